@@ -0,0 +1,279 @@
+"""
+Micro-benchmarks of the generation hot paths on the miniature model of
+configs/stable-diffusion/v1-tiny.yaml (random weights, no downloads), so a change can be
+measured on a cpu: attention backends, the UNet, sampler steps, VAE decode, the text encoder,
+initial noise, image grids, image saving and prompt parsing. Every case reports the median,
+mean and minimum milliseconds per call; with --baseline the run is compared against the json
+of an earlier run and the exit status is 1 if a case got slower than --threshold allows.
+
+    python benchmarks/micro_suite.py --json baseline.json
+    python benchmarks/micro_suite.py --baseline baseline.json --threshold 0.1
+    python benchmarks/micro_suite.py --only attention,samplers --device cuda
+"""
+import argparse, contextlib, io, json, os, platform, shutil, statistics, sys, tempfile, time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from benchmarks.tiny_models import TINY_CONFIG, load_tiny_model
+from frontend.image_metadata import ImageMetadata
+from ldm.models.batched_decode import BatchedDecoder
+from ldm.modules.attention import ATTENTION_BACKENDS, CrossAttention, resolve_attention_backend
+from modules.grid import image_grid
+from modules.image_writer import ImageWriter
+from modules.noise import create_random_tensors
+from modules.prompts import split_weighted_subprompts
+from modules.samplers import get_sampler
+
+PROMPTS = [
+    "a photograph of an astronaut riding a horse",
+    "a castle on a hill at sunset, oil painting:1.5 blurry, low quality:-0.5",
+    "portrait of a cat wearing a hat, studio lighting, highly detailed",
+    "a city street in the rain\\: neon signs:2 empty:0.5 night",
+]
+
+
+@contextlib.contextmanager
+def quiet():
+    # progress bars and schedule prints are part of the work, but not of the output
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, opt, per=1):
+    ''' milliseconds per call of fn, divided by per for cases that time several units in one call '''
+    for _ in range(opt.warmup):
+        fn()
+    synchronize(opt.device)
+    times = []
+    for _ in range(opt.runs):
+        start = time.perf_counter()
+        fn()
+        synchronize(opt.device)
+        times.append((time.perf_counter() - start) * 1e3 / per)
+    times.sort()
+    return {
+        'median_ms': round(statistics.median(times), 4),
+        'mean_ms': round(statistics.mean(times), 4),
+        'min_ms': round(times[0], 4),
+    }
+
+
+def bench_attention(opt, model):
+    # v1 shapes of the first transformer block: 320 channels in 8 heads, 77 tokens of 768 context
+    tokens = (opt.size // 8) ** 2
+    x = torch.randn(2 * opt.batch_size, tokens, 320, device=opt.device)
+    context = torch.randn(2 * opt.batch_size, 77, 768, device=opt.device)
+    for name, (_, available) in ATTENTION_BACKENDS.items():
+        if not available():
+            continue
+        with quiet():
+            resolved, op = resolve_attention_backend(name)
+        if resolved != name:
+            continue
+        self_attn = CrossAttention(320, heads=8, dim_head=40).to(opt.device).eval()
+        cross_attn = CrossAttention(320, context_dim=768, heads=8, dim_head=40).to(opt.device).eval()
+        self_attn.attention_op = cross_attn.attention_op = op
+        yield f'attention/{name}/self', lambda: self_attn(x)
+        yield f'attention/{name}/cross', lambda: cross_attn(x, context=context)
+
+
+def conditioning(opt, model):
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(opt.batch_size)]
+    return model.get_learned_conditioning(prompts), model.get_learned_conditioning(opt.batch_size * [""])
+
+
+def bench_unet(opt, model):
+    c, uc = conditioning(opt, model)
+    x = torch.randn(2 * opt.batch_size, 4, opt.size // 8, opt.size // 8, device=opt.device)
+    t = torch.full((2 * opt.batch_size,), 500, device=opt.device, dtype=torch.long)
+    cond = torch.cat([uc, c])
+    yield 'unet/cfg_batch', lambda: model.apply_model(x, t, cond)
+
+
+def bench_samplers(opt, model):
+    # per step, with classifier free guidance; the tiny UNet leaves mostly the sampler's own overhead
+    c, uc = conditioning(opt, model)
+    shape = [4, opt.size // 8, opt.size // 8]
+    x_T = torch.randn([opt.batch_size] + shape, device=opt.device)
+    for name in opt.samplers.split(','):
+        sampler = get_sampler(model, name)
+
+        def run(sampler=sampler):
+            with quiet():
+                sampler.sample(S=opt.steps, conditioning=c, batch_size=opt.batch_size, shape=shape, verbose=False,
+                               unconditional_guidance_scale=7.5, unconditional_conditioning=uc, eta=0.0, x_T=x_T)
+        yield f'samplers/{name}', run, opt.steps
+
+
+def bench_vae_decode(opt, model):
+    z = torch.randn(opt.batch_size, 4, opt.size // 8, opt.size // 8, device=opt.device)
+    decoder = BatchedDecoder()
+    yield 'vae_decode/decode_first_stage', lambda: model.decode_first_stage(z)
+    yield 'vae_decode/batched_decoder', lambda: list(decoder(model.decode_first_stage, z))
+
+
+def bench_text_encoder(opt, model):
+    encoder = model.cond_stage_model
+    prompts = [PROMPTS[i % len(PROMPTS)] for i in range(opt.batch_size)]
+
+    def uncached():
+        encoder.clear_cache()
+        model.get_learned_conditioning(prompts)
+    yield 'text_encoder/uncached', uncached
+    yield 'text_encoder/cached', lambda: model.get_learned_conditioning(prompts)
+
+
+def bench_noise(opt, model):
+    shape = [4, opt.size // 8, opt.size // 8]
+    seeds = list(range(opt.batch_size))
+    yield 'noise/create_random_tensors', lambda: create_random_tensors(shape, seeds=seeds, device=opt.device)
+    if opt.device.type != 'cpu':
+        yield 'noise/create_random_tensors_cpu', lambda: create_random_tensors(shape, seeds=seeds, device=opt.device, cpu=True)
+
+
+def sample_images(opt, n):
+    rng = np.random.default_rng(opt.seed)
+    return [Image.fromarray(rng.integers(0, 256, (opt.size, opt.size, 3), dtype=np.uint8)) for _ in range(n)]
+
+
+def bench_image_grid(opt, model):
+    images = sample_images(opt, 4 * opt.batch_size)
+    yield 'image_grid/plain', lambda: image_grid(images, opt.batch_size)
+    try:
+        image_grid(images[:1], 1, captions=['caption'])
+    except Exception as e:
+        print(f"image_grid/captions skipped: {e}", file=sys.stderr)
+        return
+    yield 'image_grid/captions', lambda: image_grid(images, opt.batch_size, captions=len(images) * ['a caption'])
+
+
+def bench_save(opt, model):
+    # what save_sample queues: a png with the generation parameters as metadata, or a jpg
+    images = sample_images(opt, opt.batch_size)
+    for i, image in enumerate(images):
+        ImageMetadata.set_on_image(image, ImageMetadata(prompt=PROMPTS[i % len(PROMPTS)], seed=str(i), width=str(opt.size), height=str(opt.size), steps=str(opt.steps)))
+    formats = {
+        'png': lambda image: {'pnginfo': ImageMetadata.get_from_image(image).as_png_info()},
+        'jpg': lambda image: {'format': 'jpeg', 'quality': 100, 'optimize': True},
+    }
+    writer = ImageWriter()
+    outdir = tempfile.mkdtemp(prefix='micro_suite_')
+
+    def encode(ext):
+        for image in images:
+            image.save(io.BytesIO(), **{'format': 'png', **formats[ext](image)})
+
+    def write(ext):
+        for i, image in enumerate(images):
+            path = os.path.join(outdir, f"{i:05}.{ext}")
+            writer.submit(image.save, path, **formats[ext](image), paths=[path])
+        writer.flush()
+    try:
+        for ext in formats:
+            # encode is the cpu work alone, written runs it on the writer pool until the files are on disk
+            yield f'save/{ext}_encode', lambda ext=ext: encode(ext), opt.batch_size
+            yield f'save/{ext}_written', lambda ext=ext: write(ext), opt.batch_size
+    finally:
+        writer.close()
+        shutil.rmtree(outdir, ignore_errors=True)
+
+
+def bench_prompts(opt, model):
+    prompts = 256 * PROMPTS
+    yield 'prompts/split_weighted_subprompts', lambda: [split_weighted_subprompts(p) for p in prompts], len(prompts)
+
+
+BENCHMARKS = {
+    'attention': bench_attention,
+    'unet': bench_unet,
+    'samplers': bench_samplers,
+    'vae_decode': bench_vae_decode,
+    'text_encoder': bench_text_encoder,
+    'noise': bench_noise,
+    'image_grid': bench_image_grid,
+    'save': bench_save,
+    'prompts': bench_prompts,
+}
+
+
+def compare(result, baseline, threshold):
+    ''' prints the cases of both runs side by side to stderr, the json stays alone on stdout, and returns the names of the ones that got slower '''
+    for key in ['device', 'threads', 'size', 'batch_size', 'steps', 'torch']:
+        if baseline.get(key) != result.get(key):
+            print(f"warning: {key} differs from the baseline ({baseline.get(key)} vs {result.get(key)}), the numbers are not comparable", file=sys.stderr)
+    slower = []
+    print(f"{'case':<44}{'baseline ms':>14}{'ms':>12}{'ratio':>9}", file=sys.stderr)
+    for name, case in result['results'].items():
+        if name not in baseline['results']:
+            print(f"{name:<44}{'-':>14}{case['median_ms']:>12.4f}{'new':>9}", file=sys.stderr)
+            continue
+        before = baseline['results'][name]['median_ms']
+        ratio = case['median_ms'] / before if before else float('inf')
+        status = ''
+        if ratio > 1 + threshold:
+            status = '  slower'
+            slower.append(name)
+        elif ratio < 1 - threshold:
+            status = '  faster'
+        print(f"{name:<44}{before:>14.4f}{case['median_ms']:>12.4f}{ratio:>8.2f}x{status}", file=sys.stderr)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='cpu', help="device to run on, cpu by default so results compare across machines")
+    parser.add_argument("--only", type=str, default=','.join(BENCHMARKS), help="comma separated: " + ', '.join(BENCHMARKS))
+    parser.add_argument("--config", type=str, default=TINY_CONFIG, help="model config, random weights are drawn for it")
+    parser.add_argument("--samplers", type=str, default='DDIM,PLMS,k_euler_a,k_lms', help="comma separated sampler names of modules.samplers")
+    parser.add_argument("--size", type=int, default=256, help="image size in pixels, the latent is 1/8 of it")
+    parser.add_argument("--batch-size", type=int, default=1, help="images per call")
+    parser.add_argument("--steps", type=int, default=10, help="sampling steps per sampler run")
+    parser.add_argument("--runs", type=int, default=10, help="number of measured calls per case")
+    parser.add_argument("--warmup", type=int, default=2, help="calls before measuring")
+    parser.add_argument("--threads", type=int, default=1, help="torch cpu threads, fixed so repeated runs are comparable")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the weights and inputs")
+    parser.add_argument("--json", type=str, default=None, help="write the results as json to this path, to use as a baseline later")
+    parser.add_argument("--baseline", type=str, default=None, help="json of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change of the median that counts as slower or faster")
+    opt = parser.parse_args()
+    opt.device = torch.device(opt.device)
+
+    torch.set_num_threads(opt.threads)
+    with quiet():
+        model = load_tiny_model(opt.device, opt.config, opt.seed)
+    result = {
+        'device': str(opt.device), 'threads': opt.threads, 'size': opt.size, 'batch_size': opt.batch_size, 'steps': opt.steps,
+        'runs': opt.runs, 'seed': opt.seed, 'config': os.path.basename(opt.config),
+        'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(), 'processor': platform.processor(),
+        'results': {},
+    }
+    with torch.no_grad():
+        for name in opt.only.split(','):
+            torch.manual_seed(opt.seed)
+            for case in BENCHMARKS[name](opt, model):
+                case_name, fn, *per = case
+                result['results'][case_name] = measure(fn, opt, *per)
+                print(f"{case_name}: {result['results'][case_name]['median_ms']} ms", file=sys.stderr)
+
+    print(json.dumps(result, indent=2))
+    if opt.json:
+        with open(opt.json, 'w', encoding='utf8') as f:
+            json.dump(result, f, indent=2)
+    if opt.baseline:
+        with open(opt.baseline, encoding='utf8') as f:
+            slower = compare(result, json.load(f), opt.threshold)
+        if slower:
+            print(f"{len(slower)} case(s) slower than the baseline: {', '.join(slower)}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Measures what a DDIM or PLMS step costs besides the UNet: the model is replaced by a
+stub that returns a fixed noise prediction, so the time per step is the sampler's own
+schedule lookups, step math, noise and loop bookkeeping.
+
+    python benchmarks/sampler_step_overhead.py --device cuda
+    python benchmarks/sampler_step_overhead.py --device cpu --compile
+"""
+import argparse, contextlib, io, json, os, statistics, sys, time
+
+import torch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.plms import PLMSSampler
+from ldm.modules.diffusionmodules.util import noise_like
+from modules.samplers import compile_steps
+
+
+class StubModel():
+    """ the parts of LatentDiffusion the samplers use, with a free apply_model """
+    parameterization = 'eps'
+
+    def __init__(self, device, shape, num_timesteps=1000):
+        self.device = device
+        self.num_timesteps = num_timesteps
+        # the v1 scaled linear schedule
+        self.betas = torch.linspace(0.00085 ** 0.5, 0.012 ** 0.5, num_timesteps, dtype=torch.float64, device=device) ** 2
+        self.alphas_cumprod = torch.cumprod(1. - self.betas, 0)
+        self.alphas_cumprod_prev = torch.cat([self.alphas_cumprod.new_ones(1), self.alphas_cumprod[:-1]])
+        self.e_t = torch.randn(shape, device=device)
+
+    def apply_model(self, x, t, c):
+        return self.e_t[:x.shape[0]]
+
+
+class LegacyDDIMSampler(DDIMSampler):
+    """ the previous step: four torch.full per step from host scalars, noise drawn even with eta 0 """
+    def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
+                      temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
+                      unconditional_guidance_scale=1., unconditional_conditioning=None):
+        b, *_, device = *x.shape, x.device
+        e_t = self.model.apply_model(x, t, c)
+        a_t = torch.full((b, 1, 1, 1), self.ddim_alphas[index], device=device)
+        a_prev = torch.full((b, 1, 1, 1), self.ddim_alphas_prev[index], device=device)
+        sigma_t = torch.full((b, 1, 1, 1), self.ddim_sigmas[index], device=device)
+        sqrt_one_minus_at = torch.full((b, 1, 1, 1), self.ddim_sqrt_one_minus_alphas[index], device=device)
+        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
+        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
+        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
+        return x_prev, pred_x0
+
+
+SAMPLERS = {'ddim': DDIMSampler, 'plms': PLMSSampler, 'ddim-legacy': LegacyDDIMSampler}
+
+
+def run(sampler, opt, shape):
+    x_T = torch.randn(shape, device=opt.device)
+    # progress bars and schedule prints are part of the loop, but not of the output
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        sampler.sample(S=opt.steps, conditioning=None, batch_size=shape[0], shape=shape[1:], verbose=False, eta=opt.eta, x_T=x_T)
+        if opt.device.type == 'cuda':
+            torch.cuda.synchronize(opt.device)
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help="device to sample on")
+    parser.add_argument("--samplers", type=str, default='ddim,plms,ddim-legacy', help="comma separated: " + ', '.join(SAMPLERS))
+    parser.add_argument("--steps", type=int, default=50, help="sampling steps per run")
+    parser.add_argument("--runs", type=int, default=10, help="number of measured runs")
+    parser.add_argument("--warmup", type=int, default=2, help="runs before measuring, they also build the schedule")
+    parser.add_argument("--batch-size", type=int, default=1, help="latents per run")
+    parser.add_argument("--size", type=int, default=512, help="image size in pixels, the latent is 1/8 of it")
+    parser.add_argument("--eta", type=float, default=0.0, help="ddim eta, plms only supports 0")
+    parser.add_argument("--compile", action='store_true', help="compile the step with torch.compile first")
+    parser.add_argument("--json", type=str, default=None, help="write the summary as json to this path")
+    opt = parser.parse_args()
+    opt.device = torch.device(opt.device)
+
+    if opt.compile and not compile_steps():
+        return
+    shape = (opt.batch_size, 4, opt.size // 8, opt.size // 8)
+    model = StubModel(opt.device, shape)
+    result = {'device': str(opt.device), 'steps': opt.steps, 'shape': list(shape), 'eta': opt.eta, 'compiled': opt.compile, 'samplers': {}}
+    for name in opt.samplers.split(','):
+        if name == 'plms' and opt.eta != 0:
+            continue
+        sampler = SAMPLERS[name](model)
+        for _ in range(opt.warmup):
+            run(sampler, opt, shape)
+        per_step = sorted(run(sampler, opt, shape) / opt.steps * 1e6 for _ in range(opt.runs))
+        result['samplers'][name] = {
+            'mean_us_per_step': round(statistics.mean(per_step), 1),
+            'median_us_per_step': round(statistics.median(per_step), 1),
+            'min_us_per_step': round(per_step[0], 1),
+        }
+    print(json.dumps(result, indent=2))
+    if opt.json:
+        with open(opt.json, 'w', encoding='utf8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Measures the dispatch overhead of every hop in the Discord bot pipeline
+(bot -> worker -> bot -> upscaler -> bot) with dummy workers that do no work,
+so the numbers are pure queue + wakeup latency.
+
+    python benchmarks/sdb_dispatch_latency.py --mode event
+    python benchmarks/sdb_dispatch_latency.py --mode poll
+"""
+import argparse, asyncio, json, os, random, statistics, sys, time
+from multiprocessing import Process, Queue
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modules.sdb_dispatch import QueueBridge
+
+HOPS = ['bot->worker', 'worker->bot', 'bot->upscaler', 'upscaler->bot']
+
+
+class PollingGetter():
+    """ the previous dispatch: check Queue.empty() and sleep """
+    def __init__(self, source, interval):
+        self.source = source
+        self.interval = interval
+
+    async def get(self):
+        while True:
+            if not self.source.empty():
+                return self.source.get()
+            await asyncio.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+def make_getter(mode, source, name, interval):
+    if mode == 'poll':
+        return PollingGetter(source, interval)
+    return QueueBridge(source, name)
+
+
+async def dummy_loop(mode, in_queue, out_queue, name, interval):
+    getter = make_getter(mode, in_queue, name, interval)
+    while True:
+        item = await getter.get()
+        if item is None:
+            getter.close()
+            return
+        item.append(time.perf_counter())
+        out_queue.put(item)
+
+
+def dummy_launch(mode, in_queue, out_queue, name, interval):
+    asyncio.run(dummy_loop(mode, in_queue, out_queue, name, interval))
+
+
+async def bot_loop(opt, dream_queue, awaken_queue, upscale_queue, upscaled_queue):
+    # the real bot polled every 0.5s, the worker every 0.2s and the upscaler every 0.5s
+    awaken = make_getter(opt.mode, awaken_queue, 'awaken', 0.5)
+    upscaled = make_getter(opt.mode, upscaled_queue, 'upscaled', 0.5)
+    samples = {hop: [] for hop in HOPS}
+    for i in range(opt.jobs + opt.warmup):
+        # jitter the arrival time so polled consumers are caught at random phases
+        await asyncio.sleep(random.uniform(0, opt.gap))
+        dream = [time.perf_counter()]
+        dream_queue.put(dream)
+        dream = await awaken.get()
+        dream.append(time.perf_counter())
+        upscale_queue.put(dream)
+        dream = await upscaled.get()
+        dream.append(time.perf_counter())
+        if i >= opt.warmup:
+            for hop, start, end in zip(HOPS, dream, dream[1:]):
+                samples[hop].append((end - start) * 1000)
+    awaken.close()
+    upscaled.close()
+    return samples
+
+
+def summarize(samples):
+    result = {}
+    for hop, values in samples.items():
+        values = sorted(values)
+        result[hop] = {
+            'mean_ms': round(statistics.mean(values), 3),
+            'median_ms': round(statistics.median(values), 3),
+            'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))], 3),
+            'max_ms': round(values[-1], 3),
+        }
+    total = [sum(hop) for hop in zip(*samples.values())]
+    result['total'] = {
+        'mean_ms': round(statistics.mean(total), 3),
+        'median_ms': round(statistics.median(total), 3),
+    }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, choices=['event', 'poll'], default='event', help="dispatch implementation to measure")
+    parser.add_argument("--jobs", type=int, default=50, help="number of measured jobs")
+    parser.add_argument("--warmup", type=int, default=3, help="jobs to run before measuring")
+    parser.add_argument("--gap", type=float, default=0.05, help="maximum random delay in seconds between jobs")
+    parser.add_argument("--json", type=str, default=None, help="write the summary as json to this path")
+    opt = parser.parse_args()
+
+    dream_queue, awaken_queue = Queue(), Queue()
+    upscale_queue, upscaled_queue = Queue(), Queue()
+    worker = Process(target=dummy_launch, args=(opt.mode, dream_queue, awaken_queue, 'dream', 0.2))
+    upscaler = Process(target=dummy_launch, args=(opt.mode, upscale_queue, upscaled_queue, 'upscale', 0.5))
+    worker.start()
+    upscaler.start()
+    try:
+        samples = asyncio.run(bot_loop(opt, dream_queue, awaken_queue, upscale_queue, upscaled_queue))
+    finally:
+        dream_queue.put(None)
+        upscale_queue.put(None)
+        worker.join()
+        upscaler.join()
+
+    result = {'mode': opt.mode, 'jobs': opt.jobs, 'hops': summarize(samples)}
+    print(json.dumps(result, indent=2))
+    if opt.json:
+        with open(opt.json, 'w', encoding='utf8') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
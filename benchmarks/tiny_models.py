@@ -0,0 +1,57 @@
+"""
+Miniature stand-ins for the v1 models, built from configs/stable-diffusion/v1-tiny.yaml with
+random weights, so benchmarks run on a cpu without a checkpoint or downloads.
+"""
+import os, sys, zlib
+
+import torch
+import torch.nn as nn
+from omegaconf import OmegaConf
+from transformers import CLIPTextConfig, CLIPTextModel
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from ldm.modules.encoders.modules import FrozenCLIPEmbedder
+from ldm.util import instantiate_from_config
+
+TINY_CONFIG = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'configs', 'stable-diffusion', 'v1-tiny.yaml'))
+
+
+class HashTokenizer():
+    """ the CLIPTokenizer call without a vocabulary file: a word's id is its crc32 modulo the vocabulary """
+    def __init__(self, vocab_size):
+        # CLIP's pooling looks for the end token as the largest id
+        self.bos = vocab_size - 2
+        self.eos = vocab_size - 1
+        self.words = vocab_size - 2
+
+    def encode(self, text, max_length):
+        ids = [zlib.crc32(word.encode('utf8')) % self.words for word in text.lower().split()]
+        ids = [self.bos] + ids[:max_length - 2] + [self.eos]
+        return ids + [self.eos] * (max_length - len(ids))
+
+    def __call__(self, text, max_length=77, **kwargs):
+        if isinstance(text, str):
+            text = [text]
+        return {"input_ids": torch.tensor([self.encode(t, max_length) for t in text])}
+
+
+class TinyCLIPEmbedder(FrozenCLIPEmbedder):
+    """ FrozenCLIPEmbedder, prompt cache included, around a small randomly initialized CLIP text transformer """
+    def __init__(self, hidden_size=64, layers=2, heads=4, vocab_size=1024, device="cpu", max_length=77, cache_mb=64):
+        nn.Module.__init__(self)
+        self.tokenizer = HashTokenizer(vocab_size)
+        self.transformer = CLIPTextModel(CLIPTextConfig(vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=4 * hidden_size,
+                                                        num_hidden_layers=layers, num_attention_heads=heads, max_position_embeddings=max_length))
+        self.device = device
+        self.max_length = max_length
+        self.cache_mb = cache_mb
+        self.clear_cache()
+        self.freeze()
+
+
+def load_tiny_model(device, config=TINY_CONFIG, seed=0):
+    ''' the LatentDiffusion of config with weights drawn from seed, in eval mode on device '''
+    torch.manual_seed(seed)
+    model = instantiate_from_config(OmegaConf.load(config).model)
+    model.cond_stage_model.device = device
+    return model.eval().to(device)
@@ -1,6 +1,6 @@
 import gradio as gr
 from frontend.css_and_js import css, js, call_JS, js_parse_prompt, js_copy_txt2img_output
-from frontend.job_manager import JobManager
+from frontend.job_manager import JobManager, batch_priority
 import frontend.ui_functions as uifn
 import uuid
 import torch
@@ -13,7 +13,7 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                    img2img_toggles={}, img2img_toggle_defaults={}, sample_img2img=None, img2img_mask_modes=None,
                    img2img_resize_modes=None, imgproc_defaults={}, imgproc_mode_toggles={}, user_defaults={},
                    run_GFPGAN=lambda x: x, run_RealESRGAN=lambda x: x,
-                   job_manager: JobManager = None) -> gr.Blocks:
+                   job_manager: JobManager = None, telemetry=None) -> gr.Blocks:
     with gr.Blocks(css=css(opt), analytics_enabled=False, title="Stable Diffusion WebUI") as demo:
         with gr.Tabs(elem_id='tabss') as tabs:
             with gr.TabItem("Text-to-Image", id='txt2img_tab'):
@@ -112,6 +112,11 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                                                    value=txt2img_defaults['variant_amount'])
                                 txt2img_variant_seed = gr.Textbox(label="Variant Seed (blank to randomize)", lines=1,
                                                                   max_lines=1, value=txt2img_defaults["variant_seed"])
+                                with gr.Row():
+                                    txt2img_cfg_sigma_min = gr.Number(label="Guide from sigma (k-diffusion, 0 = to the end)",
+                                                                      value=txt2img_defaults['cfg_sigma_min'])
+                                    txt2img_cfg_sigma_max = gr.Number(label="Guide up to sigma (k-diffusion, 0 = from the start)",
+                                                                      value=txt2img_defaults['cfg_sigma_max'])
                         txt2img_embeddings = gr.File(label="Embeddings file for textual inversion",
                                                      visible=show_embeddings)
 
@@ -119,7 +124,8 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                 txt2img_inputs = [txt2img_prompt, txt2img_steps, txt2img_sampling, txt2img_toggles,
                                   txt2img_realesrgan_model_name, txt2img_ddim_eta, txt2img_batch_count,
                                   txt2img_batch_size, txt2img_cfg, txt2img_seed, txt2img_height, txt2img_width,
-                                  txt2img_embeddings, txt2img_variant_amount, txt2img_variant_seed]
+                                  txt2img_embeddings, txt2img_variant_amount, txt2img_variant_seed,
+                                  txt2img_cfg_sigma_min, txt2img_cfg_sigma_max]
                 txt2img_outputs = [output_txt2img_gallery, output_txt2img_seed,
                                    output_txt2img_params, output_txt2img_stats]
 
@@ -128,7 +134,8 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                     txt2img_func, txt2img_inputs, txt2img_outputs = txt2img_job_ui.wrap_func(
                         func=txt2img_func,
                         inputs=txt2img_inputs,
-                        outputs=txt2img_outputs
+                        outputs=txt2img_outputs,
+                        priority=batch_priority(txt2img_inputs, txt2img_batch_count, txt2img_batch_size)
                     )
                     use_queue = False
                 else:
@@ -297,6 +304,11 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                                                              'RealESRGAN_x4plus_anime_6B'],
                                                                     value='RealESRGAN_x4plus',
                                                                     visible=RealESRGAN is not None)  # TODO: Feels like I shouldnt slot it in here.
+                        with gr.Row():
+                            img2img_cfg_sigma_min = gr.Number(label="Guide from sigma (k-diffusion, 0 = to the end)",
+                                                              value=img2img_defaults['cfg_sigma_min'])
+                            img2img_cfg_sigma_max = gr.Number(label="Guide up to sigma (k-diffusion, 0 = from the start)",
+                                                              value=img2img_defaults['cfg_sigma_max'])
 
                         img2img_embeddings = gr.File(label="Embeddings file for textual inversion",
                                                      visible=show_embeddings)
@@ -356,7 +368,8 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                                   img2img_mask_restore, img2img_steps, img2img_sampling, img2img_toggles,
                                   img2img_realesrgan_model_name, img2img_batch_count, img2img_cfg,
                                   img2img_denoising, img2img_seed, img2img_height, img2img_width, img2img_resize,
-                                  img2img_image_editor, img2img_image_mask, img2img_embeddings]
+                                  img2img_image_editor, img2img_image_mask, img2img_embeddings,
+                                  img2img_cfg_sigma_min, img2img_cfg_sigma_max]
                 img2img_outputs = [output_img2img_gallery, output_img2img_seed, output_img2img_params,
                                    output_img2img_stats]
 
@@ -366,6 +379,7 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
                         func=img2img_func,
                         inputs=img2img_inputs,
                         outputs=img2img_outputs,
+                        priority=batch_priority(img2img_inputs, img2img_batch_count)
                     )
                     use_queue = False
                 else:
@@ -663,6 +677,11 @@ def draw_gradio_ui(opt, img2img=lambda x: x, txt2img=lambda x: x, imgproc=lambda
         # Hack: Detect the load event on the frontend
         # Won't be needed in the next version of gradio
         # See the relevant PR: https://github.com/gradio-app/gradio/pull/2108
+        if telemetry:
+            # device memory and utilization as json at /api/telemetry/
+            telemetry_btn = gr.Button(visible=False)
+            telemetry_json = gr.JSON(visible=False)
+            telemetry_btn.click(telemetry, [], [telemetry_json], api_name="telemetry", queue=False)
         load_detector = gr.Number(value=0, label="Load Detector", visible=False)
         load_detector.change(None, None, None, _js=js(opt))
         demo.load(lambda x: 42, inputs=load_detector, outputs=load_detector)
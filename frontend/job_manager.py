@@ -2,9 +2,10 @@
 from __future__ import annotations
 import gradio as gr
 from gradio.components import Component, Gallery, Slider
-from threading import Event, Timer
-from typing import Callable, List, Dict, Tuple, Optional, Any
+from threading import Event, Lock
+from typing import Callable, List, Dict, Tuple, Optional, Any, Deque
 from dataclasses import dataclass, field
+from collections import deque
 from functools import partial
 from PIL.Image import Image
 import uuid
@@ -30,6 +31,8 @@ class JobInfo:
     func: Callable
     session_key: str
     job_token: Optional[int] = None
+    priority: int = 0
+    queue_item: Optional[QueueItem] = None
     images: List[Image] = field(default_factory=list)
     active_image: Image = None
     rec_steps_enabled: bool = False
@@ -58,6 +61,28 @@ class SessionInfo:
 @dataclass
 class QueueItem:
     wait_event: Event
+    session_key: str = None
+    priority: int = 0
+    enqueue_time: float = field(default_factory=time.time)
+    job_token: Optional[int] = None
+
+
+def batch_priority(inputs: List[Component], *components: Component) -> Callable[..., int]:
+    ''' Makes a priority function for wrap_func from the inputs holding a job's batch count, batch size etc.
+        A job making one image gets priority 0, 2-3 images 1, 4-7 images 2 and so on '''
+    idxs = [next(i for i, comp in enumerate(inputs) if comp is component) for component in components]
+
+    def priority(*values) -> int:
+        images = 1
+        for idx in idxs:
+            images *= max(int(values[idx] or 1), 1)
+        return images.bit_length() - 1
+    return priority
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[round(q * (len(values) - 1))]
 
 
 def triggerChangeEvent():
@@ -70,7 +95,8 @@ class JobManagerUi:
             self,
             func: Callable,
             inputs: List[Component],
-            outputs: List[Component]) -> Tuple[Callable, List[Component], List[Component]]:
+            outputs: List[Component],
+            priority: Callable[..., int] = None) -> Tuple[Callable, List[Component], List[Component]]:
         ''' Takes a gradio event listener function and its input/outputs and returns wrapped replacements which will
             be managed by JobManager
         Parameters:
@@ -79,6 +105,8 @@ class JobManagerUi:
                         be used by the function to check for stop events and to store intermediate image results
         inputs (List[Component]) the original inputs
         outputs (List[Component]) the original outputs. The first gallery, if any, will be used for refreshing images
+        priority (Callable, optional) called with the job's input values, returns its priority. Queued jobs with
+                        a lower priority start first, see batch_priority
         refresh_btn: (gr.Button, optional) a button to use for updating the gallery with intermediate results
         stop_btn: (gr.Button, optional) a button to use for stopping the function
         status_text: (gr.Textbox) a textbox to display job status updates
@@ -89,7 +117,7 @@ class JobManagerUi:
         '''
         return self._job_manager._wrap_func(
             func=func, inputs=inputs, outputs=outputs,
-            job_ui=self
+            job_ui=self, priority=priority
         )
 
     _refresh_btn: gr.Button
@@ -97,6 +125,7 @@ class JobManagerUi:
     _status_text: gr.Textbox
     _stop_all_session_btn: gr.Button
     _free_done_sessions_btn: gr.Button
+    _queue_stats_btn: gr.Button
     _active_image: gr.Image
     _active_image_stop_btn: gr.Button
     _active_image_refresh_btn: gr.Button
@@ -109,11 +138,17 @@ class JobManagerUi:
 
 class JobManager:
     JOB_MAX_START_TIME = 5.0  # How long can a job be stuck 'starting' before assuming it isn't running
+    JOB_PRIORITY_AGING = 30.0  # How long a job waits in the queue to move up one priority, so big jobs still start
+    WAIT_TIME_HISTORY = 1000  # How many recent queue waits are kept for the metrics
 
     def __init__(self, max_jobs: int):
         self._max_jobs: int = max_jobs
+        # The tokens, queue and running counts are only touched with the lock held
+        self._lock = Lock()
         self._avail_job_tokens: List[Any] = list(range(max_jobs))
         self._job_queue: List[QueueItem] = []
+        self._running_jobs: Dict[str, int] = {}
+        self._wait_times: Deque[Tuple[int, float]] = deque(maxlen=JobManager.WAIT_TIME_HISTORY)
         self._sessions: Dict[str, SessionInfo] = {}
         self._session_key: gr.JSON = None
 
@@ -152,9 +187,11 @@ class JobManager:
                     free_done_sessions_btn = gr.Button(
                         "Clear Finished Jobs", elem_id="clear_finished", variant="secondary"
                     )
+                    queue_stats_btn = gr.Button("Queue Statistics", elem_id="queue_stats", variant="secondary")
 
         return JobManagerUi(_refresh_btn=refresh_btn, _stop_btn=stop_btn, _status_text=status_text,
                             _stop_all_session_btn=stop_all_sessions_btn, _free_done_sessions_btn=free_done_sessions_btn,
+                            _queue_stats_btn=queue_stats_btn,
                             _active_image=active_image, _active_image_stop_btn=active_image_stop_btn,
                             _active_image_refresh_btn=active_image_refresh_btn,
                             _rec_steps_checkbox=record_steps_checkbox,
@@ -175,31 +212,96 @@ class JobManager:
             for job in session.jobs.values():
                 job.should_stop.set()
                 job.stop_cur_iter.set()
-
-    def _get_job_token(self, block: bool = False) -> Optional[int]:
-        ''' Attempts to acquire a job token, optionally blocking until available '''
-        token = None
-        while token is None:
-            try:
-                token = self._avail_job_tokens.pop()
-                break
-            except IndexError:
-                pass
-
-            if not block:
-                break
+                self._cancel_queued_job(job)
+
+    def metrics(self) -> Dict[str, Any]:
+        ''' Queue depth and the wait times of recently started jobs, per priority '''
+        with self._lock:
+            queued: Dict[int, int] = {}
+            for item in self._job_queue:
+                queued[item.priority] = queued.get(item.priority, 0) + 1
+            waits: Dict[int, List[float]] = {}
+            for priority, wait in self._wait_times:
+                waits.setdefault(priority, []).append(wait)
+            return {
+                'running': self._max_jobs - len(self._avail_job_tokens),
+                'max_jobs': self._max_jobs,
+                'queued': len(self._job_queue),
+                'queued_by_priority': queued,
+                'wait_by_priority': {
+                    priority: {'count': len(w), 'p50': percentile(w, 0.5), 'p95': percentile(w, 0.95), 'max': max(w)}
+                    for priority, w in sorted(waits.items())
+                },
+            }
+
+    def _queue_stats(self) -> str:
+        ''' Formats metrics() for the status text '''
+        metrics = self.metrics()
+        text = f"Running {metrics['running']}/{metrics['max_jobs']} jobs, {metrics['queued']} queued."
+        for priority, wait in metrics['wait_by_priority'].items():
+            text += f" Priority {priority}: waited p50 {wait['p50']:.1f}s, p95 {wait['p95']:.1f}s over {wait['count']} jobs."
+        return text
+
+    def _get_job_token(self, job_info: JobInfo, block: bool = False) -> Optional[int]:
+        ''' Attempts to acquire a job token, optionally blocking until one is handed over.
+            Returns None if the job was cancelled while queued '''
+        with self._lock:
+            # Tokens are handed straight to queued jobs, so a free token means nobody is waiting
+            if self._avail_job_tokens:
+                return self._start_job(self._avail_job_tokens.pop(), job_info.session_key, job_info.priority, 0.0)
+            if not block or job_info.should_stop.is_set():
+                return None
 
             # No token and requested to block, so queue up
-            wait_event = Event()
-            self._job_queue.append(QueueItem(wait_event))
-            wait_event.wait()
-
+            queue_item = QueueItem(Event(), session_key=job_info.session_key, priority=job_info.priority)
+            self._job_queue.append(queue_item)
+            job_info.queue_item = queue_item
+
+        queue_item.wait_event.wait()
+        job_info.queue_item = None
+        return queue_item.job_token
+
+    def _start_job(self, token: int, session_key: str, priority: int, wait: float) -> int:
+        ''' Books a token to a session. Must be called with the lock held '''
+        self._running_jobs[session_key] = self._running_jobs.get(session_key, 0) + 1
+        self._wait_times.append((priority, wait))
         return token
 
-    def _release_job_token(self, token: int) -> None:
-        ''' Returns a job token to allow another job to start '''
-        self._avail_job_tokens.append(token)
-        self._run_queued_jobs()
+    def _next_queued_job(self) -> QueueItem:
+        ''' The queued job to start next: lowest priority after aging, then the session running the fewest jobs,
+            then the longest waiting. Must be called with the lock held '''
+        now = time.time()
+        return min(self._job_queue, key=lambda item: (
+            item.priority - int((now - item.enqueue_time) // JobManager.JOB_PRIORITY_AGING),
+            self._running_jobs.get(item.session_key, 0),
+            item.enqueue_time))
+
+    def _release_job_token(self, token: Optional[int], session_key: str) -> None:
+        ''' Returns a job token, handing it to the next queued job if there is one '''
+        if token is None:
+            return
+        with self._lock:
+            self._running_jobs[session_key] -= 1
+            if not self._running_jobs[session_key]:
+                del self._running_jobs[session_key]
+            if not self._job_queue:
+                self._avail_job_tokens.append(token)
+                return
+
+            queue_item = self._next_queued_job()
+            self._job_queue.remove(queue_item)
+            queue_item.job_token = self._start_job(token, queue_item.session_key, queue_item.priority,
+                                                   time.time() - queue_item.enqueue_time)
+        queue_item.wait_event.set()
+
+    def _cancel_queued_job(self, job_info: JobInfo) -> None:
+        ''' Takes a stopped job out of the queue right away, its waiter returns without a token '''
+        with self._lock:
+            queue_item = job_info.queue_item
+            if queue_item is None or queue_item not in self._job_queue:
+                return
+            self._job_queue.remove(queue_item)
+        queue_item.wait_event.set()
 
     def _refresh_func(self, func_key: FuncKey, session_key: str) -> List[Component]:
         ''' Updates information from the active job '''
@@ -214,6 +316,7 @@ class JobManager:
         if job_info is None:
             return f"Session {session_key} was not running function {func_key}"
         job_info.should_stop.set()
+        self._cancel_queued_job(job_info)
         return "Stopping after current batch finishes"
 
     def _refresh_cur_iter_func(self, func_key: FuncKey, session_key: str) -> List[Component]:
@@ -252,30 +355,23 @@ class JobManager:
 
         return session_info, job_info
 
-    def _run_queued_jobs(self) -> None:
-        ''' Runs queued jobs for any available slots '''
-        if self._avail_job_tokens:
-            try:
-                # Notify next queued job it may begin
-                queue_item = self._job_queue.pop(0)
-                queue_item.wait_event.set()
-
-                # Check again in a few seconds, just in case the queued
-                # waiter closed the browser while still queued
-                Timer(3.0, self._run_queued_jobs).start()
-            except IndexError:
-                pass  # No queued jobs
-
     def _pre_call_func(
             self, func_key: FuncKey, output_dummy_obj: Component, refresh_btn: gr.Button, stop_btn: gr.Button,
             status_text: gr.Textbox, active_image: gr.Image, active_refresh_btn: gr.Button, active_stop_btn: gr.Button,
             session_key: str) -> List[Component]:
         ''' Called when a job is about to start '''
         session_info, job_info = self._get_call_info(func_key, session_key)
+        if job_info is None:
+            return {}
 
         # If we didn't already get a token then queue up for one
         if job_info.job_token is None:
-            job_info.job_token = self._get_job_token(block=True)
+            token = self._get_job_token(job_info, block=True)
+            with self._lock:
+                # A job tossed while it waited is gone from the session and never runs, its token goes back
+                if session_info.jobs.get(func_key) is job_info:
+                    job_info.job_token, token = token, None
+            self._release_job_token(token, session_key)
 
         # Buttons don't seem to update unless value is set on them as well...
         return {output_dummy_obj: triggerChangeEvent(),
@@ -304,7 +400,7 @@ class JobManager:
         finally:
             job_info.finished = True
             session_info.finished_jobs[func_key] = session_info.jobs.pop(func_key)
-            self._release_job_token(job_info.job_token)
+            self._release_job_token(job_info.job_token, job_info.session_key)
 
         # Filter the function output for any removed outputs
         filtered_output = []
@@ -344,7 +440,8 @@ class JobManager:
 
     def _wrap_func(self, func: Callable, inputs: List[Component],
                    outputs: List[Component],
-                   job_ui: JobManagerUi) -> Tuple[Callable, List[Component]]:
+                   job_ui: JobManagerUi,
+                   priority: Callable[..., int] = None) -> Tuple[Callable, List[Component]]:
         ''' handles JobManageUI's wrap_func'''
 
         assert gr.context.Context.block is not None, "wrap_func must be called within a 'gr.Blocks' 'with' context"
@@ -423,6 +520,12 @@ class JobManager:
                 queue=False
             )
 
+        if job_ui._queue_stats_btn:
+            job_ui._queue_stats_btn.click(
+                self._queue_stats, [], [job_ui._status_text],
+                queue=False
+            )
+
         # (ab)use gr.JSON to forward events.
         # The gr.JSON object will fire its 'change' event when it is modified by being the output
         # of another component. This allows a method to forward events and allow multiple components
@@ -493,7 +596,12 @@ class JobManager:
                 if not job_info.started and time.time() > job_info.timestamp + JobManager.JOB_MAX_START_TIME:
                     job_info.should_stop.set()
                     job_info.stop_cur_iter.set()
+                    self._cancel_queued_job(job_info)
                     session_info.jobs.pop(func_key)
+                    # _call_func won't find the job to release a token it already holds
+                    with self._lock:
+                        token, job_info.job_token = job_info.job_token, None
+                    self._release_job_token(token, session_key)
                     return {job_ui._status_text: "Canceled possibly hung job. Try again"}
                 return {job_ui._status_text: "This session is already running that function!"}
 
@@ -501,16 +609,16 @@ class JobManager:
             if func_key in session_info.finished_jobs:
                 session_info.finished_jobs.pop(func_key)
 
-            job_token = self._get_job_token(block=False)
             job = JobInfo(
                 inputs=job_inputs, func=func, removed_output_idxs=removed_idxs, session_key=session_key,
-                job_token=job_token, rec_steps_enabled=record_steps_enabled, rec_steps_intrvl=rec_steps_interval,
+                priority=priority(*job_inputs) if priority else 0, rec_steps_enabled=record_steps_enabled, rec_steps_intrvl=rec_steps_interval,
                 rec_steps_to_gallery=save_rec_steps_grid, rec_steps_to_file=save_rec_steps_file, timestamp=time.time())
+            job.job_token = self._get_job_token(job, block=False)
             session_info.jobs[func_key] = job
 
             ret = {pre_call_dummyobj: triggerChangeEvent()}
-            if job_token is None:
-                ret[job_ui._status_text] = "Job is queued"
+            if job.job_token is None:
+                ret[job_ui._status_text] = f"Job is queued, {self.metrics()['queued']} other jobs are waiting"
             return ret
 
         return wrapped_func, inputs + added_inputs, [pre_call_dummyobj, job_ui._status_text]
@@ -0,0 +1,210 @@
+import os
+import glob
+import hashlib
+import inspect
+from collections import abc
+from contextlib import contextmanager
+
+import torch
+
+from ldm.util import instantiate_from_config
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+except ImportError:
+    safe_open = None
+
+
+# weight init functions that are pointless when every weight is overwritten from a checkpoint
+INIT_FUNCTIONS = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'dirac_',
+                  'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_', 'sparse_']
+
+
+@contextmanager
+def no_init_weights():
+    ''' modules built inside allocate their weights but skip the random init '''
+    saved = {name: getattr(torch.nn.init, name) for name in INIT_FUNCTIONS if hasattr(torch.nn.init, name)}
+    try:
+        for name in saved:
+            setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        yield
+    finally:
+        for name, fn in saved.items():
+            setattr(torch.nn.init, name, fn)
+
+
+class LazyStateDict(abc.Mapping):
+    ''' a state dict whose tensors are read from the file only when they are looked up '''
+    def __init__(self, keys, get, metadata=None):
+        self._keys = list(keys)
+        self._key_set = set(self._keys)
+        self._get = get
+        self.metadata = metadata or {}
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        return self._get(key)
+
+    def __contains__(self, key):
+        return key in self._key_set
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def torch_mmap():
+    # torch >= 2.1 can map the zip file instead of reading it into memory
+    return 'mmap' in inspect.signature(torch.load).parameters
+
+
+def torch_load_mmap(path):
+    if torch_mmap():
+        return torch.load(path, map_location="cpu", mmap=True)
+    return torch.load(path, map_location="cpu")
+
+
+def mapped_cache():
+    ''' whether a cache file is mapped on load instead of read, which makes it faster than any .ckpt '''
+    return safe_open is not None or torch_mmap()
+
+
+def cache_path(ckpt, keys=None):
+    # a cache limited to the keys of one model is its own file, another config gets the tensors it needs
+    tag = '' if keys is None else '-' + hashlib.sha1('\n'.join(sorted(keys)).encode('utf8')).hexdigest()[:12]
+    return ckpt + '.cache' + tag + ('.safetensors' if safe_open is not None else '.pt')
+
+
+def open_state_dict(path):
+    if path.endswith('.safetensors'):
+        if safe_open is None:
+            raise ImportError(f'{path} needs the safetensors package')
+        f = safe_open(path, framework="pt", device="cpu")
+        return LazyStateDict(f.keys(), f.get_tensor, f.metadata())
+    pl_sd = torch_load_mmap(path)
+    if "global_step" in pl_sd:
+        print(f"Global Step: {pl_sd['global_step']}")
+    return pl_sd.get("state_dict", pl_sd)
+
+
+def convert_checkpoint(ckpt, keys=None, sd=None):
+    '''
+    writes the state dict of a pickled .ckpt once into a cache file next to it, as safetensors
+    when available, so later loads map the file instead of unpickling it; keys limits the
+    cache to the tensors the model uses, which drops the ema and optimizer copies. sd is the
+    state dict of ckpt if it is already open
+    '''
+    target = cache_path(ckpt, keys)
+    print(f"Converting {ckpt} to {target}")
+    if sd is None:
+        sd = open_state_dict(ckpt)
+    sd = {k: v.contiguous() for k, v in sd.items() if torch.is_tensor(v) and (keys is None or k in keys)}
+    tmp = target + '.tmp'
+    if safe_open is not None:
+        # safetensors refuses tensors that share memory
+        seen = set()
+        for k, v in sd.items():
+            if v.data_ptr() in seen:
+                sd[k] = v.clone()
+            seen.add(sd[k].data_ptr())
+        save_file(sd, tmp)
+    else:
+        torch.save({"state_dict": sd}, tmp)
+    os.replace(tmp, target)
+    # every cache is a copy of the model, only the one written last is kept
+    for path in glob.glob(glob.escape(ckpt) + '.cache*'):
+        if path != target and not path.endswith('.tmp'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return target
+
+
+def load_state_dict(ckpt, keys=None, cache=True):
+    '''
+    opens the fastest available copy of a checkpoint. A cache is written on first use only where
+    it makes later loads faster: when it is mapped, it holds every tensor and serves any model;
+    when it is read in full, only if keys drops tensors the model does not use. cache=False
+    always opens ckpt itself
+    '''
+    if ckpt.endswith('.safetensors') or not cache:
+        return open_state_dict(ckpt)
+    if mapped_cache():
+        # only the tensors that are looked up are read, a filtered copy would not be faster
+        keys = None
+    target = cache_path(ckpt, keys)
+    if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(ckpt):
+        return open_state_dict(target)
+    sd = None
+    if not mapped_cache():
+        sd = open_state_dict(ckpt)
+        if keys is None or all(k in keys for k, v in sd.items() if torch.is_tensor(v)):
+            # a copy of the same tensors would be read just as slowly
+            return sd
+    try:
+        convert_checkpoint(ckpt, keys, sd)
+    except Exception as e:
+        print(f"Could not cache {ckpt}, loading it directly: {e}")
+        return sd if sd is not None else open_state_dict(ckpt)
+    if sd is not None:
+        # already in memory, reading the cache back would load it twice
+        return {k: v for k, v in sd.items() if k in keys}
+    return open_state_dict(target)
+
+
+def load_into(model, sd):
+    '''
+    copies every tensor of sd into the matching parameter or buffer of model, in place, converting
+    to the dtype and device the model already has; returns the missing and unexpected keys
+    '''
+    own = model.state_dict(keep_vars=True)
+    missing = [k for k in own if k not in sd]
+    unexpected = [k for k in sd if k not in own]
+    with torch.no_grad():
+        for key, target in own.items():
+            if key not in sd:
+                continue
+            value = sd[key]
+            if value.shape != target.shape:
+                raise RuntimeError(f'size mismatch for {key}: copying a param with shape {tuple(value.shape)} from checkpoint, the shape in current model is {tuple(target.shape)}.')
+            target.copy_(value)
+            del value
+
+    # weights that were not in the checkpoint never got their init, give it to them now
+    for name, module in model.named_modules():
+        if hasattr(module, 'reset_parameters') and any(k.rsplit('.', 1)[0] == name for k in missing):
+            module.reset_parameters()
+    return missing, unexpected
+
+
+def load_model(config, ckpt, device=None, half=False, verbose=False, cache=True):
+    '''
+    builds config.model without random weight init and streams the checkpoint into it;
+    the model is moved to its final dtype and device before the weights are copied, so
+    the weights are never held twice in host memory
+    '''
+    print(f"Loading model from {ckpt}")
+    with no_init_weights():
+        model = instantiate_from_config(config.model)
+    if half:
+        model = model.half()
+    if device is not None:
+        model = model.to(device)
+
+    sd = load_state_dict(ckpt, keys=set(model.state_dict().keys()), cache=cache)
+    m, u = load_into(model, sd)
+    if len(m) > 0 and verbose:
+        print("missing keys:")
+        print(m)
+    if len(u) > 0 and verbose:
+        print("unexpected keys:")
+        print(u)
+    del sd
+
+    model.eval()
+    return model
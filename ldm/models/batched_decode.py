@@ -0,0 +1,89 @@
+import torch
+
+
+class BatchedDecoder():
+    """
+    Decodes latents with the first stage in micro-batches sized to the free memory.
+
+    The micro-batch size is estimated from free device memory once per call, halved
+    on out of memory errors and the smaller size is remembered for later calls.
+    On CUDA the uint8 conversion runs on the device and the device to host copy of
+    one micro-batch runs on a side stream while the next micro-batch decodes.
+    Samples are yielded in order as numpy arrays in h w c layout.
+    """
+    def __init__(self, max_batch=8, bytes_per_pixel=128 * 6, factor=8):
+        self.max_batch = max_batch
+        # rough peak activation size of the decoder per output pixel and byte of precision
+        self.bytes_per_pixel = bytes_per_pixel
+        self.factor = factor
+        self.fits = None
+        self.streams = {}
+
+    def batch_size(self, samples):
+        n = min(len(samples), self.max_batch)
+        if self.fits is not None:
+            n = min(n, self.fits)
+        if samples.device.type != 'cuda':
+            return n
+        stats = torch.cuda.memory_stats(samples.device)
+        mem_free_cuda, _ = torch.cuda.mem_get_info(samples.device)
+        mem_free_total = mem_free_cuda + stats['reserved_bytes.all.current'] - stats['active_bytes.all.current']
+        pixels = samples.shape[2] * samples.shape[3] * self.factor ** 2
+        per_sample = pixels * self.bytes_per_pixel * samples.element_size()
+        return max(1, min(n, mem_free_total // per_sample))
+
+    def to_host(self, x, to_uint8):
+        x = torch.clamp((x + 1.0) / 2.0, min=0.0, max=1.0)
+        if to_uint8:
+            x = (255. * x).to(torch.uint8) # truncates, same as astype(np.uint8)
+        x = x.permute(0, 2, 3, 1).contiguous()
+        if x.device.type != 'cuda':
+            return x, None
+
+        if x.device not in self.streams:
+            self.streams[x.device] = torch.cuda.Stream(x.device)
+        stream = self.streams[x.device]
+        stream.wait_stream(torch.cuda.current_stream(x.device))
+        host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        with torch.cuda.stream(stream):
+            host.copy_(x, non_blocking=True)
+        x.record_stream(stream)
+        event = torch.cuda.Event()
+        event.record(stream)
+        return host, event
+
+    def finish(self, pending):
+        host, event = pending
+        if event is not None:
+            event.synchronize()
+        for sample in host.numpy():
+            yield sample
+
+    def __call__(self, decode, samples, to_uint8=True):
+        '''
+        decode: the first stage decode, usually model.decode_first_stage
+        yields uint8 images, or floats in [0, 1] when to_uint8 is False
+        '''
+        n = self.batch_size(samples)
+        pending = None
+        i = 0
+        while i < len(samples):
+            try:
+                x = decode(samples[i:i + n])
+            except RuntimeError as e:
+                if 'out of memory' not in str(e) or n == 1:
+                    raise
+                n = max(1, n // 2)
+                self.fits = n
+                print(f'BatchedDecoder: out of memory, decoding {n} samples at once')
+                torch.cuda.empty_cache()
+                continue
+            current = self.to_host(x, to_uint8)
+            del x
+            # the next micro-batch is already queued on the device while this one is handed out
+            if pending is not None:
+                yield from self.finish(pending)
+            pending = current
+            i += n
+        if pending is not None:
+            yield from self.finish(pending)
@@ -6,23 +6,58 @@ from tqdm import tqdm
 from functools import partial
 
 from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
-    extract_into_tensor
+    extract_into_tensor, sampling_noise
+
+
+def step_coefficients(alphas, alphas_prev, sigmas):
+    '''
+    the constants of every ddim step as one (steps, 5, 1, 1, 1, 1) float32 table, row i holds
+    sqrt(a_t), sqrt(1 - a_t), sqrt(a_prev), sqrt(1 - a_prev - sigma_t^2) and sigma_t of step i;
+    indexing a row is a view, so a step needs no allocation or copy from the host
+    '''
+    a_t, a_prev, sigma_t = (torch.as_tensor(np.asarray(v.cpu() if torch.is_tensor(v) else v, dtype=np.float64))
+                            for v in (alphas, alphas_prev, sigmas))
+    table = torch.stack([a_t.sqrt(), (1. - a_t).sqrt(), a_prev.sqrt(), (1. - a_prev - sigma_t ** 2).sqrt(), sigma_t], 1)
+    return table.to(torch.float32).view(-1, 5, 1, 1, 1, 1)
+
+
+def ddim_step(x, e_t, coefficients, noise=None, quantize=None):
+    ''' one ddim update with a row of step_coefficients(), returns x_prev and pred_x0 '''
+    sqrt_a_t, sqrt_one_minus_at, sqrt_a_prev, dir_xt_scale, sigma_t = coefficients
+    # current prediction for x_0
+    pred_x0 = (x - sqrt_one_minus_at * e_t) / sqrt_a_t
+    if quantize is not None:
+        pred_x0 = quantize(pred_x0)
+    # direction pointing to x_t
+    x_prev = sqrt_a_prev * pred_x0 + dir_xt_scale * e_t
+    if noise is not None:
+        x_prev = x_prev + sigma_t * noise
+    return x_prev, pred_x0
 
 
 class DDIMSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    # replaced by a compiled version where torch.compile is available and asked for
+    step_fn = staticmethod(ddim_step)
+
+    def __init__(self, model, schedule="linear", schedules=None, **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # computed schedules by (steps, discretize, eta), may be shared between samplers of one model
+        self.schedules = {} if schedules is None else schedules
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.betas.device:
+                attr = attr.to(self.model.betas.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        key = (ddim_num_steps, ddim_discretize, ddim_eta)
+        if key in self.schedules:
+            self.__dict__.update(self.schedules[key])
+            return
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
@@ -53,6 +88,15 @@ class DDIMSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+        # everything a step needs, indexed on the device
+        self.ddim_eta = ddim_eta
+        self.register_buffer('ddim_coefficients', step_coefficients(ddim_alphas, ddim_alphas_prev, ddim_sigmas))
+        self.register_buffer('ddpm_coefficients', step_coefficients(self.alphas_cumprod, self.alphas_cumprod_prev,
+                                                                    sigmas_for_original_sampling_steps))
+        self.register_buffer('ddim_timestep_table', torch.from_numpy(np.asarray(self.ddim_timesteps, dtype=np.int64)))
+        self.register_buffer('ddpm_timestep_table', torch.arange(self.ddpm_num_timesteps))
+        self.schedules[key] = {k: v for k, v in self.__dict__.items() if k not in ('model', 'ddpm_num_timesteps', 'schedule', 'schedules')}
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -120,7 +164,7 @@ class DDIMSampler(object):
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = sampling_noise(shape, device)
         else:
             img = x_T
 
@@ -137,9 +181,10 @@ class DDIMSampler(object):
 
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
 
+        timestep_table = self.ddpm_timestep_table if ddim_use_original_steps else self.ddim_timestep_table
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
+            ts = timestep_table[index].expand(b)
 
             if mask is not None:
                 assert x0 is not None
@@ -166,8 +211,6 @@ class DDIMSampler(object):
     def p_sample_ddim(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None):
-        b, *_, device = *x.shape, x.device
-
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
             e_t = self.model.apply_model(x, t, c)
         else:
@@ -181,27 +224,16 @@ class DDIMSampler(object):
             assert self.model.parameterization == "eps"
             e_t = score_corrector.modify_score(self.model, e_t, x, t, c, **corrector_kwargs)
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
-
-        # current prediction for x_0
-        pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-        if quantize_denoised:
-            pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
-        # direction pointing to x_t
-        dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-        if noise_dropout > 0.:
-            noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-        x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-        return x_prev, pred_x0
+        coefficients = (self.ddpm_coefficients if use_original_steps else self.ddim_coefficients)[index]
+        noise = None
+        # with eta 0 sigma_t is 0 at every step and the noise would be thrown away
+        if self.ddim_eta != 0:
+            noise = noise_like(x.shape, x.device, repeat_noise) * temperature
+            if noise_dropout > 0.:
+                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
+        quantize = (lambda x0: self.model.first_stage_model.quantize(x0)[0]) if quantize_denoised else None
+        return self.step_fn(x, e_t, coefficients, noise, quantize)
 
     @torch.no_grad()
     def stochastic_encode(self, x0, t, use_original_steps=False, noise=None):
@@ -215,7 +247,7 @@ class DDIMSampler(object):
             sqrt_one_minus_alphas_cumprod = self.ddim_sqrt_one_minus_alphas
 
         if noise is None:
-            noise = torch.randn_like(x0)
+            noise = sampling_noise(x0.shape, x0.device).to(x0.dtype)
         return (extract_into_tensor(sqrt_alphas_cumprod, t, x0.shape) * x0 +
                 extract_into_tensor(sqrt_one_minus_alphas_cumprod, t, x0.shape) * noise)
 
@@ -232,9 +264,10 @@ class DDIMSampler(object):
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
+        timestep_table = self.ddpm_timestep_table if use_original_steps else self.ddim_timestep_table
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
+            ts = timestep_table[index].expand(x_latent.shape[0])
 
             if z_mask is not None and i < total_steps - 2:
                 assert x0 is not None
@@ -462,6 +462,9 @@ class LatentDiffusion(DDPM):
         self.cond_stage_forward = cond_stage_forward
         self.clip_denoised = False
         self.bbox_tokenizer = None  
+        # tiled first stage decoding, in latent pixels; None decodes in one pass
+        self.first_stage_tile = None
+        self.first_stage_tile_overlap = 16
 
         self.restarted_from_ckpt = False
         if ckpt_path is not None:
@@ -702,8 +705,38 @@ class LatentDiffusion(DDPM):
             out.append(xc)
         return out
 
+    def tile_starts(self, size, tile, stride):
+        starts = list(range(0, size - tile, stride)) + [size - tile]
+        return sorted(set(starts))
+
+    def decode_first_stage_tiled(self, z, tile, overlap, decode):
+        """
+        decodes overlapping latent tiles one at a time and blends them in pixel space,
+        so peak memory depends on the tile size and not on the image size
+        :param z: scaled latent of size (bs, c, h, w)
+        :param decode: first stage decode for a single tile
+        """
+        bs, nc, h, w = z.shape
+        ks = (min(tile, h), min(tile, w))
+        stride = (max(ks[0] - overlap, 1), max(ks[1] - overlap, 1))
+        uf = 2 ** self.num_downs
+        # same border falloff as the split_input_params patches, so tile seams fade out
+        weighting = self.delta_border(ks[0] * uf, ks[1] * uf).clip(0.01, 0.5).to(device=z.device, dtype=z.dtype)
+
+        decoded = None
+        normalization = torch.zeros((1, 1, h * uf, w * uf), device=z.device, dtype=z.dtype)
+        for y in self.tile_starts(h, ks[0], stride[0]):
+            for x in self.tile_starts(w, ks[1], stride[1]):
+                o = decode(z[:, :, y:y + ks[0], x:x + ks[1]])
+                if decoded is None:
+                    decoded = torch.zeros((bs, o.shape[1], h * uf, w * uf), device=o.device, dtype=o.dtype)
+                decoded[:, :, y * uf:(y + ks[0]) * uf, x * uf:(x + ks[1]) * uf] += o * weighting
+                normalization[:, :, y * uf:(y + ks[0]) * uf, x * uf:(x + ks[1]) * uf] += weighting
+                del o
+        return decoded / normalization
+
     @torch.no_grad()
-    def decode_first_stage(self, z, predict_cids=False, force_not_quantize=False):
+    def decode_first_stage(self, z, predict_cids=False, force_not_quantize=False, tile=None):
         if predict_cids:
             if z.dim() == 4:
                 z = torch.argmax(z.exp(), dim=1).long()
@@ -712,6 +745,14 @@ class LatentDiffusion(DDPM):
 
         z = 1. / self.scale_factor * z
 
+        tile = default(tile, self.first_stage_tile)
+        if tile and (z.shape[2] > tile or z.shape[3] > tile):
+            if isinstance(self.first_stage_model, VQModelInterface):
+                decode = partial(self.first_stage_model.decode, force_not_quantize=predict_cids or force_not_quantize)
+            else:
+                decode = self.first_stage_model.decode
+            return self.decode_first_stage_tiled(z, tile, self.first_stage_tile_overlap, decode)
+
         if hasattr(self, "split_input_params"):
             if self.split_input_params["patch_distributed_vq"]:
                 ks = self.split_input_params["ks"]  # eg. (128, 128)
@@ -5,23 +5,34 @@ import numpy as np
 from tqdm import tqdm
 from functools import partial
 
-from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
+from ldm.modules.diffusionmodules.util import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like, \
+    sampling_noise
+from ldm.models.diffusion.ddim import step_coefficients, ddim_step
 
 
 class PLMSSampler(object):
-    def __init__(self, model, schedule="linear", **kwargs):
+    # replaced by a compiled version where torch.compile is available and asked for
+    step_fn = staticmethod(ddim_step)
+
+    def __init__(self, model, schedule="linear", schedules=None, **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        # computed schedules by (steps, discretize, eta), may be shared between samplers of one model
+        self.schedules = {} if schedules is None else schedules
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.model.betas.device:
+                attr = attr.to(self.model.betas.device)
         setattr(self, name, attr)
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        key = (ddim_num_steps, ddim_discretize, ddim_eta)
+        if key in self.schedules:
+            self.__dict__.update(self.schedules[key])
+            return
         if ddim_eta != 0:
             raise ValueError('ddim_eta must be 0 for PLMS')
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
@@ -54,6 +65,14 @@ class PLMSSampler(object):
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
 
+        # everything a step needs, indexed on the device
+        self.register_buffer('ddim_coefficients', step_coefficients(ddim_alphas, ddim_alphas_prev, ddim_sigmas))
+        self.register_buffer('ddpm_coefficients', step_coefficients(self.alphas_cumprod, self.alphas_cumprod_prev,
+                                                                    sigmas_for_original_sampling_steps))
+        self.register_buffer('ddim_timestep_table', torch.from_numpy(np.asarray(self.ddim_timesteps, dtype=np.int64)))
+        self.register_buffer('ddpm_timestep_table', torch.arange(self.ddpm_num_timesteps))
+        self.schedules[key] = {k: v for k, v in self.__dict__.items() if k not in ('model', 'ddpm_num_timesteps', 'schedule', 'schedules')}
+
     @torch.no_grad()
     def sample(self,
                S,
@@ -121,7 +140,7 @@ class PLMSSampler(object):
         device = self.model.betas.device
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = sampling_noise(shape, device)
         else:
             img = x_T
 
@@ -139,10 +158,11 @@ class PLMSSampler(object):
         iterator = tqdm(time_range, desc='PLMS Sampler', total=total_steps)
         old_eps = []
 
+        timestep_table = self.ddpm_timestep_table if ddim_use_original_steps else self.ddim_timestep_table
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
-            ts = torch.full((b,), step, device=device, dtype=torch.long)
-            ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
+            ts = timestep_table[index].expand(b)
+            ts_next = timestep_table[max(index - 1, 0)].expand(b)
 
             if mask is not None:
                 assert x0 is not None
@@ -173,8 +193,6 @@ class PLMSSampler(object):
     def p_sample_plms(self, x, c, t, index, repeat_noise=False, use_original_steps=False, quantize_denoised=False,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None, old_eps=None, t_next=None):
-        b, *_, device = *x.shape, x.device
-
         def get_model_output(x, t):
             if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
                 e_t = self.model.apply_model(x, t, c)
@@ -191,29 +209,13 @@ class PLMSSampler(object):
 
             return e_t
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = self.model.alphas_cumprod_prev if use_original_steps else self.ddim_alphas_prev
-        sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod if use_original_steps else self.ddim_sqrt_one_minus_alphas
-        sigmas = self.model.ddim_sigmas_for_original_num_steps if use_original_steps else self.ddim_sigmas
+        coefficients = self.ddpm_coefficients if use_original_steps else self.ddim_coefficients
+        quantize = (lambda x0: self.model.first_stage_model.quantize(x0)[0]) if quantize_denoised else None
 
         def get_x_prev_and_pred_x0(e_t, index):
-            # select parameters corresponding to the currently considered timestep
-            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-            sqrt_one_minus_at = torch.full((b, 1, 1, 1), sqrt_one_minus_alphas[index],device=device)
-
-            # current prediction for x_0
-            pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
-            if quantize_denoised:
-                pred_x0, _, *_ = self.model.first_stage_model.quantize(pred_x0)
-            # direction pointing to x_t
-            dir_xt = (1. - a_prev - sigma_t**2).sqrt() * e_t
-            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
-            if noise_dropout > 0.:
-                noise = torch.nn.functional.dropout(noise, p=noise_dropout)
-            x_prev = a_prev.sqrt() * pred_x0 + dir_xt + noise
-            return x_prev, pred_x0
+            # select parameters corresponding to the currently considered timestep;
+            # eta is always 0 for plms, so sigma_t is too and no noise is added
+            return self.step_fn(x, e_t, coefficients[index], None, quantize)
 
         e_t = get_model_output(x, t)
         if len(old_eps) == 0:
@@ -1,3 +1,4 @@
+from functools import partial
 from inspect import isfunction
 import math
 import torch
@@ -151,6 +152,163 @@ class SpatialSelfAttention(nn.Module):
         return x+h_
 
 
+# attention backends
+# every backend takes q (b*h, i, d), k and v (b*h, j, d) and the softmax scale, and returns (b*h, i, d)
+ATTENTION_BACKENDS = {}
+ATTENTION_CHUNK_BYTES = 2**28 # memory for one chunk of attention scores in the chunked backend
+attention_backend = None
+
+
+def register_attention_backend(name, available=lambda: True):
+    def register(fn):
+        ATTENTION_BACKENDS[name] = (fn, available)
+        return fn
+    return register
+
+
+@register_attention_backend('sdpa', lambda: hasattr(F, 'scaled_dot_product_attention'))
+def attention_sdpa(q, k, v, scale):
+    if scale != q.shape[-1] ** -0.5:
+        q = q * (scale * q.shape[-1] ** 0.5)
+    return F.scaled_dot_product_attention(q, k, v)
+
+
+@register_attention_backend('chunked')
+def attention_chunked(q, k, v, scale):
+    # memory-efficient attention: queries in slices, keys in chunks with an online softmax,
+    # so the full (b*h, i, j) score matrix is never materialized
+    r1 = torch.empty(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    k_chunk = min(k.shape[1], 4096)
+    q_chunk = max(1, min(q.shape[1], ATTENTION_CHUNK_BYTES // (q.shape[0] * k_chunk * 4)))
+    for i in range(0, q.shape[1], q_chunk):
+        qi = q[:, i:i + q_chunk]
+        if k_chunk == k.shape[1]:
+            s1 = einsum('b i d, b j d -> b i j', qi, k) * scale
+            s2 = s1.softmax(dim=-1, dtype=q.dtype)
+            del s1
+            r1[:, i:i + q_chunk] = einsum('b i j, b j d -> b i d', s2, v)
+            del s2
+            continue
+        acc = torch.zeros(qi.shape[0], qi.shape[1], v.shape[2], device=q.device, dtype=torch.float32)
+        s_max = torch.full((qi.shape[0], qi.shape[1], 1), -float('inf'), device=q.device, dtype=torch.float32)
+        s_sum = torch.zeros_like(s_max)
+        for j in range(0, k.shape[1], k_chunk):
+            s1 = einsum('b i d, b j d -> b i j', qi, k[:, j:j + k_chunk]).float() * scale
+            new_max = torch.maximum(s_max, s1.amax(dim=-1, keepdim=True))
+            s2 = torch.exp(s1 - new_max)
+            del s1
+            correction = torch.exp(s_max - new_max)
+            s_sum = s_sum * correction + s2.sum(dim=-1, keepdim=True)
+            acc = acc * correction + einsum('b i j, b j d -> b i d', s2.to(v.dtype), v[:, j:j + k_chunk]).float()
+            s_max = new_max
+            del s2
+        r1[:, i:i + q_chunk] = (acc / s_sum).to(q.dtype)
+    return r1
+
+
+@register_attention_backend('compvis')
+def attention_compvis(q, k, v, scale):
+    s1 = einsum('b i d, b j d -> b i j', q, k) * scale # faster
+    s2 = s1.softmax(dim=-1, dtype=q.dtype)
+    del s1
+    r1 = einsum('b i j, b j d -> b i d', s2, v)
+    del s2
+    return r1
+
+
+def attention_einsum_mps_v1(q, k, v, scale):
+    if q.shape[1] <= 4096: # (512x512) max q.shape[1]: 4096
+        return attention_compvis(q, k, v, scale)
+    r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    slice_size = math.floor(2**30 / (q.shape[0] * q.shape[1]))
+    for i in range(0, q.shape[1], slice_size):
+        end = i + slice_size
+        s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * scale
+        s2 = s1.softmax(dim=-1, dtype=r1.dtype)
+        del s1
+        r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
+        del s2
+    return r1
+
+
+def attention_einsum_mps_v2(q, k, v, scale, mem_total=0):
+    if mem_total >= 8 and q.shape[1] <= 4096:
+        return attention_compvis(q, k, v, scale)
+    r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    slice_size = 1
+    for i in range(0, q.shape[0], slice_size):
+        end = min(q.shape[0], i + slice_size)
+        s1 = einsum('b i d, b j d -> b i j', q[i:end], k[i:end])
+        s1 *= scale
+        s2 = s1.softmax(dim=-1, dtype=r1.dtype)
+        del s1
+        r1[i:end] = einsum('b i j, b j d -> b i d', s2, v[i:end])
+        del s2
+    return r1
+
+
+@register_attention_backend('einsum')
+def attention_einsum_cuda(q, k, v, scale):
+    # the original sliced einsum; picks the slice count from the allocator state on every call
+    stats = torch.cuda.memory_stats(q.device)
+    mem_active = stats['active_bytes.all.current']
+    mem_reserved = stats['reserved_bytes.all.current']
+    mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
+    mem_free_torch = mem_reserved - mem_active
+    mem_free_total = mem_free_cuda + mem_free_torch
+
+    gb = 1024 ** 3
+    tensor_size = q.shape[0] * q.shape[1] * k.shape[1] * 4
+    mem_required = tensor_size * 2.5
+    steps = 1
+
+    if mem_required > mem_free_total:
+        steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
+
+    if steps > 64:
+        max_res = math.floor(math.sqrt(math.sqrt(mem_free_total / 2.5)) / 8) * 64
+        raise RuntimeError(f'Not enough memory, use lower resolution (max approx. {max_res}x{max_res}). '
+                        f'Need: {mem_required/64/gb:0.1f}GB free, Have:{mem_free_total/gb:0.1f}GB free')
+
+    r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
+    slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]
+    for i in range(0, q.shape[1], slice_size):
+        end = min(q.shape[1], i + slice_size)
+        s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * scale
+        s2 = s1.softmax(dim=-1, dtype=r1.dtype)
+        del s1
+        r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
+        del s2
+    return r1
+
+
+def resolve_attention_backend(name='auto'):
+    if name == 'auto':
+        name = 'sdpa' if ATTENTION_BACKENDS['sdpa'][1]() else 'chunked'
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(f'unknown attention backend {name}, choose from {", ".join(ATTENTION_BACKENDS)} or auto')
+    fn, available = ATTENTION_BACKENDS[name]
+    if not available():
+        print(f'attention backend {name} is not available in torch {torch.__version__}, using chunked')
+        name, fn = 'chunked', ATTENTION_BACKENDS['chunked'][0]
+    if name == 'einsum' and not torch.cuda.is_available():
+        mem_total = psutil.virtual_memory().total / (1024**3)
+        fn = attention_einsum_mps_v1 if mem_total >= 32 else partial(attention_einsum_mps_v2, mem_total=mem_total)
+    return name, fn
+
+
+def set_attention_backend(name='auto', model=None):
+    ''' chooses the attention backend once; models created afterwards use it, and a given model is switched in place '''
+    global attention_backend
+    attention_backend = resolve_attention_backend(name)
+    print(f'Using attention backend: {attention_backend[0]}')
+    if model is not None:
+        for module in model.modules():
+            if isinstance(module, CrossAttention):
+                module.attention_op = attention_backend[1]
+    return attention_backend[0]
+
+
 class CrossAttention(nn.Module):
     def __init__(self, query_dim, context_dim=None, heads=8, dim_head=64, dropout=0.):
         super().__init__()
@@ -169,79 +327,9 @@ class CrossAttention(nn.Module):
             nn.Dropout(dropout)
         )
 
-        if torch.cuda.is_available():
-            self.einsum_op = self.einsum_op_cuda
-        else:
-            self.mem_total = psutil.virtual_memory().total / (1024**3)
-            self.einsum_op = self.einsum_op_mps_v1 if self.mem_total >= 32 else self.einsum_op_mps_v2
-    
-    def einsum_op_compvis(self, q, k, v, r1):
-        s1 = einsum('b i d, b j d -> b i j', q, k) * self.scale # faster
-        s2 = s1.softmax(dim=-1, dtype=q.dtype)
-        del s1
-        r1 = einsum('b i j, b j d -> b i d', s2, v)
-        del s2
-        return r1
-
-    def einsum_op_mps_v1(self, q, k, v, r1):
-        if q.shape[1] <= 4096: # (512x512) max q.shape[1]: 4096
-            r1 = self.einsum_op_compvis(q, k, v, r1)
-        else:
-            slice_size = math.floor(2**30 / (q.shape[0] * q.shape[1]))
-            for i in range(0, q.shape[1], slice_size):
-                end = i + slice_size
-                s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * self.scale
-                s2 = s1.softmax(dim=-1, dtype=r1.dtype)
-                del s1  
-                r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
-                del s2
-        return r1
-
-    def einsum_op_mps_v2(self, q, k, v, r1):
-        if self.mem_total >= 8 and q.shape[1] <= 4096:
-                r1 = self.einsum_op_compvis(q, k, v, r1)
-        else:
-            slice_size = 1
-            for i in range(0, q.shape[0], slice_size):
-                end = min(q.shape[0], i + slice_size)
-                s1 = einsum('b i d, b j d -> b i j', q[i:end], k[i:end])
-                s1 *= self.scale
-                s2 = s1.softmax(dim=-1, dtype=r1.dtype)
-                del s1
-                r1[i:end] = einsum('b i j, b j d -> b i d', s2, v[i:end])
-                del s2
-        return r1
-
-    def einsum_op_cuda(self, q, k, v, r1):
-        stats = torch.cuda.memory_stats(q.device)
-        mem_active = stats['active_bytes.all.current']
-        mem_reserved = stats['reserved_bytes.all.current']
-        mem_free_cuda, _ = torch.cuda.mem_get_info(torch.cuda.current_device())
-        mem_free_torch = mem_reserved - mem_active
-        mem_free_total = mem_free_cuda + mem_free_torch
-
-        gb = 1024 ** 3
-        tensor_size = q.shape[0] * q.shape[1] * k.shape[1] * 4
-        mem_required = tensor_size * 2.5
-        steps = 1
-
-        if mem_required > mem_free_total:
-            steps = 2**(math.ceil(math.log(mem_required / mem_free_total, 2)))
-
-        if steps > 64:
-            max_res = math.floor(math.sqrt(math.sqrt(mem_free_total / 2.5)) / 8) * 64
-            raise RuntimeError(f'Not enough memory, use lower resolution (max approx. {max_res}x{max_res}). '
-                            f'Need: {mem_required/64/gb:0.1f}GB free, Have:{mem_free_total/gb:0.1f}GB free')
-
-        slice_size = q.shape[1] // steps if (q.shape[1] % steps) == 0 else q.shape[1]  
-        for i in range(0, q.shape[1], slice_size):
-            end = min(q.shape[1], i + slice_size)
-            s1 = einsum('b i d, b j d -> b i j', q[:, i:end], k) * self.scale
-            s2 = s1.softmax(dim=-1, dtype=r1.dtype)
-            del s1
-            r1[:, i:end] = einsum('b i j, b j d -> b i d', s2, v)
-            del s2 
-        return r1
+        if attention_backend is None:
+            set_attention_backend()
+        self.attention_op = attention_backend[1]
 
     def forward(self, x, context=None, mask=None):
         h = self.heads
@@ -255,8 +343,7 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
-        r1 = torch.zeros(q.shape[0], q.shape[1], v.shape[2], device=q.device, dtype=q.dtype)
-        r1 = self.einsum_op(q, k, v, r1)
+        r1 = self.attention_op(q, k, v, self.scale)
         del q, k, v
         r2 = rearrange(r1, '(b h) n d -> b n (h d)', h=h)
         del r1
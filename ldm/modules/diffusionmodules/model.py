@@ -7,7 +7,7 @@ import numpy as np
 from einops import rearrange
 
 from ldm.util import instantiate_from_config
-from ldm.modules.attention import LinearAttention
+from ldm.modules.attention import LinearAttention, attention_chunked
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -161,9 +161,11 @@ class LinAttnBlock(LinearAttention):
 
 
 class AttnBlock(nn.Module):
-    def __init__(self, in_channels):
+    def __init__(self, in_channels, sliced=False):
         super().__init__()
         self.in_channels = in_channels
+        # sliced attention never builds the full (h*w)x(h*w) matrix and needs no allocator queries
+        self.sliced = sliced
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -189,6 +191,9 @@ class AttnBlock(nn.Module):
 
 
     def forward(self, x):
+        if self.sliced:
+            return self.forward_sliced(x)
+
         h_ = x
         h_ = self.norm(h_)
         q1 = self.q(h_)
@@ -251,12 +256,28 @@ class AttnBlock(nn.Module):
 
         return h3
 
+    def forward_sliced(self, x):
+        h_ = self.norm(x)
+        b, c, h, w = h_.shape
+        q = rearrange(self.q(h_), 'b c h w -> b (h w) c')
+        k = rearrange(self.k(h_), 'b c h w -> b (h w) c')
+        v = rearrange(self.v(h_), 'b c h w -> b (h w) c')
+        del h_
+
+        h_ = attention_chunked(q, k, v, int(c)**(-0.5))
+        del q, k, v
+        h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h, w=w)
+
+        return x + self.proj_out(h_)
+
 
 def make_attn(in_channels, attn_type="vanilla"):
-    assert attn_type in ["vanilla", "linear", "none"], f'attn_type {attn_type} unknown'
+    assert attn_type in ["vanilla", "sliced", "linear", "none"], f'attn_type {attn_type} unknown'
     print(f"making attention of type '{attn_type}' with {in_channels} in_channels")
     if attn_type == "vanilla":
         return AttnBlock(in_channels)
+    elif attn_type == "sliced":
+        return AttnBlock(in_channels, sliced=True)
     elif attn_type == "none":
         return nn.Identity(in_channels)
     else:
@@ -10,6 +10,7 @@
 
 import os
 import math
+from contextvars import ContextVar
 import torch
 import torch.nn as nn
 import numpy as np
@@ -262,7 +263,19 @@ class HybridConditioner(nn.Module):
         return {'c_concat': [c_concat], 'c_crossattn': [c_crossattn]}
 
 
+# the torch.Generator the sampling noise of the current job is drawn from, None draws from the
+# global rng; a context variable, so jobs running in other threads each have their own
+sampling_generator = ContextVar('sampling_generator', default=None)
+
+
+def sampling_noise(shape, device):
+    g = sampling_generator.get()
+    if g is None:
+        return torch.randn(shape, device=device)
+    return torch.randn(shape, generator=g, device=g.device).to(device)
+
+
 def noise_like(shape, device, repeat=False):
-    repeat_noise = lambda: torch.randn((1, *shape[1:]), device=device).repeat(shape[0], *((1,) * (len(shape) - 1)))
-    noise = lambda: torch.randn(shape, device=device)
+    repeat_noise = lambda: sampling_noise((1, *shape[1:]), device).repeat(shape[0], *((1,) * (len(shape) - 1)))
+    noise = lambda: sampling_noise(shape, device)
     return repeat_noise() if repeat else noise()
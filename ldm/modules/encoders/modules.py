@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 from functools import partial
 import clip
 from einops import rearrange, repeat
@@ -135,13 +136,20 @@ class SpatialRescaler(nn.Module):
         return self(x)
 
 class FrozenCLIPEmbedder(AbstractEncoder):
-    """Uses the CLIP transformer encoder for text (from Hugging Face)"""
-    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):
+    """Uses the CLIP transformer encoder for text (from Hugging Face)
+
+    Inference results are kept in a per-model LRU cache keyed by text, so repeated
+    prompts (loopback, tiling, animation, the empty uncond prompt) are encoded once.
+    cache_mb bounds the memory of the cached tensors, 0 disables the cache. The
+    empty prompt is pinned and never evicted."""
+    def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77, cache_mb=64):
         super().__init__()
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version)
         self.device = device
         self.max_length = max_length
+        self.cache_mb = cache_mb
+        self.clear_cache()
         self.freeze()
 
     def freeze(self):
@@ -149,7 +157,18 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         for param in self.parameters():
             param.requires_grad = False
 
-    def forward(self, text):
+    def clear_cache(self):
+        self.cache = OrderedDict()
+        self.pinned = dict()
+        self.cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'entries': len(self.cache) + len(self.pinned),
+                'mb': self.cache_bytes / 2**20, 'max_mb': self.cache_mb}
+
+    def encode_text(self, text):
         batch_encoding = self.tokenizer(text, truncation=True, max_length=self.max_length, return_length=True,
                                         return_overflowing_tokens=False, padding="max_length", return_tensors="pt")
         tokens = batch_encoding["input_ids"].to(self.device)
@@ -158,6 +177,54 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         z = outputs.last_hidden_state
         return z
 
+    def cache_key(self, text):
+        # the same text encodes differently once the model moved, changed dtype or runs under autocast
+        return (text, self.max_length, str(self.device), self.transformer.dtype, torch.is_autocast_enabled())
+
+    def cache_get(self, key):
+        if key in self.pinned:
+            return self.pinned[key]
+        z = self.cache.get(key)
+        if z is not None:
+            self.cache.move_to_end(key)
+        return z
+
+    def cache_put(self, key, z):
+        size = z.element_size() * z.nelement()
+        if key[0] == "":
+            self.pinned[key] = z
+        else:
+            self.cache[key] = z
+        self.cache_bytes += size
+        limit = self.cache_mb * 2**20
+        while self.cache and self.cache_bytes > limit:
+            _, old = self.cache.popitem(last=False)
+            self.cache_bytes -= old.element_size() * old.nelement()
+
+    def forward(self, text):
+        if self.cache_mb <= 0 or torch.is_grad_enabled():
+            return self.encode_text(text)
+        if isinstance(text, str):
+            text = [text]
+
+        keys = [self.cache_key(t) for t in text]
+        found = {}
+        for key in keys:
+            if key not in found:
+                found[key] = self.cache_get(key)
+        missing = [key for key, z in found.items() if z is None]
+        self.cache_hits += len(keys) - len(missing)
+        self.cache_misses += len(missing)
+
+        if missing:
+            # encode all unseen texts in one pass
+            z = self.encode_text([key[0] for key in missing])
+            for i, key in enumerate(missing):
+                found[key] = z[i].clone()
+                self.cache_put(key, found[key])
+
+        return torch.stack([found[key] for key in keys])
+
     def encode(self, text):
         return self(text)
 
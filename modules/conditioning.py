@@ -0,0 +1,32 @@
+import torch
+
+
+def get_conditioning(model, prompts, split_prompt):
+    '''
+    conditioning with one prompt per row; every distinct (sub)prompt is encoded once, in a single call.
+    split_prompt(prompt) gives the [(text, weight), ...] of a weighted prompt, the weights already normalized if wanted
+    '''
+    parsed = {}
+    index = {}
+    for prompt in prompts:
+        if prompt in parsed:
+            continue
+        weighted_subprompts = split_prompt(prompt)
+        # sub-prompt weighting used if more than 1, otherwise just behave like usual
+        parsed[prompt] = weighted_subprompts if len(weighted_subprompts) > 1 else None
+        for text, weight in (parsed[prompt] or [(prompt, None)]):
+            index.setdefault(text, len(index))
+
+    embeddings = model.get_learned_conditioning(list(index))
+
+    c = []
+    for prompt in prompts:
+        if parsed[prompt] is None:
+            c.append(embeddings[index[prompt]])
+            continue
+        row = torch.zeros_like(embeddings[0])
+        for text, weight in parsed[prompt]:
+            # note if alpha negative, it functions same as torch.sub
+            row = torch.add(row, embeddings[index[text]], alpha=weight)
+        c.append(row)
+    return torch.stack(c)
@@ -0,0 +1,62 @@
+import math
+
+import numpy as np
+
+
+def tile_positions(size, tile, overlap):
+    ''' starts of the tiles along one side, same layout as the old split_grid: the last tile ends at the border '''
+    if size <= tile:
+        return [0]
+    count = math.ceil((size - overlap) / (tile - overlap))
+    return sorted(set(min(i * (tile - overlap), size - tile) for i in range(count)))
+
+
+def split_tiles(image, tile_w, tile_h, overlap):
+    ''' cuts an hwc image into overlapping tiles, returns them stacked with their (y, x) positions '''
+    h, w = image.shape[:2]
+    tile_h, tile_w = min(tile_h, h), min(tile_w, w)
+    positions = [(y, x) for y in tile_positions(h, tile_h, overlap) for x in tile_positions(w, tile_w, overlap)]
+    tiles = np.stack([image[y:y + tile_h, x:x + tile_w] for y, x in positions])
+    return tiles, positions
+
+
+def tile_weights(tile_h, tile_w, overlap):
+    ''' linear ramps over the overlap on every side of a tile, never zero so a lone tile keeps its pixels '''
+    def ramp(size):
+        i = np.arange(size, dtype=np.float32)
+        return np.minimum(np.minimum(i + 1, size - i) / (overlap + 1), 1.0)
+    return ramp(tile_h)[:, None] * ramp(tile_w)[None, :]
+
+
+def blend_tiles(tiles, positions, h, w, overlap):
+    ''' puts tiles of size (n, tile_h, tile_w, c) back together, overlaps are weighted averages '''
+    n, tile_h, tile_w, c = tiles.shape
+    weight = tile_weights(tile_h, tile_w, overlap)
+    out = np.zeros((h, w, c), dtype=np.float32)
+    norm = np.zeros((h, w, 1), dtype=np.float32)
+    for tile, (y, x) in zip(tiles, positions):
+        out[y:y + tile_h, x:x + tile_w] += tile * weight[:, :, None]
+        norm[y:y + tile_h, x:x + tile_w] += weight[:, :, None]
+    return out / norm
+
+
+def gobig(image, tile_w, tile_h, overlap, batch_size, encode, sample, decode):
+    '''
+    img2img over overlapping tiles of a large image, batch_size tiles per sampler call.
+    image: hwc uint8 array
+    encode: uint8 tiles (n, h, w, c) to latents
+    sample: latents of a batch of tiles to denoised latents
+    decode: latents to an iterable of hwc float images in [0, 1]
+    returns the blended image as hwc uint8
+    '''
+    h, w = image.shape[:2]
+    tiles, positions = split_tiles(image, tile_w, tile_h, overlap)
+    batch_count = math.ceil(len(tiles) / batch_size)
+    print(f"GoBig upscaling will process a total of {len(tiles)} tiles in a total of {batch_count} batches.")
+
+    results = []
+    for i in range(batch_count):
+        latents = encode(tiles[i * batch_size:(i + 1) * batch_size])
+        results.extend(decode(sample(latents)))
+    combined = blend_tiles(np.stack(results), positions, h, w, overlap)
+    return (np.clip(combined, 0, 1) * 255).astype(np.uint8)
@@ -0,0 +1,45 @@
+import math
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+def get_font(fontsize):
+    fonts = ["arial.ttf", "DejaVuSans.ttf"]
+    for font_name in fonts:
+        try:
+            return ImageFont.truetype(font_name, fontsize)
+        except OSError:
+           pass
+
+    # ImageFont.load_default() is practically unusable as it only supports
+    # latin1, so raise an exception instead if no usable font was found
+    raise Exception(f"No usable font found (tried {', '.join(fonts)})")
+
+def image_grid(imgs, batch_size, force_n_rows=None, captions=None, n_rows=-1):
+    ''' imgs pasted into one image, n_rows rows; 0 makes it batch_size rows, -1 about square '''
+    if force_n_rows is not None:
+        rows = force_n_rows
+    elif n_rows > 0:
+        rows = n_rows
+    elif n_rows == 0:
+        rows = batch_size
+    else:
+        rows = math.sqrt(len(imgs))
+        rows = round(rows)
+
+    cols = math.ceil(len(imgs) / rows)
+
+    w, h = imgs[0].size
+    grid = Image.new('RGB', size=(cols * w, rows * h), color='black')
+
+    # the font is only loaded for captions, a grid without them needs no font installed
+    fnt = get_font(30) if captions else None
+
+    for i, img in enumerate(imgs):
+        grid.paste(img, box=(i % cols * w, i // cols * h))
+        if captions and i<len(captions):
+            d = ImageDraw.Draw( grid )
+            size = d.textbbox( (0,0), captions[i], font=fnt, stroke_width=2, align="center" )
+            d.multiline_text((i % cols * w + w/2, i // cols * h + h - size[3]), captions[i], font=fnt, fill=(255,255,255), stroke_width=2, stroke_fill=(0,0,0), anchor="mm", align="center")
+
+    return grid
@@ -0,0 +1,100 @@
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+from io import BytesIO
+
+
+class ImageWriter():
+    """
+    Background stage that encodes images and writes them to disk.
+
+    Callers hand over finished images with their target path and go on with the
+    next batch; a small thread pool does the encoding and the file I/O. At most
+    max_pending jobs are queued or running, submit() blocks beyond that, so a slow
+    disk throttles the producer instead of piling images up in memory.
+
+    Paths that are queued but not written yet are reported by pending_files(), so
+    sequence numbering that looks at a directory still sees them.
+    """
+    def __init__(self, workers=2, max_pending=16):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image_writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.futures = set()
+
+    def pending_files(self, path):
+        with self.lock:
+            return list(self.pending.get(os.path.abspath(path), ()))
+
+    def _track(self, paths, add):
+        with self.lock:
+            for p in paths:
+                directory, name = os.path.split(os.path.abspath(p))
+                names = self.pending.setdefault(directory, [])
+                if add:
+                    names.append(name)
+                else:
+                    names.remove(name)
+                    if not names:
+                        del self.pending[directory]
+
+    def _run(self, fn, args, kwargs, paths):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            print(f'image_writer: {fn.__name__} has error:')
+            print(traceback.format_exc())
+            raise
+        finally:
+            self._track(paths, False)
+            self.slots.release()
+
+    def submit(self, fn, *args, paths=(), **kwargs):
+        ''' runs fn(*args, **kwargs) on the writer pool; paths are the files it is going to create '''
+        self.slots.acquire()
+        self._track(paths, True)
+        try:
+            future = self.executor.submit(self._run, fn, args, kwargs, paths)
+        except Exception:
+            self._track(paths, False)
+            self.slots.release()
+            raise
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def save(self, image, path, *args, **kwargs):
+        ''' image.save(path, *args, **kwargs) in the background '''
+        return self.submit(image.save, path, *args, paths=[path], **kwargs)
+
+    def flush(self):
+        ''' waits until everything submitted so far is on disk '''
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+
+    def close(self):
+        ''' writes what is still queued and stops the pool, submit() fails afterwards '''
+        self.executor.shutdown(wait=True)
+
+
+def save_sized(image, path, limit, formats=(('PNG', '.png'), ('JPEG', '.jpg'))):
+    '''
+    encodes image once in the first format and writes it to path plus extension, unless the
+    result is limit bytes or larger, then it falls back to the next format; returns the extension
+    '''
+    for i, (image_format, ext) in enumerate(formats):
+        fileio = BytesIO()
+        image.save(fileio, image_format)
+        if fileio.tell() < limit or i == len(formats) - 1:
+            break
+    with open(path + ext, 'wb') as f:
+        f.write(fileio.getbuffer())
+    return ext
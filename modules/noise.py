@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+
+import torch
+
+from ldm.modules.diffusionmodules.util import sampling_generator, sampling_noise
+
+
+def generator(seed, device):
+    g = torch.Generator(device=device)
+    g.manual_seed(seed)
+    return g
+
+
+def create_random_tensors(shape, seeds, device, cpu=False):
+    '''
+    noise of size shape for every seed, stacked into one batch. Each sample is drawn from its
+    own generator, so the global rng is left alone and a seed gives the same noise in any batch;
+    on the device that is the same noise the old manual_seed + randn loop gave.
+    cpu draws on the cpu and moves the batch, so a seed gives the same noise on every device.
+    '''
+    device = torch.device(device)
+    noise_device = torch.device('cpu') if cpu else device
+    x = torch.empty([len(seeds)] + list(shape), device=noise_device)
+    for i, seed in enumerate(seeds):
+        # randn is normal_ on a fresh tensor, drawing into the batch saves the stack
+        x[i].normal_(generator=generator(seed, noise_device))
+    return x.to(device)
+
+
+@contextmanager
+def seeded_rng(seed, shape, device, cpu=False):
+    '''
+    runs the body with a generator for the sampling noise of this job, in the state the old
+    create_random_tensors left the global rng in after drawing the noise for seed. Ancestral
+    samplers and ddim with eta draw their step noise from it, so seeds keep their images, and
+    concurrent jobs neither reseed nor draw from each other's rng.
+    cpu draws the step noise on the cpu, like create_random_tensors does the initial noise.
+    '''
+    noise_device = torch.device('cpu') if cpu else torch.device(device)
+    g = generator(seed, noise_device)
+    torch.randn(shape, generator=g, device=noise_device)
+    token = sampling_generator.set(g)
+    try:
+        yield g
+    finally:
+        sampling_generator.reset(token)
+
+
+def slerp(t, v0, v1, DOT_THRESHOLD=0.9995):
+    '''
+    spherical interpolation from noise batch v0 to v1, per sample and on their device;
+    a v0 of one sample is interpolated against every sample of v1. t is a float or a tensor
+    of fractions shaped (n, 1, ...), which walks a single v0 and v1 through n steps at once.
+    '''
+    dims = tuple(range(1, v1.dim()))
+    t = torch.as_tensor(t, dtype=v1.dtype, device=v1.device)
+    v0 = v0.expand_as(v1)
+    dot = (v0 * v1).sum(dims, keepdim=True) / (v0.norm(dim=dims, keepdim=True) * v1.norm(dim=dims, keepdim=True))
+    theta_0 = torch.arccos(dot.clamp(-1, 1))
+    sin_theta_0 = torch.sin(theta_0)
+    theta_t = theta_0 * t
+    s0 = torch.sin(theta_0 - theta_t) / sin_theta_0
+    s1 = torch.sin(theta_t) / sin_theta_0
+    # nearly parallel samples are interpolated linearly
+    linear = dot.abs() > DOT_THRESHOLD
+    s0 = torch.where(linear, 1 - t, s0)
+    s1 = torch.where(linear, t, s1)
+    return s0 * v0 + s1 * v1
@@ -0,0 +1,166 @@
+import numpy as np
+import torch
+
+
+def ramp(size, overlap):
+    ''' blend weights along one tile edge: rising over the overlap at both ends, never zero '''
+    i = torch.arange(size, dtype=torch.float32)
+    w = torch.minimum((i + 1) / (overlap + 1), (size - i) / (overlap + 1))
+    return w.clamp(max=1.0)
+
+
+def tile_starts(size, tile, stride):
+    starts = list(range(0, size - tile, stride)) + [size - tile]
+    return sorted(set(starts))
+
+
+def by_shape(images):
+    ''' indices of images grouped by shape, so every group stacks into one tensor '''
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(image.shape, []).append(i)
+    return groups.values()
+
+
+class PostProcessor():
+    """
+    Face restoration and upscaling for whole batches of images.
+
+    Images are hwc uint8 RGB numpy arrays, as they come out of the first stage decoder.
+    Upscaling stacks up to max_batch images of the same size into one tensor, cuts it into
+    overlapping tiles and runs the tiles of those images through the network together,
+    max_batch at a time; the tiles are blended on the device with linear ramps over the
+    overlap and converted to uint8, and the chunk is copied to the host before the next
+    one starts, so device memory does not grow with the number of images. Face
+    restoration detects and aligns faces per image, which facexlib only does on the
+    host, and restores all faces of all images in batched GFPGAN calls.
+
+    Micro-batches are halved on out of memory errors and the smaller size is kept.
+    """
+    def __init__(self, tile=512, tile_overlap=32, max_batch=8):
+        # tile is in input pixels, 0 upscales every image in one piece
+        self.tile = tile
+        self.tile_overlap = tile_overlap
+        self.max_batch = max_batch
+
+    def run_batched(self, fn, x):
+        ''' fn over x in micro-batches '''
+        out = []
+        i = 0
+        while i < len(x):
+            n = self.max_batch
+            try:
+                out.append(fn(x[i:i + n]))
+            except RuntimeError as e:
+                if 'out of memory' not in str(e) or n == 1:
+                    raise
+                self.max_batch = max(1, n // 2)
+                print(f'PostProcessor: out of memory, running {self.max_batch} tiles at once')
+                torch.cuda.empty_cache()
+                continue
+            i += n
+        return torch.cat(out)
+
+    def upscale_tensor(self, model, x):
+        '''
+        runs model over a float batch x of size (n, c, h, w) in overlapping tiles and
+        returns the blended output, still on the device
+        '''
+        n, c, h, w = x.shape
+        # the 2x RRDBNet unshuffles pixels and wants even sizes, reflect pad up to a multiple of 4
+        pad_h, pad_w = (-h) % 4, (-w) % 4
+        if pad_h or pad_w:
+            x = torch.nn.functional.pad(x, (0, pad_w, 0, pad_h), mode='reflect')
+        H, W = x.shape[2:]
+        tile_h = min(self.tile or H, H)
+        tile_w = min(self.tile or W, W)
+        overlap = min(self.tile_overlap, tile_h // 2, tile_w // 2)
+        ys = tile_starts(H, tile_h, tile_h - overlap)
+        xs = tile_starts(W, tile_w, tile_w - overlap)
+        if len(ys) == 1 and len(xs) == 1:
+            y = self.run_batched(model, x)
+            s = y.shape[2] // H
+            return y[:, :, :h * s, :w * s]
+
+        # tile major order, all images of one tile position are next to each other
+        tiles = torch.cat([x[:, :, ty:ty + tile_h, tx:tx + tile_w] for ty in ys for tx in xs])
+        y = self.run_batched(model, tiles)
+        s = y.shape[2] // tile_h
+        weight = (ramp(tile_h * s, overlap * s)[:, None] * ramp(tile_w * s, overlap * s)[None, :]).to(y.device)
+        # accumulated in float32, half precision loses the blend
+        out = torch.zeros((n, y.shape[1], H * s, W * s), device=y.device)
+        norm = torch.zeros((1, 1, H * s, W * s), device=y.device)
+        k = 0
+        for ty in ys:
+            for tx in xs:
+                out[:, :, ty * s:(ty + tile_h) * s, tx * s:(tx + tile_w) * s] += y[k:k + n].float() * weight
+                norm[:, :, ty * s:(ty + tile_h) * s, tx * s:(tx + tile_w) * s] += weight
+                k += n
+        return (out / norm)[:, :, :h * s, :w * s]
+
+    @torch.no_grad()
+    def upscale(self, upsampler, images):
+        '''
+        upsampler: a RealESRGANer, only its network and device are used
+        returns the upscaled images as hwc uint8 RGB numpy arrays
+        '''
+        model = upsampler.model
+        dtype = next(model.parameters()).dtype
+        results = [None] * len(images)
+        for indices in by_shape(images):
+            start = 0
+            while start < len(indices):
+                # the input, its tiles and the float32 blend of a chunk are on the device at once
+                chunk = indices[start:start + self.max_batch]
+                x = torch.from_numpy(np.stack([images[i] for i in chunk])).to(upsampler.device)
+                x = x.permute(0, 3, 1, 2).to(dtype) / 255.
+                y = self.upscale_tensor(model, x)
+                y = (y.float().clamp_(0, 1) * 255.).round_().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+                del x
+                for i, sample in zip(chunk, y):
+                    results[i] = sample
+                start += len(chunk)
+        return results
+
+    @torch.no_grad()
+    def restore_faces(self, restorer, images, only_center_face=False):
+        '''
+        restorer: a GFPGANer, its face helper finds and pastes the faces, its network restores them
+        returns the images with restored faces as hwc uint8 RGB numpy arrays
+        '''
+        helper = restorer.face_helper
+        states, faces = [], []
+        for image in images:
+            helper.clean_all()
+            # facexlib works on bgr images
+            helper.read_image(np.ascontiguousarray(image[:, :, ::-1]))
+            helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
+            helper.align_warp_face()
+            # clean_all() replaces the lists, so a shallow copy keeps this image's faces
+            states.append(dict(vars(helper)))
+            faces.append(list(helper.cropped_faces))
+
+        cropped = [face for image_faces in faces for face in image_faces]
+        restored = []
+        if cropped:
+            dtype = next(restorer.gfpgan.parameters()).dtype
+            x = torch.from_numpy(np.stack(cropped)[:, :, :, ::-1].copy()).to(restorer.device)
+            x = (x.permute(0, 3, 1, 2).to(dtype) / 255. - 0.5) / 0.5
+            y = self.run_batched(lambda faces: restorer.gfpgan(faces, return_rgb=False)[0], x)
+            y = ((y.float().clamp_(-1, 1) + 1) / 2 * 255.).round_().to(torch.uint8)
+            restored = list(y.permute(0, 2, 3, 1).flip(3).cpu().numpy())
+
+        results = []
+        k = 0
+        for image, state, image_faces in zip(images, states, faces):
+            if not image_faces:
+                results.append(image)
+                continue
+            vars(helper).update(state)
+            for face in restored[k:k + len(image_faces)]:
+                helper.add_restored_face(face)
+            k += len(image_faces)
+            helper.get_inverse_affine(None)
+            results.append(np.ascontiguousarray(helper.paste_faces_to_input_image()[:, :, ::-1]))
+        helper.clean_all()
+        return results
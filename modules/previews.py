@@ -0,0 +1,35 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+# least squares fit from the four SD v1 latent channels to rgb in [-1, 1]
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+PREVIEW_MODES = ['latent', 'full']
+
+
+def latent_to_rgb(samples, upscale=8):
+    '''
+    approximate images of a latent batch (n, 4, h, w) without the VAE: a fixed linear map from
+    the latent channels to rgb, upsampled from 1/8 size. Returns (n, 3, h*upscale, w*upscale) in [0, 1]
+    '''
+    factors = torch.tensor(LATENT_RGB_FACTORS, device=samples.device)
+    rgb = torch.einsum('nchw,cr->nrhw', samples.float(), factors)
+    rgb = torch.clamp((rgb + 1.0) / 2.0, min=0.0, max=1.0)
+    if upscale > 1:
+        rgb = F.interpolate(rgb, scale_factor=upscale, mode='bilinear', align_corners=False)
+    return rgb
+
+
+def latent_preview(samples, upscale=8):
+    ''' latent_to_rgb as a list of hwc uint8 arrays, the format of first_stage_decoder '''
+    with torch.no_grad():
+        rgb = latent_to_rgb(samples, upscale)
+        rgb = (255. * rgb).to(torch.uint8).permute(0, 2, 3, 1).cpu()
+    return list(np.ascontiguousarray(rgb.numpy()))
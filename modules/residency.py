@@ -0,0 +1,212 @@
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def modules_of(obj, depth=2):
+    '''
+    the torch modules that make up a loaded model: obj itself, or the modules held in the
+    attributes of wrapper objects like GFPGANer and RealESRGANer, up to depth levels down
+    '''
+    if isinstance(obj, torch.nn.Module):
+        return [obj]
+    if isinstance(obj, (tuple, list)):
+        return [m for o in obj for m in modules_of(o, depth)]
+    result = []
+    if depth > 0 and hasattr(obj, '__dict__'):
+        for value in vars(obj).values():
+            result += modules_of(value, depth - 1)
+    return result
+
+
+def size_of(obj):
+    ''' bytes taken by the parameters and buffers of obj '''
+    seen, size = set(), 0
+    for module in modules_of(obj):
+        for t in list(module.parameters()) + list(module.buffers()):
+            if t.data_ptr() not in seen:
+                seen.add(t.data_ptr())
+                size += t.numel() * t.element_size()
+    return size
+
+
+def device_of(obj):
+    for module in modules_of(obj):
+        for t in module.parameters():
+            return t.device
+    return torch.device('cpu')
+
+
+def move(obj, device, pin=False):
+    ''' moves every module of obj to device, pinned when it goes to host memory for a fast way back '''
+    device = torch.device(device)
+    for module in dict((id(m), m) for m in modules_of(obj)).values():
+        # copies from pinned memory to the gpu are asynchronous
+        module.to(device, non_blocking=device.type == 'cuda')
+        if pin:
+            module._apply(lambda t: t if t.is_pinned() else t.pin_memory())
+    # wrappers remember the device they run on
+    stack = [(obj, 2)]
+    while stack:
+        o, depth = stack.pop()
+        if isinstance(o, (torch.nn.Module, tuple, list)) or not hasattr(o, '__dict__'):
+            continue
+        if isinstance(getattr(o, 'device', None), torch.device):
+            o.device = device
+        if depth > 0:
+            stack += [(v, depth - 1) for v in vars(o).values()]
+
+
+class Entry():
+    def __init__(self, name, load, movable=True, unload=None):
+        self.name = name
+        self.load = load
+        self.unload = unload
+        self.movable = movable
+        self.obj = None
+        self.tier = 'disk'
+        self.device = None
+        self.size = 0
+        self.in_use = False
+
+
+class ModelResidency():
+    """
+    Keeps loaded models warm on three tiers: the gpu, pinned host memory and disk.
+
+    Every loadable model is registered once with a function that loads it. get() hands
+    out the model on its device, loading it on first use, and marks it in use until
+    release(). Models that are not in use stay on the gpu as long as the device budget
+    allows; past that the least recently used ones are moved to pinned host memory,
+    where promoting them back is a single copy, and past the host budget they are
+    dropped and have to be loaded from disk again.
+    """
+    def __init__(self, device_budget=None, host_budget=8 << 30):
+        # None: a share of the device memory, the rest is left for activations
+        self.device_budget = device_budget
+        self.host_budget = host_budget
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.metrics = {'hits': 0, 'host_hits': 0, 'misses': 0, 'demotions': 0, 'drops': 0, 'swap_time': 0.0, 'load_time': 0.0}
+
+    def register(self, name, load, movable=True, unload=None):
+        '''
+        load() returns the model on the device it should run on; movable=False for models
+        that place themselves, those are only ever dropped; unload(model) is called when
+        the model leaves the device, dropped or moved to host memory, for loaders that keep
+        their own reference and must not hand out the moved copy
+        '''
+        with self.lock:
+            if name in self.entries:
+                self.drop(name)
+            self.entries[name] = Entry(name, load, movable, unload)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def budget(self, device):
+        if self.device_budget is not None:
+            return self.device_budget
+        if device.type != 'cuda':
+            return float('inf')
+        return int(torch.cuda.get_device_properties(device).total_memory * 0.6)
+
+    def used(self, tier, device=None):
+        return sum(e.size for e in self.entries.values() if e.tier == tier and (device is None or e.device == device))
+
+    def get(self, name):
+        ''' the model called name on its device, loaded or promoted if needed; in use until release(name) '''
+        with self.lock:
+            entry = self.entries[name]
+            self.entries.move_to_end(name)
+            start = time.perf_counter()
+            if entry.tier == 'device':
+                self.metrics['hits'] += 1
+            elif entry.tier == 'host':
+                self.make_room(entry.device, entry.size, keep=name)
+                move(entry.obj, entry.device)
+                if entry.device.type == 'cuda':
+                    torch.cuda.synchronize(entry.device)
+                entry.tier = 'device'
+                self.metrics['host_hits'] += 1
+                self.metrics['swap_time'] += time.perf_counter() - start
+                print(f'Promoted {name} from host memory in {time.perf_counter() - start:.2f}s')
+            else:
+                if entry.device is not None:
+                    # the size is known from an earlier load
+                    self.make_room(entry.device, entry.size, keep=name)
+                entry.obj = entry.load()
+                entry.device = device_of(entry.obj)
+                entry.size = size_of(entry.obj)
+                entry.tier = 'device'
+                self.metrics['misses'] += 1
+                self.metrics['load_time'] += time.perf_counter() - start
+                print(f'Loaded {name} in {time.perf_counter() - start:.2f}s')
+                self.make_room(entry.device, 0, keep=name)
+            entry.in_use = True
+            return entry.obj
+
+    def release(self, name):
+        ''' the model is no longer needed right now, it stays warm but may be evicted '''
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None:
+                entry.in_use = False
+
+    def make_room(self, device, size, keep=None):
+        ''' evicts least recently used models that are not in use until size more bytes fit the device budget '''
+        budget = self.budget(device)
+        for entry in list(self.entries.values()):
+            if self.used('device', device) + size <= budget:
+                break
+            if entry.name != keep and entry.tier == 'device' and entry.device == device and not entry.in_use:
+                self.demote(entry)
+
+    def evict_unused(self):
+        ''' moves every model that is not in use off the gpu, for work that allocates outside the manager '''
+        with self.lock:
+            for entry in list(self.entries.values()):
+                if entry.tier == 'device' and not entry.in_use:
+                    self.demote(entry)
+
+    def demote(self, entry):
+        start = time.perf_counter()
+        if entry.movable and entry.device.type == 'cuda' and entry.size <= self.host_budget:
+            for other in list(self.entries.values()):
+                if self.used('host') + entry.size <= self.host_budget:
+                    break
+                if other.tier == 'host':
+                    self.drop(other.name)
+            move(entry.obj, 'cpu', pin=True)
+            if entry.unload is not None:
+                entry.unload(entry.obj)
+            entry.tier = 'host'
+            self.metrics['demotions'] += 1
+            self.metrics['swap_time'] += time.perf_counter() - start
+            print(f'Moved {entry.name} to host memory')
+        else:
+            self.drop(entry.name)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def drop(self, name):
+        ''' forgets the loaded model, the next get() loads it from disk '''
+        with self.lock:
+            entry = self.entries[name]
+            if entry.obj is not None:
+                if entry.unload is not None:
+                    entry.unload(entry.obj)
+                self.metrics['drops'] += 1
+                print(f'Unloaded {name}')
+            entry.obj = None
+            entry.tier = 'disk'
+            entry.in_use = False
+
+    def stats(self):
+        ''' counters plus the tier and size of every model '''
+        with self.lock:
+            result = dict(self.metrics)
+            result['models'] = {e.name: {'tier': e.tier, 'size_mb': e.size >> 20, 'in_use': e.in_use} for e in self.entries.values()}
+            return result
@@ -0,0 +1,226 @@
+import threading
+from functools import partial
+from typing import Callable
+
+import k_diffusion as K
+import torch
+import torch.nn as nn
+from tqdm import trange
+
+from ldm.models.diffusion.ddim import DDIMSampler, ddim_step
+from ldm.models.diffusion.plms import PLMSSampler
+from modules.noise import sampling_noise
+
+
+SAMPLERS = {}
+lock = threading.Lock()
+
+
+def register_sampler(name):
+    '''
+    registers factory(model, cache) as the sampler called name; cache is a dict kept per model
+    for whatever the sampler can reuse between requests, like wrappers and schedules
+    '''
+    def register(factory):
+        SAMPLERS[name] = factory
+        return factory
+    return register
+
+
+def model_cache(model):
+    # kept on the model itself, so it goes away with the model
+    with lock:
+        if 'sampler_cache' not in model.__dict__:
+            model.__dict__['sampler_cache'] = {}
+        return model.__dict__['sampler_cache']
+
+
+def compile_steps():
+    '''
+    compiles the DDIM/PLMS update, the elementwise math between two UNet calls, into one
+    fused kernel with torch.compile; returns False when the installed torch has no compiler
+    '''
+    if not hasattr(torch, 'compile'):
+        print('torch.compile is not available, DDIM and PLMS steps stay eager')
+        return False
+    step = staticmethod(torch.compile(ddim_step))
+    DDIMSampler.step_fn = step
+    PLMSSampler.step_fn = step
+    return True
+
+
+def get_sampler(model, name):
+    ''' a sampler called name for model; what it builds from the model is built once and reused '''
+    if name not in SAMPLERS:
+        raise Exception("Unknown sampler: " + name)
+    return SAMPLERS[name](model, model_cache(model))
+
+
+def guidance_interval(sigma_min=0., sigma_max=0.):
+    ''' the (low, high) sigma range for CFGDenoiser from two ui values, 0 leaves that side open; None if both are '''
+    if not sigma_min and not sigma_max:
+        return None
+    return (float(sigma_min or 0.), float(sigma_max or 'inf'))
+
+
+class CFGDenoiser(nn.Module):
+    '''
+    classifier free guidance around a k-diffusion denoiser. Without uncond or at cond_scale 1
+    only the cond half runs. interval=(low, high) guides only at sigmas in that range; at
+    other sigmas only the cond half runs and the uncond prediction of the last guided step
+    is reused, or the step is unguided if there was none yet.
+    '''
+    def __init__(self, model, interval=None):
+        super().__init__()
+        self.inner_model = model
+        self.interval = interval
+        self.last_uncond = None
+
+    def guided(self, sigma):
+        if self.interval is None:
+            return True
+        low, high = self.interval
+        return low <= sigma.max().item() <= high
+
+    def forward(self, x, sigma, uncond, cond, cond_scale):
+        if uncond is None or cond_scale == 1:
+            return self.inner_model(x, sigma, cond=cond)
+        if not self.guided(sigma):
+            cond = self.inner_model(x, sigma, cond=cond)
+            if self.last_uncond is None:
+                return cond
+            uncond = self.last_uncond
+        else:
+            x_in = torch.cat([x] * 2)
+            sigma_in = torch.cat([sigma] * 2)
+            cond_in = torch.cat([uncond, cond])
+            uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
+            if self.interval is not None:
+                self.last_uncond = uncond
+        return uncond + (cond - uncond) * cond_scale
+
+
+class CFGMaskedDenoiser(CFGDenoiser):
+    ''' CFGDenoiser that keeps the unmasked part of x0, for inpainting '''
+    def forward(self, x, sigma, uncond, cond, cond_scale, mask, x0, xi):
+        denoised = super().forward(x, sigma, uncond, cond, cond_scale)
+
+        if mask is not None:
+            assert x0 is not None
+            img_orig = x0
+            mask_inv = 1. - mask
+            denoised = (img_orig * mask_inv) + (mask * denoised)
+
+        return denoised
+
+
+class CompVisDenoiser(K.external.CompVisDenoiser):
+    ''' the k-diffusion wrapper, remembering every sigma schedule it has computed '''
+    def __init__(self, model, *args, **kwargs):
+        super().__init__(model, *args, **kwargs)
+        self.schedules = {}
+
+    def get_sigmas(self, n=None):
+        if n not in self.schedules:
+            self.schedules[n] = super().get_sigmas(n)
+        return self.schedules[n]
+
+
+# the ancestral loops of k-diffusion, which draw their step noise with randn_like from the global
+# rng; these draw it with sampling_noise from the job's generator, the same noise for one seed
+@torch.no_grad()
+def sample_euler_ancestral(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    '''Ancestral sampling with Euler method steps.'''
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+        sigma_down, sigma_up = K.sampling.get_ancestral_step(sigmas[i], sigmas[i + 1])
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        d = K.sampling.to_d(x, sigmas[i], denoised)
+        # Euler method
+        dt = sigma_down - sigmas[i]
+        x = x + d * dt
+        x = x + sampling_noise(x.shape, x.device).to(x.dtype) * sigma_up
+    return x
+
+
+@torch.no_grad()
+def sample_dpm_2_ancestral(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    '''Ancestral sampling with DPM-Solver inspired second-order steps.'''
+    extra_args = {} if extra_args is None else extra_args
+    s_in = x.new_ones([x.shape[0]])
+    for i in trange(len(sigmas) - 1, disable=disable):
+        denoised = model(x, sigmas[i] * s_in, **extra_args)
+        sigma_down, sigma_up = K.sampling.get_ancestral_step(sigmas[i], sigmas[i + 1])
+        if callback is not None:
+            callback({'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised})
+        d = K.sampling.to_d(x, sigmas[i], denoised)
+        # Midpoint method, where the midpoint is chosen according to a rho=3 Karras schedule
+        sigma_mid = ((sigmas[i] ** (1 / 3) + sigma_down ** (1 / 3)) / 2) ** 3
+        dt_1 = sigma_mid - sigmas[i]
+        dt_2 = sigma_down - sigmas[i]
+        x_2 = x + d * dt_1
+        denoised_2 = model(x_2, sigma_mid * s_in, **extra_args)
+        d_2 = K.sampling.to_d(x_2, sigma_mid, denoised_2)
+        x = x + d_2 * dt_2
+        x = x + sampling_noise(x.shape, x.device).to(x.dtype) * sigma_up
+    return x
+
+
+ANCESTRAL_SAMPLERS = {'euler_ancestral': sample_euler_ancestral, 'dpm_2_ancestral': sample_dpm_2_ancestral}
+
+
+class KDiffusionSampler:
+    def __init__(self, m, sampler, model_wrap=None):
+        self.model = m
+        self.model_wrap = model_wrap if model_wrap is not None else CompVisDenoiser(m)
+        self.schedule = sampler
+    def get_sampler_name(self):
+        return self.schedule
+    def sample(self, S, conditioning, batch_size, shape, verbose, unconditional_guidance_scale, unconditional_conditioning, eta, x_T, img_callback: Callable = None, cfg_interval=None, log_every_t=None):
+        # log_every_t is taken for the DDIM/PLMS signature, k-diffusion calls back on every step
+        sigmas = self.model_wrap.get_sigmas(S)
+        x = x_T * sigmas[0]
+        model_wrap_cfg = CFGDenoiser(self.model_wrap, cfg_interval)
+
+        samples_ddim = self.run(model_wrap_cfg, x, sigmas, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': unconditional_guidance_scale}, disable=False, callback=partial(KDiffusionSampler.img_callback_wrapper, img_callback))
+
+        return samples_ddim, None
+
+    def run(self, denoiser, x, sigmas, **kwargs):
+        ''' the sampling function of the schedule, ours for the ancestral ones '''
+        fn = ANCESTRAL_SAMPLERS.get(self.schedule) or K.sampling.__dict__[f'sample_{self.schedule}']
+        return fn(denoiser, x, sigmas, **kwargs)
+
+    @classmethod
+    def img_callback_wrapper(cls, callback: Callable, *args):
+        ''' Converts a KDiffusion callback to the standard img_callback(x0, i) of DDIM and PLMS '''
+        if callback:
+            arg_dict = args[0]
+            callback(arg_dict['denoised'], arg_dict['i'])
+
+
+# DDIM and PLMS keep their schedule on the instance, so every request gets its own
+# sampler; the schedules themselves are shared through the model's cache
+@register_sampler('DDIM')
+def ddim_sampler(model, cache):
+    return DDIMSampler(model, schedules=cache.setdefault('ddim_schedules', {}))
+
+
+@register_sampler('PLMS')
+def plms_sampler(model, cache):
+    return PLMSSampler(model, schedules=cache.setdefault('plms_schedules', {}))
+
+
+def k_sampler(schedule, model, cache):
+    with lock:
+        if 'model_wrap' not in cache:
+            cache['model_wrap'] = CompVisDenoiser(model)
+    return KDiffusionSampler(model, schedule, model_wrap=cache['model_wrap'])
+
+
+for name, schedule in [('k_dpm_2_a', 'dpm_2_ancestral'), ('k_dpm_2', 'dpm_2'), ('k_euler_a', 'euler_ancestral'),
+                       ('k_euler', 'euler'), ('k_heun', 'heun'), ('k_lms', 'lms')]:
+    register_sampler(name)(partial(k_sampler, schedule))
@@ -11,6 +11,8 @@ from discord.ext import commands, tasks
 
 from modules.sdb_shared import opt, processes, cpkts
 from modules.sdb_upscaler import SyncDiffusionUpscaler
+from modules.sdb_dispatch import QueueBridge
+from modules.telemetry import get_telemetry, format_summary
 
 
 def get_resolution(ar, basesize):
@@ -50,18 +52,21 @@ class SyncDiffusionBot(commands.Bot):
         print('Synced!')
 
 class SyncDiffusionCog(commands.Cog):
-    def __init__(self, bot: commands.Bot, dream_queue, awaken_queue, message_queue, upscale_queue, out_dir, restart_queue) -> None:
+    def __init__(self, bot: commands.Bot, dream_queue, awaken_queue, message_queue, upscale_queue, upscaled_queue, out_dir, restart_queue, pool=None) -> None:
         self.loop = asyncio.get_event_loop()
         self.bot = bot
         self.dream_queue = dream_queue
         self.awaken_queue = awaken_queue
         self.message_queue = message_queue
         self.upscale_queue = upscale_queue
+        self.upscaled_queue = upscaled_queue
+        self.consumers = []
         self.index = 0
         self.jobs = dict()
         self.upscale_jobs = dict()
         self.out_dir = out_dir
         self.restart_queue = restart_queue
+        self.pool = pool
 
     async def setup_hook(self) -> None:
         print(f'bot: setup_hook(self)')
@@ -70,14 +75,40 @@ class SyncDiffusionCog(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         print(f'bot: on_ready')
-        await self.bot_loop.start()
+        # on_ready fires again on every reconnect, the consumers only start once
+        if self.consumers:
+            return
+        # device memory for /info, sampled from the start
+        for index in self.device_indices():
+            get_telemetry(index)
+        bridges = [
+            (QueueBridge(self.message_queue, 'message'), self.on_message_queue),
+            (QueueBridge(self.upscaled_queue, 'upscaled'), self.on_upscaled_queue),
+            (QueueBridge(self.awaken_queue, 'awaken'), self.on_awaken_queue),
+        ]
+        for bridge, handler in bridges:
+            self.consumers.append(self.loop.create_task(bridge.consume(handler)))
+
+    def device_indices(self):
+        ''' the gpus the workers run on, one line each in /info; gpu 0 without a pool '''
+        devices = self.pool.devices if self.pool is not None else []
+        return sorted({int(device.split(':')[1]) for device in devices if device.startswith('cuda:')}) or [0]
 
     @discord.app_commands.command(name="info")
     async def show_info(self, interaction: discord.Interaction):
         try:
             print(f'bot: show_info')
             worker_number = len(processes)
-            await interaction.response.send_message(content=f"```job_queue_number: {self.dream_queue.qsize()}\nworker_number: {worker_number}```", view=InfoButtons(self))
+            job_queue_number = self.dream_queue.qsize()
+            pool_message = ''
+            if self.pool is not None:
+                status = self.pool.status()
+                job_queue_number += status['pending']
+                workers = ' '.join(f'{index}:{name}' for index, name in sorted(status['workers'].items()))
+                worker_number = len(status['workers'])
+                pool_message = f"\nworkers: {workers}\nswaps: {status['swaps']}"
+            telemetry_message = ''.join(f"\ncuda:{index} {format_summary(get_telemetry(index).summary())}" for index in self.device_indices())
+            await interaction.response.send_message(content=f"```job_queue_number: {job_queue_number}\nworker_number: {worker_number}{pool_message}{telemetry_message}```", view=InfoButtons(self))
         except Exception as e:
             await discord.interaction.response.send_message(content=str(e))
             raise
@@ -107,7 +138,7 @@ class SyncDiffusionCog(commands.Cog):
     @discord.app_commands.command(name="dream")
     async def recieve_dream(self, interaction: discord.Interaction, prompt: str, model:str = 'sd', seed: int = None, itr: int = 1, ar: str = '1:1', 
         basesize: int = 512, ddim_steps: int = 25, cfg_scale: float = 7.5, sampler_name: str = 'k_lms', matrix: bool = False, normalize: bool = True, 
-        gfpgan: bool = True, realesrgan: bool = False, realesrgan_anime:bool = False):
+        gfpgan: bool = True, realesrgan: bool = False, realesrgan_anime:bool = False, cfg_sigma_min: float = 0.0, cfg_sigma_max: float = 0.0):
         try: 
             print(f'bot: recieve_dream() / dream_queue: {self.dream_queue.qsize()}')
 
@@ -144,8 +175,11 @@ class SyncDiffusionCog(commands.Cog):
                 seed_message = f'seed: {seed} '
 
             fp = None
+            # guidance only between these sigmas, k-diffusion samplers only; 0 leaves a side open
+            cfg_sigma = (cfg_sigma_min, cfg_sigma_max)
+            interval_message = f' cfg_sigma:{cfg_sigma_min}-{cfg_sigma_max}' if cfg_sigma_min or cfg_sigma_max else ''
     
-            message = f'{prompt}\n```itr:{itr} ar:{ar} basesize:{basesize} \nmodel: {model} \nddim_steps:{ddim_steps} cfg_scale:{cfg_scale} sampler_name:{sampler_name} \nmatrix:{matrix} normalize:{normalize} gfpgan:{gfpgan} realesrgan:{realesrgan} realesrgan_anime:{realesrgan_anime}\nuser: {username} ({userid})```'
+            message = f'{prompt}\n```itr:{itr} ar:{ar} basesize:{basesize} \nmodel: {model} \nddim_steps:{ddim_steps} cfg_scale:{cfg_scale}{interval_message} sampler_name:{sampler_name} \nmatrix:{matrix} normalize:{normalize} gfpgan:{gfpgan} realesrgan:{realesrgan} realesrgan_anime:{realesrgan_anime}\nuser: {username} ({userid})```'
             await interaction.response.send_message(content=message, view=InfoButtons(self))
             print(itr)
 
@@ -157,7 +191,7 @@ class SyncDiffusionCog(commands.Cog):
                 if random_seed:
                     seed = randint(0, 9999999999)
                 workload = 'dream'
-                payload = [prompt, ddim_steps, sampler_name, toggles, realesrgan_model_name, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp]
+                payload = [prompt, ddim_steps, sampler_name, toggles, realesrgan_model_name, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, cfg_sigma]
                 job = SyncDiffusionJob(id, workload, interaction, payload, seed, total_itr, current_itr, self.dream_queue, self.awaken_queue, self.message_queue, self.upscale_queue, self.upscale_jobs, self.out_dir, model)
                 self.jobs[id] = job
                 await job.dreaming()
@@ -167,44 +201,42 @@ class SyncDiffusionCog(commands.Cog):
             raise
 
 
-    @tasks.loop(seconds=0.5)  # task runs every 60 seconds
-    async def bot_loop(self):
-#        print(f'bot: bot_loop: self.awaken_queue / {self.awaken_queue.qsize()}')
+    async def on_message_queue(self, message):
+        try:
+            print(f'bot: force_send_message: message: {message}')
+            await discord.interaction.response.send_message(content=message)
+        except Exception as e:
+            await discord.interaction.response.send_message(content=str(e))
+            raise
+
+    async def on_upscaled_queue(self, queue):
+        try:
+            print(f'bot: on_upscaled_queue: upscale_queue found done')
+            print(queue)
+            job = self.upscale_jobs[queue[0]]
+            print(job)
+
+            filename = queue[2][2]
+            fp = queue[2][3]
+
+            print(fp)
+
+            original_message = await job[1].original_response()
+            print(original_message)
+            await original_message.add_files(discord.File(fp=fp, filename=filename))
+            del job
+        except Exception as e:
+            await discord.interaction.response.send_message(content=str(e))
+            raise
+
+    async def on_awaken_queue(self, awaken):
         try:
-            if not self.message_queue.empty():
-                message = self.message_queue.get()
-                print(f'bot: force_send_message: message: {message}')
-                await discord.interaction.response.send_message(content=message)
-
-            elif not self.upscale_queue.empty():
-                queue = self.upscale_queue.get()
-                if queue[1] == 'done':
-                    print(f'bot: bot_loop: upscale_queue found done')
-                    print(queue)
-                    job = self.upscale_jobs[queue[0]]
-                    print(job)
-
-                    filename = queue[2][2]
-                    fp = queue[2][3]
-
-                    print(fp)
-
-                    original_message = await job[1].original_response()
-                    print(original_message)
-                    await original_message.add_files(discord.File(fp=fp, filename=filename))
-                    del job
-                else:
-                    self.upscale_queue.put(queue)
-
-            elif not self.awaken_queue.empty():
-                print(f'bot: bot_loop: self.awaken_queue found! / {self.awaken_queue.qsize()}')
-                awaken = self.awaken_queue.get()
-                print(f'bot: bot_loop: self.awaken_queue: awaken: {awaken}')
-                job = self.jobs[awaken[0]]
-                await job.terminate(awaken)
-                del self.jobs[awaken[0]]
-                del job
-                print(f'bot: bot_loop: complete! / {self.awaken_queue.qsize()}')
+            print(f'bot: on_awaken_queue: awaken: {awaken}')
+            job = self.jobs[awaken[0]]
+            await job.terminate(awaken)
+            del self.jobs[awaken[0]]
+            del job
+            print(f'bot: on_awaken_queue: complete! / {self.awaken_queue.qsize()}')
 
         except Exception as e:
             await discord.interaction.response.send_message(content=str(e))
@@ -340,6 +372,8 @@ class InfoButtons(discord.ui.View):
             button.style = discord.ButtonStyle.green
             while not self.instance.dream_queue.empty():
                 self.instance.dream_queue.get()
+            if self.instance.pool is not None:
+                self.instance.pool.cancel()
             await interaction.response.send_message(content=f"Send Cancel Dreaming!")
         except Exception as e:
             await discord.interaction.response.send_message(content=str(e))
@@ -0,0 +1,50 @@
+import asyncio
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+# how long a bridge thread blocks in Queue.get before re-arming; this only bounds
+# shutdown latency, items are still handed over the moment they are put
+BLOCK_TIMEOUT = 1.0
+
+
+class QueueBridge():
+    """
+    Bridges a multiprocessing.Queue into asyncio.
+
+    Every bridge owns a single thread that sits in a blocking Queue.get(), so the
+    awaiting coroutine wakes up as soon as an item arrives instead of polling
+    Queue.empty() and sleeping. A dedicated executor per bridge keeps long-lived
+    blocking gets from starving the loop's default executor.
+    """
+    def __init__(self, source, name='queue', timeout=BLOCK_TIMEOUT):
+        self.source = source
+        self.name = name
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'sdb_dispatch_{name}')
+
+    def _get(self):
+        try:
+            return True, self.source.get(True, self.timeout)
+        except queue.Empty:
+            return False, None
+
+    async def get(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            found, item = await loop.run_in_executor(self.executor, self._get)
+            if found:
+                return item
+
+    async def consume(self, handler):
+        while True:
+            item = await self.get()
+            try:
+                await handler(item)
+            except Exception:
+                print(f'sdb_dispatch: {self.name}: handler has error:')
+                print(traceback.format_exc())
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+from modules.sdb_dispatch import QueueBridge
+
+
+def batch_key(dream):
+    ''' dreams with equal keys can share one sampler call; prompt and seed are per sample '''
+    prompt, ddim_steps, sampler_name, toggles, realesrgan_model_name, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, cfg_sigma = dream[1]
+    if 0 in toggles or fp is not None:
+        # prompt matrix and embeddings change the whole batch, never merge them
+        return dream[0]
+    return (width, height, ddim_steps, sampler_name, cfg_scale, cfg_sigma, ddim_eta, tuple(sorted(toggles)), realesrgan_model_name)
+
+
+def find_ckpt(cpkts, name, default_name):
+    ''' returns the checkpoint entry for a /dream model name, falling back to the default checkpoint '''
+    for ckpt in cpkts:
+        if ckpt['name'] == name:
+            return ckpt
+    for ckpt in cpkts:
+        if ckpt['name'] == default_name:
+            return ckpt
+    return cpkts[0]
+
+
+class SyncDiffusionPool():
+    """
+    Routes dreams to a pool of workers with checkpoint affinity.
+
+    Dreams wait in one queue per checkpoint. Workers announce themselves on the
+    ready_queue with the checkpoint they have loaded whenever they are idle, and
+    the pool hands them work in this order:
+      1. a dream for the checkpoint the worker already has loaded
+      2. a dream for a checkpoint no worker has loaded, or whose backlog is larger
+         than the number of workers hosting it; the worker swaps models for it
+    Each worker has at most one batch in flight, so a worker is never handed a
+    model switch while it still has work queued for its current model.
+
+    A batch is the oldest pending dream plus up to max_batch - 1 later dreams
+    with the same batch_key. A partial batch is held back until its oldest
+    dream has waited batch_window seconds, so that dreams arriving together
+    from several users end up in one sampler call.
+    """
+    def __init__(self, dream_queue, ready_queue, inboxes, cpkts, default_name, max_batch=1, batch_window=0., devices=()):
+        self.dream_queue = dream_queue
+        self.ready_queue = ready_queue
+        self.inboxes = inboxes
+        self.cpkts = cpkts
+        self.default_name = default_name
+        self.max_batch = max(max_batch, 1)
+        self.batch_window = batch_window
+        # devices[i] is the torch device worker i runs on
+        self.devices = list(devices)
+        self.loop = None
+        self.timer = None
+        self.pending = OrderedDict()
+        self.loaded = dict()
+        self.idle = OrderedDict()
+        self.dispatched = 0
+        self.batches = 0
+        self.swaps = 0
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            QueueBridge(self.dream_queue, 'pool_dream').consume(self.on_dream),
+            QueueBridge(self.ready_queue, 'pool_ready').consume(self.on_ready),
+        )
+
+    async def on_dream(self, dream):
+        ckpt = find_ckpt(self.cpkts, dream[2], self.default_name)
+        self.pending.setdefault(ckpt['name'], deque()).append((dream, ckpt, time.time()))
+        self.dispatch()
+
+    async def on_ready(self, ready):
+        index, name = ready
+        self.loaded[index] = name
+        self.idle[index] = time.time()
+        self.dispatch()
+
+    def hosts(self, name):
+        return [index for index, loaded in self.loaded.items() if loaded == name]
+
+    def pick(self):
+        # 1. affinity: an idle worker that already has a pending checkpoint loaded
+        for index in self.idle:
+            if self.loaded[index] in self.pending:
+                return index, self.loaded[index]
+
+        # 2. swap: checkpoints nobody hosts, or that are backed up behind busy hosts
+        for name, dreams in self.pending.items():
+            if len(dreams) > len(self.hosts(name)):
+                # prefer the worker whose model is most redundant, then the longest idle
+                index = max(self.idle, key=lambda i: (len(self.hosts(self.loaded[i])), -self.idle[i]))
+                return index, name
+
+        return None, None
+
+    def take_batch(self, name):
+        dreams = self.pending[name]
+        key = batch_key(dreams[0][0])
+        batch = []
+        rest = deque()
+        for entry in dreams:
+            if len(batch) < self.max_batch and batch_key(entry[0]) == key:
+                batch.append(entry)
+            else:
+                rest.append(entry)
+        return batch, rest
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    def dispatch(self):
+        while self.idle and self.pending:
+            index, name = self.pick()
+            if index is None:
+                return
+            batch, rest = self.take_batch(name)
+            wait = batch[0][2] + self.batch_window - time.time()
+            if len(batch) < self.max_batch and wait > 0:
+                if self.timer is None:
+                    self.timer = self.loop.call_later(wait, self.on_timer)
+                return
+            if rest:
+                self.pending[name] = rest
+            else:
+                del self.pending[name]
+            del self.idle[index]
+            if self.loaded[index] != name:
+                self.swaps += 1
+                print(f'pool: worker {index}: swap {self.loaded[index]} -> {name} / swaps: {self.swaps}')
+            self.loaded[index] = name
+            self.dispatched += len(batch)
+            self.batches += 1
+            self.inboxes[index].put([[entry[0] for entry in batch], batch[0][1]])
+
+    def cancel(self):
+        ''' drops every dream that has not been handed to a worker yet; safe to call from other threads '''
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.pending.clear)
+
+    def pending_count(self):
+        return sum(len(dreams) for dreams in list(self.pending.values()))
+
+    def status(self):
+        return {
+            'pending': self.pending_count(),
+            'dispatched': self.dispatched,
+            'batches': self.batches,
+            'swaps': self.swaps,
+            'workers': dict(self.loaded),
+        }
+
+
+def pool_launch(pool):
+    asyncio.run(pool.run())
@@ -15,6 +15,7 @@ parser.add_argument("--gfpgan-dir", type=str, help="GFPGAN directory", default=(
 parser.add_argument("--realesrgan-dir", type=str, help="RealESRGAN directory", default=('./src/realesrgan' if os.path.exists('./src/realesrgan') else './RealESRGAN'))
 parser.add_argument("--realesrgan-model", type=str, help="Upscaling model for RealESRGAN", default=('RealESRGAN_x4plus'))
 parser.add_argument("--no-verify-input", action='store_true', help="do not verify input to check if it's too long")
+parser.add_argument("--no-ckpt-cache", action='store_true', help="do not write a faster to load copy of .ckpt checkpoints next to them")
 parser.add_argument("--no-half", action='store_true', help="do not switch the model to 16-bit floats")
 parser.add_argument("--no-progressbar-hiding", action='store_true', help="do not hide progressbar in gradio UI (we hide it because it slows down ML if you have hardware accleration in browser)")
 parser.add_argument("--defaults", type=str, help="path to configuration file providing UI defaults, uses same format as cli parameter", default='configs/webui/webui.yaml')
@@ -22,6 +23,16 @@ parser.add_argument("--cli", type=str, help="don't launch web server, take Pytho
 parser.add_argument("--modeltype", type=str, default=None, help="name of model",)
 parser.add_argument("--workers", type=int, default=None, help="quantity of worker",)
 parser.add_argument("--all", action='store_true', help="all")
+parser.add_argument("--max-batch", type=int, default=4, help="maximum number of compatible dreams merged into one sampler call",)
+parser.add_argument("--batch-window", type=float, default=0.15, help="seconds to wait for compatible dreams before dispatching a partial batch to an idle worker",)
+parser.add_argument("--clip-cache-mb", type=int, default=64, help="memory cap in MB for cached prompt embeddings, 0 disables the cache",)
+parser.add_argument("--attention", type=str, default="auto", help="attention backend, picked once at load: auto (sdpa if available, else chunked), sdpa, chunked, einsum or compvis",)
+parser.add_argument("--upscale-tile", type=int, default=512, help="RealESRGAN tile size in input pixels, tiles of all images in a batch are upscaled together; 0 upscales whole images",)
+parser.add_argument("--upscale-tile-overlap", type=int, default=32, help="overlap in input pixels between RealESRGAN tiles, blended linearly",)
+parser.add_argument("--vae-tile-size", type=int, default=0, help="decode images larger than this many pixels in overlapping tiles to bound VAE memory, 0 decodes in one pass",)
+parser.add_argument("--compile-sampler", action='store_true', help="compile the DDIM/PLMS step with torch.compile, needs torch 2",)
+parser.add_argument("--trace-log", type=str, default=None, help="append the stage timings of every request as one json line to this file",)
+parser.add_argument("--cpu-noise", action='store_true', help="draw the initial and step noise on the cpu, so a seed gives the same image on any device (changes the images of existing gpu seeds)",)
 
 opt = parser.parse_args()
 
@@ -2,27 +2,16 @@ import os, sys
 import numpy as np
 from PIL import Image, ImageFont, ImageDraw, ImageFilter, ImageOps
 from modules.sdb_shared import opt
+from modules.upscalers import get_RealESRGAN
+from modules.tracing import Trace, set_trace_log
 
 RealESRGAN_dir = opt.realesrgan_dir
+set_trace_log(opt.trace_log)
 
 
 def load_RealESRGAN(model_name: str):
-    from basicsr.archs.rrdbnet_arch import RRDBNet
-    RealESRGAN_models = {
-        'RealESRGAN_x4plus': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
-        'RealESRGAN_x4plus_anime_6B': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
-    }
-
-    model_path = os.path.join(RealESRGAN_dir, 'experiments/pretrained_models', model_name + '.pth')
-    if not os.path.isfile(model_path):
-        raise Exception(model_name+".pth not found at path "+model_path)
-
-    sys.path.append(os.path.abspath(RealESRGAN_dir))
-    from realesrgan import RealESRGANer
-
-    instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_models[model_name], pre_pad=0, half=True)
-    instance.model.name = model_name
-    return instance
+    # cached per model and device, shared with the RealESRGAN pass in sdb_utils.process_images
+    return get_RealESRGAN(RealESRGAN_dir, model_name)
 
 def try_loading_RealESRGAN(model_name: str):
     global RealESRGAN
@@ -62,8 +51,14 @@ class SyncDiffusionUpscaler():
         self.model_name = model_name
 
     async def run(self):
-        image = Image.open(self.source_filepath)
-        self.response = run_RealESRGAN(image, self.model_name)
+        trace = Trace('upscale', model=self.model_name, source=self.source_filename)
+        with trace.span('load'):
+            image = Image.open(self.source_filepath)
+            image.load()
+        with trace.span('realesrgan', sync=True):
+            self.response = run_RealESRGAN(image, self.model_name)
+        trace.finish()
+        print(f"Upscaled {self.source_filename}. {trace.summary()}")
 
     async def get_response(self):
         return self.response
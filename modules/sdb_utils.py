@@ -5,7 +5,6 @@ import k_diffusion as K
 import math
 import mimetypes
 import numpy as np
-import pynvml
 import random
 import threading, asyncio
 import time
@@ -14,6 +13,7 @@ import torch.nn as nn
 import yaml
 import glob
 from typing import List, Union
+from functools import partial
 
 from contextlib import contextmanager, nullcontext
 from einops import rearrange, repeat
@@ -24,11 +24,21 @@ from io import BytesIO
 import base64
 import re
 from torch import autocast
-from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.models.diffusion.plms import PLMSSampler
 from ldm.util import instantiate_from_config
+from ldm.checkpoint import load_model
+from ldm.modules.attention import set_attention_backend
+from ldm.models.batched_decode import BatchedDecoder
 
 from modules.sdb_shared import opt
+from modules.image_writer import ImageWriter
+from modules.sequence import next_sequence_number
+from modules.upscalers import get_RealESRGAN
+from modules.postprocess import PostProcessor
+from modules.samplers import get_sampler, compile_steps, guidance_interval, CFGDenoiser
+from modules.noise import create_random_tensors, seeded_rng
+from modules.conditioning import get_conditioning
+from modules.telemetry import get_telemetry, format_usage
+from modules.tracing import Trace, current_trace, span, traced, set_trace_log
 
 try:
     # this silences the annoying "Some weights of the model checkpoint were not used when initializing..." message at start.
@@ -52,23 +62,30 @@ def chunk(it, size):
     it = iter(it)
     return iter(lambda: tuple(islice(it, size)), ())
 
-def load_model_from_config(config, ckpt, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print("missing keys:")
-        print(m)
-    if len(u) > 0 and verbose:
-        print("unexpected keys:")
-        print(u)
-
-    model.cuda()
-    model.eval()
+def load_model_from_config(config, ckpt, verbose=False, device="cuda", half=False):
+    # builds the model without weight init and streams the cached checkpoint straight into device and dtype
+    return load_model(config, ckpt, device=device, half=half, verbose=verbose, cache=not opt.no_ckpt_cache)
+
+
+first_stage_decoder = BatchedDecoder()
+postprocessor = PostProcessor(tile=opt.upscale_tile, tile_overlap=opt.upscale_tile_overlap)
+image_writer = ImageWriter()
+set_trace_log(opt.trace_log)
+
+
+def write_info_file(path, info_dict):
+    with open(path, "w", encoding="utf8") as f:
+        yaml.dump(info_dict, f)
+
+def load_ckpt(ckpt, device):
+    set_attention_backend(opt.attention)
+    if opt.compile_sampler:
+        compile_steps()
+    config = OmegaConf.load("configs/stable-diffusion/v1-inference.yaml")
+    model = load_model_from_config(config, ckpt['path'], device=device, half=not opt.no_half)
+    model.cond_stage_model.cache_mb = opt.clip_cache_mb
+    if opt.vae_tile_size:
+        model.first_stage_tile = opt.vae_tile_size // 8
     return model
 
 def crash(e, s, device, model):
@@ -85,80 +102,6 @@ def crash(e, s, device, model):
     t.start()
 
 
-class MemUsageMonitor(threading.Thread):
-    stop_flag = False
-    max_usage = 0
-    total = 0
-
-    def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
-
-    def run(self):
-        print(f"[{self.name}] Recording max memory usage...\n")
-        pynvml.nvmlInit()
-        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
-        self.total = pynvml.nvmlDeviceGetMemoryInfo(handle).total
-        while not self.stop_flag:
-            m = pynvml.nvmlDeviceGetMemoryInfo(handle)
-            self.max_usage = max(self.max_usage, m.used)
-            # print(self.max_usage)
-            time.sleep(0.1)
-#            asyncio.sleep(0.1)
-        print(f"[{self.name}] Stopped recording.\n")
-        pynvml.nvmlShutdown()
-
-    def read(self):
-        return self.max_usage, self.total
-
-    def stop(self):
-        self.stop_flag = True
-
-    def read_and_stop(self):
-        self.stop_flag = True
-        return self.max_usage, self.total
-
-class CFGDenoiser(nn.Module):
-    def __init__(self, model):
-        super().__init__()
-        self.inner_model = model
-
-    def forward(self, x, sigma, uncond, cond, cond_scale):
-        x_in = torch.cat([x] * 2)
-        sigma_in = torch.cat([sigma] * 2)
-        cond_in = torch.cat([uncond, cond])
-        uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
-        return uncond + (cond - uncond) * cond_scale
-
-
-class KDiffusionSampler:
-    def __init__(self, m, sampler):
-        self.model = m
-        self.model_wrap = K.external.CompVisDenoiser(m)
-        self.schedule = sampler
-
-    def sample(self, S, conditioning, batch_size, shape, verbose, unconditional_guidance_scale, unconditional_conditioning, eta, x_T):
-        sigmas = self.model_wrap.get_sigmas(S)
-        x = x_T * sigmas[0]
-        model_wrap_cfg = CFGDenoiser(self.model_wrap)
-
-        samples_ddim = K.sampling.__dict__[f'sample_{self.schedule}'](model_wrap_cfg, x, sigmas, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': unconditional_guidance_scale}, disable=False)
-
-        return samples_ddim, None
-
-def create_random_tensors(shape, seeds, device):
-    xs = []
-    for seed in seeds:
-        torch.manual_seed(seed)
-
-        # randn results depend on device; gpu and cpu get different results for same seed;
-        # the way I see it, it's better to do this on CPU, so that everyone gets same result;
-        # but the original script had it like this so i do not dare change it for now because
-        # it will break everyone's seeds.
-        xs.append(torch.randn(shape, device=device))
-    x = torch.stack(xs)
-    return x
-
 def torch_gc():
     torch.cuda.empty_cache()
     torch.cuda.ipc_collect()
@@ -175,22 +118,8 @@ def load_GFPGAN():
     return GFPGANer(model_path=model_path, upscale=1, arch='clean', channel_multiplier=2, bg_upsampler=None)
 
 def load_RealESRGAN(model_name: str):
-    from basicsr.archs.rrdbnet_arch import RRDBNet
-    RealESRGAN_models = {
-        'RealESRGAN_x4plus': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
-        'RealESRGAN_x4plus_anime_6B': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
-    }
-
-    model_path = os.path.join(RealESRGAN_dir, 'experiments/pretrained_models', model_name + '.pth')
-    if not os.path.isfile(model_path):
-        raise Exception(model_name+".pth not found at path "+model_path)
-
-    sys.path.append(os.path.abspath(RealESRGAN_dir))
-    from realesrgan import RealESRGANer
-
-    instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_models[model_name], pre_pad=0, half=True)
-    instance.model.name = model_name
-    return instance
+    # cached per model and device, the upscaler worker gets the same instance
+    return get_RealESRGAN(RealESRGAN_dir, model_name)
 
 def try_loading_RealESRGAN(model_name: str):
     global RealESRGAN
@@ -206,6 +135,8 @@ def try_loading_RealESRGAN(model_name: str):
 def load_embeddings(fp, model):
     if fp is not None and hasattr(model, "embedding_manager"):
         model.embedding_manager.load(fp.name)
+        if hasattr(model.cond_stage_model, "clear_cache"):
+            model.cond_stage_model.clear_cache()
 
 def image_grid(imgs, batch_size, round_down=False, force_n_rows=None):
     if force_n_rows is not None:
@@ -368,223 +299,229 @@ def check_prompt_length(prompt, comments, model):
     comments.append(f"Warning: too many input tokens; some ({len(overflowing_words)}) have been truncated:\n{overflowing_text}\n")
 
 
+def weighted_subprompts(prompt, normalize_prompt_weights):
+    ''' split_weighted_subprompts as [(text, weight), ...] for get_conditioning '''
+    subprompts, weights = split_weighted_subprompts(prompt)
+    if len(subprompts) > 1 and normalize_prompt_weights:
+        # get total weight for normalizing, this gets weird if large negative values used
+        totalPromptWeight = sum(weights)
+        weights = [weight / totalPromptWeight for weight in weights]
+    return list(zip(subprompts, weights))
+
+
 async def process_images(
         outpath, func_init, func_sample, prompt, seed, sampler_name, skip_grid, skip_save, batch_size,
         n_iter, steps, cfg_scale, width, height, prompt_matrix, use_GFPGAN, use_RealESRGAN, realesrgan_model_name,
         fp, ddim_eta=0.0, do_not_save_grid=False, normalize_prompt_weights=True, init_img=None, init_mask=None,
         keep_mask=False, denoising_strength=0.75, resize_mode=None, uses_loopback=False,
-        uses_random_seed_loopback=False, sort_samples=True, write_info_files=True, jpg_sample=False, model=None, device=None, GFPGAN=None):
-    """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch"""
+        uses_random_seed_loopback=False, sort_samples=True, write_info_files=True, jpg_sample=False, model=None, device=None, GFPGAN=None,
+        batch_prompts=None, batch_seeds=None):
+    """this is the main loop that both txt2img and img2img use; it calls func_init once inside all the scopes and func_sample once per batch
+    batch_prompts and batch_seeds run a single batch with one prompt and seed per sample, used to merge compatible dreams"""
     assert prompt is not None
     torch_gc()
     # start time after garbage collection (or before?)
     start_time = time.time()
 
-    mem_mon = MemUsageMonitor('MemMon')
-    mem_mon.start()
-
-    if hasattr(model, "embedding_manager"):
-        load_embeddings(fp, model)
+    telemetry = get_telemetry(torch.device(device).index or 0)
+    usage = telemetry.begin_job()
+    try:
+        if hasattr(model, "embedding_manager"):
+            load_embeddings(fp, model)
 
-    os.makedirs(outpath, exist_ok=True)
+        os.makedirs(outpath, exist_ok=True)
 
-    sample_path = os.path.join(outpath, "samples")
-    os.makedirs(sample_path, exist_ok=True)
-    grid_count = len(os.listdir(outpath)) - 1
+        sample_path = os.path.join(outpath, "samples")
+        os.makedirs(sample_path, exist_ok=True)
+        grid_count = next_sequence_number(outpath, 'grid-')
 
-    comments = []
+        comments = []
 
-    prompt_matrix_parts = []
-    if prompt_matrix:
-        all_prompts = []
-        prompt_matrix_parts = prompt.split("|")
-        combination_count = 2 ** (len(prompt_matrix_parts) - 1)
-        for combination_num in range(combination_count):
-            current = prompt_matrix_parts[0]
+        prompt_matrix_parts = []
+        if prompt_matrix:
+            all_prompts = []
+            prompt_matrix_parts = prompt.split("|")
+            combination_count = 2 ** (len(prompt_matrix_parts) - 1)
+            for combination_num in range(combination_count):
+                current = prompt_matrix_parts[0]
 
-            for n, text in enumerate(prompt_matrix_parts[1:]):
-                print('for n, text in enumerate(prompt_matrix_parts[1:]):')
-                print(text)
-                if combination_num & (2 ** n) > 0:
-                    current += ("" if text.strip().startswith(",") else ", ") + text
+                for n, text in enumerate(prompt_matrix_parts[1:]):
+                    print('for n, text in enumerate(prompt_matrix_parts[1:]):')
+                    print(text)
+                    if combination_num & (2 ** n) > 0:
+                        current += ("" if text.strip().startswith(",") else ", ") + text
 
-            all_prompts.append(current)
+                all_prompts.append(current)
 
-        n_iter = math.ceil(len(all_prompts) / batch_size)
-        all_seeds = len(all_prompts) * [seed]
+            n_iter = math.ceil(len(all_prompts) / batch_size)
+            all_seeds = len(all_prompts) * [seed]
 
-        print(f"Prompt matrix will create {len(all_prompts)} images using a total of {n_iter} batches.")
-    else:
+            print(f"Prompt matrix will create {len(all_prompts)} images using a total of {n_iter} batches.")
+        else:
 
-        if not opt.no_verify_input:
-            try:
-                check_prompt_length(prompt, comments, model)
-            except:
-                import traceback
-                print("Error verifying input:", file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
+            if batch_prompts is not None:
+                all_prompts = list(batch_prompts)
+                all_seeds = list(batch_seeds)
+                batch_size = len(all_prompts)
+                n_iter = 1
+            else:
+                all_prompts = batch_size * n_iter * [prompt]
+                all_seeds = [seed + x for x in range(len(all_prompts))]
 
-        all_prompts = batch_size * n_iter * [prompt]
-        all_seeds = [seed + x for x in range(len(all_prompts))]
-
-    precision_scope = autocast if opt.precision == "autocast" else nullcontext
-    output_images = []
-    stats = []
-    with torch.no_grad(), precision_scope("cuda"), model.ema_scope():
-        init_data = func_init()
-        tic = time.time()
-
-        for n in range(n_iter):
-            prompts = all_prompts[n * batch_size:(n + 1) * batch_size]
-            seeds = all_seeds[n * batch_size:(n + 1) * batch_size]
-
-            uc = model.get_learned_conditioning(len(prompts) * [""])
-            if isinstance(prompts, tuple):
-                prompts = list(prompts)
-
-            # split the prompt if it has : for weighting
-            # TODO for speed it might help to have this occur when all_prompts filled??
-            subprompts,weights = split_weighted_subprompts(prompts[0])
-            # get total weight for normalizing, this gets weird if large negative values used
-            totalPromptWeight = sum(weights)
-
-            # sub-prompt weighting used if more than 1
-            if len(subprompts) > 1:
-                c = torch.zeros_like(uc) # i dont know if this is correct.. but it works
-                for i in range(0,len(subprompts)): # normalize each prompt and add it
-                    weight = weights[i]
-                    if normalize_prompt_weights:
-                        weight = weight / totalPromptWeight
-                    #print(f"{subprompts[i]} {weight*100.0}%")
-                    # note if alpha negative, it functions same as torch.sub
-                    c = torch.add(c,model.get_learned_conditioning(subprompts[i]), alpha=weight)
-            else: # just behave like usual
-                c = model.get_learned_conditioning(prompts)
-
-            shape = [opt_C, height // opt_f, width // opt_f]
-
-            # we manually generate all input noises because each one should have a specific seed
-            x = create_random_tensors([opt_C, height // opt_f, width // opt_f], seeds=seeds, device=device)
-            samples_ddim = func_sample(init_data=init_data, x=x, conditioning=c, unconditional_conditioning=uc, sampler_name=sampler_name)
-
-
-            x_samples_ddim = model.decode_first_stage(samples_ddim)
-            x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
-            for i, x_sample in enumerate(x_samples_ddim):
-                x_sample = 255. * rearrange(x_sample.cpu().numpy(), 'c h w -> h w c')
-                x_sample = x_sample.astype(np.uint8)
+            if not opt.no_verify_input:
+                try:
+                    for p in set(all_prompts):
+                        check_prompt_length(p, comments, model)
+                except:
+                    import traceback
+                    print("Error verifying input:", file=sys.stderr)
+                    print(traceback.format_exc(), file=sys.stderr)
 
-                if use_GFPGAN and GFPGAN is not None:
-                    cropped_faces, restored_faces, restored_img = GFPGAN.enhance(x_sample[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
-                    x_sample = restored_img[:,:,::-1]
+        precision_scope = autocast if opt.precision == "autocast" else nullcontext
+        output_images = []
+        stats = []
+        with torch.no_grad(), precision_scope("cuda"), model.ema_scope():
+            init_data = func_init()
+            tic = time.time()
 
-                if use_RealESRGAN and RealESRGAN is not None:
-                    if RealESRGAN.model.name != realesrgan_model_name:
-                        try_loading_RealESRGAN(realesrgan_model_name)
+            for n in range(n_iter):
+                prompts = all_prompts[n * batch_size:(n + 1) * batch_size]
+                seeds = all_seeds[n * batch_size:(n + 1) * batch_size]
 
-                    output, img_mode = RealESRGAN.enhance(x_sample[:,:,::-1])
-                    x_sample = output[:,:,::-1]
-
-                image = Image.fromarray(x_sample)
-                if init_mask:
-                    #init_mask = init_mask if keep_mask else ImageOps.invert(init_mask)
-                    init_mask = init_mask.filter(ImageFilter.GaussianBlur(3))
-                    init_mask = init_mask.convert('L')
-                    init_img = init_img.convert('RGB')
-                    image = image.convert('RGB')
-
-                    if use_RealESRGAN and RealESRGAN is not None:
-                        if RealESRGAN.model.name != realesrgan_model_name:
-                            try_loading_RealESRGAN(realesrgan_model_name)
-                        output, img_mode = RealESRGAN.enhance(np.array(init_img, dtype=np.uint8))
-                        init_img = Image.fromarray(output)
-                        init_img = init_img.convert('RGB')
+                with span('text_encoder', sync=True):
+                    uc = model.get_learned_conditioning(len(prompts) * [""])
+                    if isinstance(prompts, tuple):
+                        prompts = list(prompts)
 
-                        output, img_mode = RealESRGAN.enhance(np.array(init_mask, dtype=np.uint8))
-                        init_mask = Image.fromarray(output)
-                        init_mask = init_mask.convert('L')
+                    # every row gets the conditioning of its own prompt, merged dreams may differ
+                    c = get_conditioning(model, prompts, partial(weighted_subprompts, normalize_prompt_weights=normalize_prompt_weights))
 
-                    image = Image.composite(init_img, image, init_mask)
+                shape = [opt_C, height // opt_f, width // opt_f]
 
-                sanitized_prompt = prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})
-                if sort_samples:
-                    sanitized_prompt = sanitized_prompt[:128] #200 is too long
-                    sample_path_i = os.path.join(sample_path, sanitized_prompt)
-                    os.makedirs(sample_path_i, exist_ok=True)
-                    base_count = len(glob.glob(f"{sample_path_i}/*.png"))
-                    filename = f"{base_count:05}-{seeds[i]}"
-                else:
-                    sample_path_i = sample_path
-                    base_count = len(glob.glob(f"{sample_path_i}/*.png"))
-                    sanitized_prompt = sanitized_prompt
-                    filename = f"{base_count:05}-{seeds[i]}_{sanitized_prompt}"[:128] #same as before
-                if not skip_save:
-                    filename_i = os.path.join(sample_path_i, filename)
-                    if not jpg_sample:
-                        image.save(f"{filename_i}.png")
-                    else:
-                        image.save(f"{filename_i}.jpg", 'jpeg', quality=100, optimize=True)
-                    if write_info_files:
-                        # toggles differ for txt2img vs. img2img:
-                        offset = 0 if init_img is None else 2
-                        toggles = []
-                        if prompt_matrix:
-                            toggles.append(0)
-                        if normalize_prompt_weights:
-                            toggles.append(1)
-                        if init_img is not None:
-                            if uses_loopback:
-                                toggles.append(2)
-                            if uses_random_seed_loopback:
-                                toggles.append(3)
-                        if not skip_save:
-                            toggles.append(2 + offset)
-                        if not skip_grid:
-                            toggles.append(3 + offset)
-                        if sort_samples:
-                            toggles.append(4 + offset)
-                        if write_info_files:
-                            toggles.append(5 + offset)
-                        if use_GFPGAN:
-                            toggles.append(6 + offset)
-                        info_dict = dict(
-                            target="txt2img" if init_img is None else "img2img",
-                            prompt=prompts[i], ddim_steps=steps, toggles=toggles, sampler_name=sampler_name,
-                            ddim_eta=ddim_eta, n_iter=n_iter, batch_size=batch_size, cfg_scale=cfg_scale,
-                            seed=seed, width=width, height=height
-                        )
-                        if init_img is not None:
-                            # Not yet any use for these, but they bloat up the files:
-                            #info_dict["init_img"] = init_img
-                            #info_dict["init_mask"] = init_mask
-                            info_dict["denoising_strength"] = denoising_strength
-                            info_dict["resize_mode"] = resize_mode
-                        with open(f"{filename_i}.yaml", "w", encoding="utf8") as f:
-                            yaml.dump(info_dict, f)
-
-                output_images.append(image)
-                base_count += 1
-
-        if (prompt_matrix or not skip_grid) and not do_not_save_grid:
-            grid = image_grid(output_images, batch_size, round_down=prompt_matrix)
-
-            if prompt_matrix:
-                try:
-                    grid = draw_prompt_matrix(grid, width, height, prompt_matrix_parts)
-                except Exception:
-                    import traceback
-                    print("Error creating prompt_matrix text:", file=sys.stderr)
-                    print(traceback.format_exc(), file=sys.stderr)
+                # we manually generate all input noises because each one should have a specific seed
+                with span('noise', sync=True):
+                    x = create_random_tensors(shape, seeds=seeds, device=device, cpu=opt.cpu_noise)
+                # the step noise of ancestral samplers continues from the last seed drawn
+                with seeded_rng(seeds[-1], shape, device, cpu=opt.cpu_noise), span('sampling', sync=True):
+                    samples_ddim = func_sample(init_data=init_data, x=x, conditioning=c, unconditional_conditioning=uc, sampler_name=sampler_name)
 
-                output_images.insert(0, grid)
 
+                # decodes in micro-batches; sample i is copied to the host while the next ones decode
+                with span('vae_decode', sync=True):
+                    x_samples = list(first_stage_decoder(model.decode_first_stage, samples_ddim))
 
-            grid_file = f"grid-{grid_count:05}-{seed}_{prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.jpg"
-            grid.save(os.path.join(outpath, grid_file), 'jpeg', quality=100, optimize=True)
-            grid_count += 1
-        toc = time.time()
+                # faces and upscales for the whole batch at once
+                if use_GFPGAN and GFPGAN is not None:
+                    with span('gfpgan', sync=True):
+                        x_samples = postprocessor.restore_faces(GFPGAN, x_samples)
 
-    mem_max_used, mem_total = mem_mon.read_and_stop()
+                if use_RealESRGAN and RealESRGAN is not None:
+                    if RealESRGAN.model.name != realesrgan_model_name:
+                        try_loading_RealESRGAN(realesrgan_model_name)
+                    with span('realesrgan', sync=True):
+                        x_samples = postprocessor.upscale(RealESRGAN, x_samples)
+
+                for i, x_sample in enumerate(x_samples):
+                    image = Image.fromarray(x_sample)
+                    if init_mask:
+                        #init_mask = init_mask if keep_mask else ImageOps.invert(init_mask)
+                        init_mask = init_mask.filter(ImageFilter.GaussianBlur(3))
+                        init_mask = init_mask.convert('L')
+                        init_img = init_img.convert('RGB')
+                        image = image.convert('RGB')
+
+                        if use_RealESRGAN and RealESRGAN is not None:
+                            if RealESRGAN.model.name != realesrgan_model_name:
+                                try_loading_RealESRGAN(realesrgan_model_name)
+                            output, img_mode = RealESRGAN.enhance(np.array(init_img, dtype=np.uint8))
+                            init_img = Image.fromarray(output)
+                            init_img = init_img.convert('RGB')
+
+                            output, img_mode = RealESRGAN.enhance(np.array(init_mask, dtype=np.uint8))
+                            init_mask = Image.fromarray(output)
+                            init_mask = init_mask.convert('L')
+
+                        image = Image.composite(init_img, image, init_mask)
+
+                    sanitized_prompt = prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})
+                    if sort_samples:
+                        sanitized_prompt = sanitized_prompt[:128] #200 is too long
+                        sample_path_i = os.path.join(sample_path, sanitized_prompt)
+                        os.makedirs(sample_path_i, exist_ok=True)
+                        base_count = next_sequence_number(sample_path_i)
+                        filename = f"{base_count:05}-{seeds[i]}"
+                    else:
+                        sample_path_i = sample_path
+                        base_count = next_sequence_number(sample_path_i)
+                        sanitized_prompt = sanitized_prompt
+                        filename = f"{base_count:05}-{seeds[i]}_{sanitized_prompt}"[:128] #same as before
+                    if not skip_save:
+                        filename_i = os.path.join(sample_path_i, filename)
+                        # encoded and written in the background while the next batch samples
+                        if not jpg_sample:
+                            image_writer.submit(traced('encode_write', image.save), f"{filename_i}.png", paths=[f"{filename_i}.png"])
+                        else:
+                            image_writer.submit(traced('encode_write', image.save), f"{filename_i}.jpg", 'jpeg', quality=100, optimize=True, paths=[f"{filename_i}.jpg"])
+                        if write_info_files:
+                            # toggles differ for txt2img vs. img2img:
+                            offset = 0 if init_img is None else 2
+                            toggles = []
+                            if prompt_matrix:
+                                toggles.append(0)
+                            if normalize_prompt_weights:
+                                toggles.append(1)
+                            if init_img is not None:
+                                if uses_loopback:
+                                    toggles.append(2)
+                                if uses_random_seed_loopback:
+                                    toggles.append(3)
+                            if not skip_save:
+                                toggles.append(2 + offset)
+                            if not skip_grid:
+                                toggles.append(3 + offset)
+                            if sort_samples:
+                                toggles.append(4 + offset)
+                            if write_info_files:
+                                toggles.append(5 + offset)
+                            if use_GFPGAN:
+                                toggles.append(6 + offset)
+                            info_dict = dict(
+                                target="txt2img" if init_img is None else "img2img",
+                                prompt=prompts[i], ddim_steps=steps, toggles=toggles, sampler_name=sampler_name,
+                                ddim_eta=ddim_eta, n_iter=n_iter, batch_size=batch_size, cfg_scale=cfg_scale,
+                                seed=seed, width=width, height=height
+                            )
+                            if init_img is not None:
+                                # Not yet any use for these, but they bloat up the files:
+                                #info_dict["init_img"] = init_img
+                                #info_dict["init_mask"] = init_mask
+                                info_dict["denoising_strength"] = denoising_strength
+                                info_dict["resize_mode"] = resize_mode
+                            image_writer.submit(write_info_file, f"{filename_i}.yaml", info_dict)
+
+                    output_images.append(image)
+                    base_count += 1
+
+            if (prompt_matrix or not skip_grid) and not do_not_save_grid:
+                grid = image_grid(output_images, batch_size, round_down=prompt_matrix)
+
+                if prompt_matrix:
+                    try:
+                        grid = draw_prompt_matrix(grid, width, height, prompt_matrix_parts)
+                    except Exception:
+                        import traceback
+                        print("Error creating prompt_matrix text:", file=sys.stderr)
+                        print(traceback.format_exc(), file=sys.stderr)
+
+                    output_images.insert(0, grid)
+
+
+                grid_file = f"grid-{grid_count:05}-{seed}_{prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.jpg"
+                image_writer.submit(traced('encode_write', grid.save), os.path.join(outpath, grid_file), 'jpeg', quality=100, optimize=True, paths=[os.path.join(outpath, grid_file)])
+                grid_count += 1
+            toc = time.time()
+    finally:
+        usage = telemetry.end_job(usage)
     time_diff = time.time()-start_time
 
     info = f"""
@@ -592,13 +529,15 @@ async def process_images(
 Steps: {steps}, Sampler: {sampler_name}, CFG scale: {cfg_scale}, Seed: {seed}{', GFPGAN' if use_GFPGAN and GFPGAN is not None else ''}{', '+realesrgan_model_name if use_RealESRGAN and RealESRGAN is not None else ''}{', Prompt Matrix Mode.' if prompt_matrix else ''}""".strip()
     stats = f'''
 Took { round(time_diff, 2) }s total ({ round(time_diff/(len(all_prompts)),2) }s per image)
-Peak memory usage: { -(mem_max_used // -1_048_576) } MiB / { -(mem_total // -1_048_576) } MiB / { round(mem_max_used/mem_total*100, 3) }%'''
+{format_usage(usage)}'''
+    # the worker's trace, its stages so far
+    trace = current_trace.get()
+    if trace is not None:
+        stats += f"\n{trace.summary()}"
 
     for comment in comments:
         info += "\n\n" + comment
 
-    #mem_mon.stop()
-    #del mem_mon
     torch_gc()
 
     return output_images, seed, info, stats
@@ -610,7 +549,7 @@ Peak memory usage: { -(mem_max_used // -1_048_576) } MiB / { -(mem_total // -1_0
 #            height: int, width: int, fp):
 async def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List[int], realesrgan_model_name: str,
             ddim_eta: float, n_iter: int, batch_size: int, cfg_scale: float, seed: Union[int, str, None],
-            height: int, width: int, fp, model, device, GFPGAN):
+            height: int, width: int, fp, cfg_sigma, model, device, GFPGAN, prompts=None, seeds=None):
     outpath = opt.outdir_txt2img or opt.outdir or "outputs/txt2img-samples"
     err = False
     seed = seed_to_int(seed)
@@ -625,30 +564,14 @@ async def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List
     use_GFPGAN = 7 in toggles
     use_RealESRGAN = 8 in toggles
 
-    if sampler_name == 'PLMS':
-        sampler = PLMSSampler(model)
-    elif sampler_name == 'DDIM':
-        sampler = DDIMSampler(model)
-    elif sampler_name == 'k_dpm_2_a':
-        sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-    elif sampler_name == 'k_dpm_2':
-        sampler = KDiffusionSampler(model,'dpm_2')
-    elif sampler_name == 'k_euler_a':
-        sampler = KDiffusionSampler(model,'euler_ancestral')
-    elif sampler_name == 'k_euler':
-        sampler = KDiffusionSampler(model,'euler')
-    elif sampler_name == 'k_heun':
-        sampler = KDiffusionSampler(model,'heun')
-    elif sampler_name == 'k_lms':
-        sampler = KDiffusionSampler(model,'lms')
-    else:
-        raise Exception("Unknown sampler: " + sampler_name)
+    sampler = get_sampler(model, sampler_name)
+    cfg_interval = guidance_interval(*cfg_sigma)
 
     def init():
         pass
 
     def sample(init_data, x, conditioning, unconditional_conditioning, sampler_name):
-        samples_ddim, _ = sampler.sample(S=ddim_steps, conditioning=conditioning, batch_size=int(x.shape[0]), shape=x[0].shape, verbose=False, unconditional_guidance_scale=cfg_scale, unconditional_conditioning=unconditional_conditioning, eta=ddim_eta, x_T=x)
+        samples_ddim, _ = sampler.sample(S=ddim_steps, conditioning=conditioning, batch_size=int(x.shape[0]), shape=x[0].shape, verbose=False, unconditional_guidance_scale=cfg_scale, unconditional_conditioning=unconditional_conditioning, eta=ddim_eta, x_T=x, cfg_interval=cfg_interval)
         return samples_ddim
 
     try:
@@ -679,7 +602,9 @@ async def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List
             jpg_sample=jpg_sample,
             model=model,
             device=device,
-            GFPGAN=GFPGAN
+            GFPGAN=GFPGAN,
+            batch_prompts=prompts,
+            batch_seeds=seeds
         )
 
         del sampler
@@ -706,7 +631,7 @@ class Flagging(gr.FlaggingCallback):
         os.makedirs("log/images", exist_ok=True)
 
         # those must match the "txt2img" function !! + images, seed, comment, stats !! NOTE: changes to UI output must be reflected here too
-        prompt, ddim_steps, sampler_name, toggles, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, images, seed, comment, stats = flag_data
+        prompt, ddim_steps, sampler_name, toggles, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, cfg_sigma, images, seed, comment, stats = flag_data
 
         filenames = []
 
@@ -756,22 +681,7 @@ async def img2img(prompt: str, image_editor_mode: str, init_info, mask_mode: str
     use_GFPGAN = 9 in toggles
     use_RealESRGAN = 10 in toggles
 
-    if sampler_name == 'DDIM':
-        sampler = DDIMSampler(model)
-    elif sampler_name == 'k_dpm_2_a':
-        sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-    elif sampler_name == 'k_dpm_2':
-        sampler = KDiffusionSampler(model,'dpm_2')
-    elif sampler_name == 'k_euler_a':
-        sampler = KDiffusionSampler(model,'euler_ancestral')
-    elif sampler_name == 'k_euler':
-        sampler = KDiffusionSampler(model,'euler')
-    elif sampler_name == 'k_heun':
-        sampler = KDiffusionSampler(model,'heun')
-    elif sampler_name == 'k_lms':
-        sampler = KDiffusionSampler(model,'lms')
-    else:
-        raise Exception("Unknown sampler: " + sampler_name)
+    sampler = get_sampler(model, sampler_name)
 
     if image_editor_mode == 'Mask':
         init_img = init_info["image"]
@@ -882,10 +792,10 @@ async def img2img(prompt: str, image_editor_mode: str, init_info, mask_mode: str
                 history.append(init_img)
 
             if not skip_grid:
-                grid_count = len(os.listdir(outpath)) - 1
+                grid_count = next_sequence_number(outpath, 'grid-')
                 grid = image_grid(history, batch_size, force_n_rows=1)
                 grid_file = f"grid-{grid_count:05}-{seed}_{prompt.replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.jpg"
-                grid.save(os.path.join(outpath, grid_file), 'jpeg', quality=100, optimize=True)
+                image_writer.save(grid, os.path.join(outpath, grid_file), 'jpeg', quality=100, optimize=True)
 
 
             output_images = history
@@ -1047,8 +957,19 @@ def copy_img_to_input(selected=1, imgs = []):
         return [None, None]
 
 class SyncDiffusionWorker():
-    def __init__(self, ckpt):
+    def __init__(self, ckpt, device=None):
         self.ckpt = ckpt
+
+        print(f'torch.cuda.is_available(): {torch.cuda.is_available()}')
+        print(f'torch.cuda.device_count(): {torch.cuda.device_count()}')
+
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        device = torch.device(device)
+        if device.type == 'cuda':
+            # load_model_from_config, GFPGAN and RealESRGAN all place their weights on the current device
+            torch.cuda.set_device(device)
+
         GFPGAN = None
         if os.path.exists(GFPGAN_dir):
             try:
@@ -1062,17 +983,7 @@ class SyncDiffusionWorker():
         RealESRGAN = None
         try_loading_RealESRGAN('RealESRGAN_x4plus')
 
-        config = OmegaConf.load("configs/stable-diffusion/v1-inference.yaml")
-
-        model = load_model_from_config(config, self.ckpt['path'])
-
-        gpu_ids = [0, 1]
-
-        print(f'torch.cuda.is_available(): {torch.cuda.is_available()}')
-        print(f'torch.cuda.device_count(): {torch.cuda.device_count()}')
-
-        device = torch.device(f"cuda:{gpu_ids[0]}") if torch.cuda.is_available() else torch.device("cpu")
-        model = (model if opt.no_half else model.half()).to(device)
+        model = load_ckpt(self.ckpt, device)
 
 
         if opt.defaults is not None and os.path.isfile(opt.defaults):
@@ -1181,17 +1092,55 @@ class SyncDiffusionWorker():
         self.GFPGAN = GFPGAN
 
 
+    async def swap(self, ckpt):
+        print(f'Worker: swap: {self.ckpt["name"]} -> {ckpt["name"]}')
+        del self.model
+        self.model = None
+        torch_gc()
+        self.model = load_ckpt(ckpt, self.device)
+        self.ckpt = ckpt
+
     async def dreaming(self, dream):
         print(dream)
-        response = await txt2img(*dream[1], self.model, self.device, self.GFPGAN)
+        trace = Trace('dream', device=str(self.device), dreams=1)
+        token = current_trace.set(trace)
+        try:
+            response = await txt2img(*dream[1], self.model, self.device, self.GFPGAN)
+        finally:
+            current_trace.reset(token)
+            trace.finish()
         # response =  output_images, seed, info, stats
         print(response)
         return response
 
+    async def dreaming_batch(self, dreams):
+        ''' runs compatible dreams as one batch and returns one response per dream '''
+        if len(dreams) == 1:
+            return [await self.dreaming(dreams[0])]
+        prompts = [dream[1][0] for dream in dreams]
+        seeds = [seed_to_int(dream[1][9]) for dream in dreams]
+        print(f'Worker: dreaming_batch: {len(dreams)} dreams')
+        trace = Trace('dream', device=str(self.device), dreams=len(dreams))
+        token = current_trace.set(trace)
+        try:
+            output_images, seed, info, stats = await txt2img(*dreams[0][1], self.model, self.device, self.GFPGAN, prompts=prompts, seeds=seeds)
+        finally:
+            current_trace.reset(token)
+            trace.finish()
+        if len(output_images) < len(dreams):
+            raise Exception(f'dreaming_batch: got {len(output_images)} images for {len(dreams)} dreams / {stats}')
+        return [([output_images[i]], seeds[i], info, stats) for i in range(len(dreams))]
+
     async def upsclaing(self, filename):
-        img = Image.open(filename)
+        trace = Trace('upscale', device=str(self.device))
+        with trace.span('load'):
+            img = Image.open(filename)
+            img.load()
         model_name = 'RealESRGAN_x4plus'
-        response = run_RealESRGAN(img, model_name)
+        with trace.span('realesrgan', sync=True):
+            response = run_RealESRGAN(img, model_name)
+        trace.finish()
+        print(trace.summary())
         print(response)
         return response
 
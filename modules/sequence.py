@@ -0,0 +1,68 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+# sidecar database in every output directory that keeps the next free sequence number per prefix
+SEQUENCE_DB = '.sequence.sqlite'
+
+lock = threading.Lock()
+# open connections of the most recently used directories; sorted samples make a directory
+# per prompt, so the rest are closed instead of holding a file descriptor each
+connections = OrderedDict()
+MAX_CONNECTIONS = 16
+
+
+def scan_sequence_number(path, prefix='', pending=()):
+    '''
+    the next sequence number from the file names in path, used once to seed the counter;
+    names in pending are counted as if they were already written
+    '''
+    result = -1
+    for name in list(os.listdir(path)) + list(pending):
+        if name.endswith(('.png', '.jpg', '.webp')) and name.startswith(prefix):
+            tmp = name[len(prefix):]
+            try:
+                result = max(int(tmp.split('-')[0]), result)
+            except ValueError:
+                pass
+    return result + 1
+
+
+def connect(path):
+    key = os.path.abspath(path)
+    if key not in connections:
+        # isolation_level=None: transactions are opened explicitly with BEGIN IMMEDIATE
+        conn = sqlite3.connect(os.path.join(key, SEQUENCE_DB), timeout=30, isolation_level=None, check_same_thread=False)
+        # the reservation only has to be atomic, not durable against power loss
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('CREATE TABLE IF NOT EXISTS sequence (prefix TEXT PRIMARY KEY, next INTEGER NOT NULL)')
+        connections[key] = conn
+        while len(connections) > MAX_CONNECTIONS:
+            _, old = connections.popitem(last=False)
+            old.close()
+    connections.move_to_end(key)
+    return connections[key]
+
+
+def next_sequence_number(path, prefix='', count=1, pending=()):
+    '''
+    reserves count consecutive sequence numbers for files in path and returns the first one.
+    The counter lives in a sqlite file in path and is updated under a write lock, so jobs
+    in other threads and processes never get the same number. The directory is scanned only
+    the first time a prefix is used there.
+    '''
+    os.makedirs(path, exist_ok=True)
+    with lock:
+        conn = connect(path)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT next FROM sequence WHERE prefix = ?', (prefix,)).fetchone()
+            result = row[0] if row is not None else scan_sequence_number(path, prefix, pending)
+            conn.execute('INSERT OR REPLACE INTO sequence (prefix, next) VALUES (?, ?)', (prefix, result + count))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    return result
@@ -0,0 +1,205 @@
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+@dataclass
+class Sample:
+    time: float
+    used: int
+    total: int
+    utilization: Optional[float] = None
+
+
+@dataclass(eq=False)
+class JobUsage:
+    ''' what one job used: the device peak over its time window, and the growth of torch's peak allocation '''
+    start: float
+    baseline_allocated: int = 0
+    end: Optional[float] = None
+    peak_used: int = 0
+    peak_allocated: int = 0
+    total: int = 0
+
+
+def loaded_torch():
+    # torch counters only where torch is already loaded, the bot process should not import it for this
+    return sys.modules.get('torch')
+
+
+def nvml_device_index(device_index):
+    # pynvml does not listen to CUDA_VISIBLE_DEVICES, the torch index is a position in that list
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES", "").split(',')
+    try:
+        return int(visible[device_index])
+    except (IndexError, ValueError):
+        return device_index
+
+
+class Telemetry(threading.Thread):
+    '''
+    one thread per process that samples device memory and utilization into a ring buffer, so
+    concurrent jobs read the same samples instead of each polling the device. Reads NVML when it
+    is there, otherwise torch's cuda counters, otherwise system memory and cpu load from psutil.
+    '''
+    def __init__(self, device_index=0, interval=0.1, history=3000):
+        super().__init__(name=f'Telemetry-{device_index}', daemon=True)
+        self.device_index = device_index
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self.lock = threading.Lock()
+        # jobs that raised never call end_job, they drop out of the set when collected
+        self.active_jobs = weakref.WeakSet()
+        self.source = self.open_source()
+
+    def open_source(self):
+        if pynvml is not None:
+            try:
+                pynvml.nvmlInit()
+                self.handle = pynvml.nvmlDeviceGetHandleByIndex(nvml_device_index(self.device_index))
+                return 'nvml'
+            except Exception as e:
+                print(f"[Telemetry] Unable to initialize NVIDIA management ({e}), falling back to other counters")
+        if self.cuda_counters() and hasattr(loaded_torch().cuda, 'mem_get_info'):
+            return 'torch'
+        if psutil is not None:
+            return 'psutil'
+        return None
+
+    def read(self):
+        ''' a fresh sample from the device, or None without a source '''
+        now = time.time()
+        if self.source == 'nvml':
+            memory = pynvml.nvmlDeviceGetMemoryInfo(self.handle)
+            utilization = pynvml.nvmlDeviceGetUtilizationRates(self.handle).gpu
+            return Sample(now, memory.used, memory.total, utilization)
+        if self.source == 'torch':
+            free, total = loaded_torch().cuda.mem_get_info(self.device_index)
+            return Sample(now, total - free, total)
+        if self.source == 'psutil':
+            memory = psutil.virtual_memory()
+            return Sample(now, memory.used, memory.total, psutil.cpu_percent())
+        return None
+
+    def sample(self):
+        sample = self.read()
+        if sample is not None:
+            with self.lock:
+                self.samples.append(sample)
+        return sample
+
+    def run(self):
+        if self.source is None:
+            print("[Telemetry] No memory counters available, memory stats will be empty")
+            return
+        while True:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"[Telemetry] Stopped sampling: {e}")
+                return
+            time.sleep(self.interval)
+
+    def window(self, start, end=None):
+        ''' the samples taken between start and end '''
+        end = end or time.time()
+        with self.lock:
+            return [s for s in self.samples if start <= s.time <= end]
+
+    def cuda_counters(self):
+        torch = loaded_torch()
+        return torch is not None and torch.cuda.is_available()
+
+    def begin_job(self):
+        ''' starts attributing usage to a job, pass the result to end_job '''
+        usage = JobUsage(start=time.time())
+        if self.cuda_counters():
+            torch = loaded_torch()
+            with self.lock:
+                # only a job that starts alone may reset torch's peak, overlapping jobs share it
+                if not self.active_jobs:
+                    torch.cuda.reset_peak_memory_stats(self.device_index)
+                self.active_jobs.add(usage)
+            usage.baseline_allocated = torch.cuda.memory_allocated(self.device_index)
+        self.sample()
+        return usage
+
+    def end_job(self, usage):
+        ''' fills in the peaks of a job from begin_job and returns it '''
+        last = self.sample()
+        usage.end = time.time()
+        samples = self.window(usage.start, usage.end)
+        usage.peak_used = max((s.used for s in samples), default=0)
+        usage.total = last.total if last is not None else 0
+        if self.cuda_counters():
+            torch = loaded_torch()
+            usage.peak_allocated = max(torch.cuda.max_memory_allocated(self.device_index) - usage.baseline_allocated, 0)
+            with self.lock:
+                self.active_jobs.discard(usage)
+        return usage
+
+    def summary(self, seconds=60.0):
+        ''' the latest sample and the peak of the last seconds, as a json-able dict '''
+        samples = self.window(time.time() - seconds)
+        last = samples[-1] if samples else None
+        return {
+            'source': self.source,
+            'device': self.device_index,
+            'used': last.used if last else 0,
+            'total': last.total if last else 0,
+            'utilization': last.utilization if last else None,
+            'peak_used': max((s.used for s in samples), default=0),
+            'window_seconds': seconds,
+        }
+
+
+def mib(size):
+    return -(size // -1_048_576)
+
+
+def format_summary(summary):
+    ''' one line for the ui and the bot '''
+    if summary['source'] is None:
+        return "memory: no counters available"
+    text = f"memory ({summary['source']}): {mib(summary['used'])} MiB / {mib(summary['total'])} MiB, peak {mib(summary['peak_used'])} MiB over {summary['window_seconds']:.0f}s"
+    if summary['utilization'] is not None:
+        text += f", utilization {summary['utilization']}%"
+    return text
+
+
+def format_usage(usage):
+    ''' the peak memory line of the stats output '''
+    if not usage.total:
+        return "Peak memory usage: not available"
+    text = f"Peak memory usage: { mib(usage.peak_used) } MiB / { mib(usage.total) } MiB / { round(usage.peak_used/usage.total*100, 3) }%"
+    if usage.peak_allocated:
+        text += f", { mib(usage.peak_allocated) } MiB allocated by torch"
+    return text
+
+
+telemetry = {}
+lock = threading.Lock()
+
+
+def get_telemetry(device_index=0):
+    ''' the telemetry thread of device_index in this process, started on first use '''
+    with lock:
+        if device_index not in telemetry:
+            telemetry[device_index] = Telemetry(device_index)
+            telemetry[device_index].start()
+        return telemetry[device_index]
@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from modules.telemetry import loaded_torch
+
+
+log_path = None
+log_lock = threading.Lock()
+# synced stages wait for the gpu only while profiling, waiting stalls the host on every stage
+profiling = False
+
+
+def set_trace_log(path, profile=None):
+    '''
+    every finished trace is appended to path as one json line; None keeps them in memory only.
+    profile turns on waiting for the gpu in synced stages, by default whenever there is a log
+    '''
+    global log_path, profiling
+    log_path = path
+    profiling = path is not None if profile is None else profile
+
+
+def synchronize():
+    # gpu work is asynchronous, a stage only ends when the device is done with it
+    if not profiling:
+        return
+    torch = loaded_torch()
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+class Trace:
+    '''
+    stage timings of one request. span() times a stage on the calling thread; time spent in a
+    nested span is taken off its parent, so the stages add up to the traced time. wrap() times
+    work the request hands to other threads, like image writes; the trace is logged once it is
+    finished and the last of that work is done.
+    '''
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.end = None
+        self.stages = {}
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add(self, name, seconds):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0.0, 0])
+            stage[0] += seconds
+            stage[1] += 1
+
+    @contextmanager
+    def span(self, name, sync=False):
+        ''' times the body as stage name; sync waits for the gpu before and after while profiling, for stages that queue cuda work '''
+        stack = self.local.__dict__.setdefault('stack', [])
+        if sync:
+            synchronize()
+        children = [0.0]
+        stack.append(children)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if sync:
+                synchronize()
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1][0] += elapsed
+            self.add(name, elapsed - children[0])
+
+    def wrap(self, name, fn):
+        ''' fn timed as stage name on whichever thread runs it, for work handed to a pool; the trace is not logged before it ran '''
+        with self.lock:
+            self.pending += 1
+
+        def run(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+                with self.lock:
+                    self.pending -= 1
+                    done = self.end is not None and self.pending == 0
+                if done:
+                    self.write()
+        return run
+
+    def finish(self):
+        ''' ends the request, logs the trace now or when its background work is done '''
+        with self.lock:
+            self.end = time.time()
+            done = self.pending == 0
+        if done:
+            self.write()
+        return self
+
+    def summary(self):
+        ''' the stages, slowest first, for the stats output '''
+        with self.lock:
+            stages = sorted(self.stages.items(), key=lambda stage: -stage[1][0])
+        return 'Stages: ' + ', '.join(f"{name} {seconds:.2f}s" + (f" ({count}x)" if count > 1 else '') for name, (seconds, count) in stages)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'start': self.start,
+                'total': round((self.end or time.time()) - self.start, 4),
+                'attributes': self.attributes,
+                'stages': {name: {'seconds': round(seconds, 4), 'count': count} for name, (seconds, count) in self.stages.items()},
+            }
+
+    def write(self):
+        if log_path is None:
+            return
+        line = json.dumps(self.to_dict(), default=str)
+        with log_lock:
+            with open(log_path, 'a', encoding='utf8') as f:
+                f.write(line + '\n')
+
+
+# the trace of the request running in this context, so helpers deep in the pipeline can add stages
+current_trace = ContextVar('current_trace', default=None)
+
+
+def span(name, sync=False):
+    ''' Trace.span on the current trace, a no-op outside of one '''
+    trace = current_trace.get()
+    return trace.span(name, sync) if trace is not None else nullcontext()
+
+
+def traced(name, fn):
+    ''' Trace.wrap on the current trace, fn itself outside of one '''
+    trace = current_trace.get()
+    return trace.wrap(name, fn) if trace is not None else fn
@@ -0,0 +1,71 @@
+import os
+import sys
+import threading
+
+import torch
+
+
+# RealESRGANer instances by (model name, device, half), shared by everything in the process
+instances = {}
+lock = threading.Lock()
+
+
+def RealESRGAN_arch(model_name):
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    if model_name == 'RealESRGAN_x4plus':
+        return RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+    if model_name == 'RealESRGAN_x4plus_anime_6B':
+        return RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
+    raise KeyError(model_name)
+
+
+def RealESRGAN_path(model_dir, model_name):
+    return os.path.join(model_dir, 'experiments/pretrained_models', model_name + '.pth')
+
+
+def load_RealESRGAN(model_dir, model_name, device, half):
+    ''' builds a RealESRGANer and reads its weights from disk, use get_RealESRGAN to reuse one '''
+    model_path = RealESRGAN_path(model_dir, model_name)
+    if not os.path.isfile(model_path):
+        raise Exception(model_name+".pth not found at path "+model_path)
+    sys.path.append(os.path.abspath(model_dir))
+    from realesrgan import RealESRGANer
+
+    if device.type == 'cuda':
+        instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_arch(model_name), pre_pad=0, half=half, gpu_id=device.index)
+    else:
+        instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_arch(model_name), pre_pad=0, half=False)
+        instance.device = device
+        instance.model.to(device)
+    instance.model.name = model_name
+    return instance
+
+
+def RealESRGAN_key(model_name, device=None, half=True):
+    if device is None:
+        device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() else torch.device('cpu')
+    device = torch.device(device)
+    # cpu does not support half
+    return model_name, device, half and device.type == 'cuda'
+
+
+def get_RealESRGAN(model_dir, model_name, device=None, half=True):
+    '''
+    the RealESRGANer for model_name on device, loaded from disk only the first time a
+    (model name, device, half) combination is asked for; device None is the current device
+    '''
+    key = RealESRGAN_key(model_name, device, half)
+    with lock:
+        if key not in instances:
+            instances[key] = load_RealESRGAN(model_dir, *key)
+            print(f"Loaded RealESRGAN with model {model_name} on {key[1]}")
+        return instances[key]
+
+
+def forget_RealESRGAN(model_name=None, device=None, half=True):
+    ''' drops cached instances, all of them when model_name is None '''
+    with lock:
+        if model_name is None:
+            instances.clear()
+        else:
+            instances.pop(RealESRGAN_key(model_name, device, half), None)
@@ -13,6 +13,7 @@ from pytorch_lightning import seed_everything
 from torch import autocast
 from contextlib import contextmanager, nullcontext
 from ldm.util import instantiate_from_config
+from ldm.checkpoint import load_state_dict
 
 
 def chunk(it, size):
@@ -22,11 +23,8 @@ def chunk(it, size):
 
 def load_model_from_config(ckpt, verbose=False):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    return sd
+    # a plain dict, the keys are renamed in place below
+    return dict(load_state_dict(ckpt, cache=not opt.no_ckpt_cache))
 
 
 config = "optimizedSD/v1-inference.yaml"
@@ -141,6 +139,11 @@ parser.add_argument(
     action='store_true',
     help="Reduce inference time when generate a smaller batch of images",
 )
+parser.add_argument(
+    "--no-ckpt-cache",
+    action='store_true',
+    help="do not write a faster to load copy of .ckpt checkpoints next to them",
+)
 parser.add_argument(
     "--precision",
     type=str,
@@ -112,6 +112,7 @@ def main():
 	from helpers import DepthModel, sampler_fn
 	from k_diffusion.external import CompVisDenoiser
 	from ldm.util import instantiate_from_config
+	from ldm.checkpoint import load_model
 	from ldm.models.diffusion.ddim import DDIMSampler
 	from ldm.models.diffusion.plms import PLMSSampler
 
@@ -565,27 +566,8 @@ def main():
 	    print(f"Using ckpt: {ckpt_path}")
 
 	def load_model_from_config(config, ckpt, verbose=False, device='cuda', half_precision=True):
-	    map_location = "cuda" #@param ["cpu", "cuda"]
-	    print(f"Loading model from {ckpt}")
-	    pl_sd = torch.load(ckpt, map_location=map_location)
-	    if "global_step" in pl_sd:
-	        print(f"Global Step: {pl_sd['global_step']}")
-	    sd = pl_sd["state_dict"]
-	    model = instantiate_from_config(config.model)
-	    m, u = model.load_state_dict(sd, strict=False)
-	    if len(m) > 0 and verbose:
-	        print("missing keys:")
-	        print(m)
-	    if len(u) > 0 and verbose:
-	        print("unexpected keys:")
-	        print(u)
-
-	    if half_precision:
-	        model = model.half().to(device)
-	    else:
-	        model = model.to(device)
-	    model.eval()
-	    return model
+	    # builds the model without weight init and streams the cached checkpoint straight into device and dtype
+	    return load_model(config, ckpt, device=device, half=half_precision, verbose=verbose)
 
 	if load_on_run_all and ckpt_valid:
 	    local_config = OmegaConf.load(f"{ckpt_config_path}")
@@ -14,8 +14,7 @@ import numpy as np
 import time
 import torch
 import skimage
-from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.models.diffusion.plms import PLMSSampler
+from modules.samplers import get_sampler
 # Temp imports 
 
 
@@ -64,24 +63,7 @@ def img2img(prompt: str = '', init_info: any = None, init_info_mask: any = None,
 	#use_GFPGAN = 10 in toggles
 	#use_RealESRGAN = 11 in toggles
 
-	if sampler_name == 'PLMS':
-		sampler = PLMSSampler(st.session_state["model"])
-	elif sampler_name == 'DDIM':
-		sampler = DDIMSampler(st.session_state["model"])
-	elif sampler_name == 'k_dpm_2_a':
-		sampler = KDiffusionSampler(st.session_state["model"],'dpm_2_ancestral')
-	elif sampler_name == 'k_dpm_2':
-		sampler = KDiffusionSampler(st.session_state["model"],'dpm_2')
-	elif sampler_name == 'k_euler_a':
-		sampler = KDiffusionSampler(st.session_state["model"],'euler_ancestral')
-	elif sampler_name == 'k_euler':
-		sampler = KDiffusionSampler(st.session_state["model"],'euler')
-	elif sampler_name == 'k_heun':
-		sampler = KDiffusionSampler(st.session_state["model"],'heun')
-	elif sampler_name == 'k_lms':
-		sampler = KDiffusionSampler(st.session_state["model"],'lms')
-	else:
-		raise Exception("Unknown sampler: " + sampler_name)
+	sampler = get_sampler(st.session_state["model"], sampler_name)
 
 	def process_init_mask(init_mask: Image):
 		if init_mask.mode == "RGBA":
@@ -4,11 +4,17 @@ import asyncio
 import time
 from io import BytesIO
 from multiprocessing import Process, Queue
+from functools import partial
 from threading import Thread
 
+import torch
+
 from modules.sdb_shared import opt, processes, cpkts
+from modules.sdb_dispatch import QueueBridge
+from modules.image_writer import save_sized
+from modules.sdb_pool import SyncDiffusionPool, find_ckpt, pool_launch
 from modules.sdb_upscaler import SyncDiffusionUpscaler
-from modules.sdb_utils import SyncDiffusionWorker
+from modules.sdb_utils import SyncDiffusionWorker, image_writer
 from modules.sdb_discord import SyncDiffusionBot, SyncDiffusionCog
 
 from PIL import Image, ImageFont, ImageDraw, ImageFilter, ImageOps
@@ -22,7 +28,7 @@ load_dotenv()
 
 
 
-def bot_launch(dream_queue, awaken_queue, message_queue, upscale_queue, out_dir, restart_queue):
+def bot_launch(dream_queue, awaken_queue, message_queue, upscale_queue, upscaled_queue, out_dir, restart_queue, pool=None):
     retry_count = 0
     while True:
         try:
@@ -31,7 +37,7 @@ def bot_launch(dream_queue, awaken_queue, message_queue, upscale_queue, out_dir,
             print('bot_launch: start bot')
             bot = SyncDiffusionBot(dream_queue, awaken_queue, message_queue)
             
-            loop.run_until_complete(bot.add_cog(SyncDiffusionCog(bot, dream_queue, awaken_queue, message_queue, upscale_queue, out_dir, restart_queue)))
+            loop.run_until_complete(bot.add_cog(SyncDiffusionCog(bot, dream_queue, awaken_queue, message_queue, upscale_queue, upscaled_queue, out_dir, restart_queue, pool)))
             loop.run_until_complete(bot.start(token=TOKEN))
             raise Exception('bot_launch: stop bot')
         except Exception as e:
@@ -44,29 +50,23 @@ def bot_launch(dream_queue, awaken_queue, message_queue, upscale_queue, out_dir,
                 break
             time.sleep(retry_count * 2 ** 3)
 
-async def save_file(response, out_dir):
-    try:
-        print(f'save_file: response: {str(response)}')
-        now = int(time.time())
-
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-
-        filename = f'{now}_{response[1]}'
-        image = response[0][0]
-        fileio = BytesIO()
-        image.save(fileio, 'PNG')
-        file_size = fileio.tell()
-        fileio.seek(0)
-        if file_size < 6000000:
-            filename = filename + '.png'   
-            image.save(f'{out_dir}\{filename}', 'PNG')
-        else:
-            filename = filename + '.jpg'   
-            image.save(f'{out_dir}\{filename}', 'JPEG')
-
-        return filename
+def save_file(response, out_dir):
+    ''' runs on the image writer; encodes the image once, as png or as jpg when the png is too large '''
+    print(f'save_file: response: {str(response)}')
+    now = int(time.time())
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+
+    filename = f'{now}_{response[1]}'
+    return filename + save_sized(response[0][0], f'{out_dir}\{filename}', 6000000)
 
+
+def awaken_saved(future, dream, stats, awaken_queue, message_queue):
+    try:
+        dream.append(future.result())
+        dream.append(stats)
+        awaken_queue.put(dream)
     except Exception as e:
         message = f'worker: save_file: has error: {e}'
         print(message)
@@ -74,40 +74,39 @@ async def save_file(response, out_dir):
 
 
 
-async def worker_loop(dream_queue, awaken_queue, message_queue, worker, out_dir, dream=None):
+async def worker_loop(inbox, awaken_queue, message_queue, ready_queue, index, worker, out_dir, dream=None):
     dream = None
+    dreams = QueueBridge(inbox, f'inbox_{index}')
     while True:
         try:
-#            print(f'Worker: worker_loop: dream_queue / {dream_queue.qsize()}')
-            if not dream_queue.empty():
-#                print(f'Worker {worker.ckpt["name"]}: worker_loop: dream_queue is found! / {dream_queue.qsize()}')
-                dream = dream_queue.get()
-#                print(f'----------------------')
-                response = await worker.dreaming(dream)
-                filename = await save_file(response, out_dir)
-                dream.append(filename)
-                dream.append(response[3])
-                awaken = dream
-                awaken_queue.put(awaken)
-            else:
-    #            print('Dream Queue is empty!')
-                await asyncio.sleep(0.2)
+            # tell the pool which checkpoint is loaded; it only hands us work when we are idle
+            ready_queue.put([index, worker.ckpt['name']])
+            batch, ckpt = await dreams.get()
+            if ckpt['name'] != worker.ckpt['name']:
+                await worker.swap(ckpt)
+            # the pool merges compatible dreams, they run as one sampler call
+            responses = await worker.dreaming_batch(batch)
+            # encoding and writing happen on the image writer, the next batch can start right away
+            for dream, response in zip(batch, responses):
+                future = image_writer.submit(save_file, response, out_dir)
+                future.add_done_callback(partial(awaken_saved, dream=dream, stats=response[3], awaken_queue=awaken_queue, message_queue=message_queue))
         except Exception as e:
             message = f'Worker {worker.ckpt["name"]}: worker_loop: has error: {e}'
             print(message)
             message_queue.put(message)
+            dreams.close()
             raise
 
-def worker_launch(dream_queue, awaken_queue, message_queue, ckpt, out_dir):
+def worker_launch(inbox, awaken_queue, message_queue, ready_queue, index, ckpt, device, out_dir):
     retry_count = 0
     dream = None
     while True:
         try:
             loop = asyncio.get_event_loop()
-            print('Worker: worker_launch: start worker')
-            worker = SyncDiffusionWorker(ckpt)
+            print(f'Worker: worker_launch: start worker {index} on {device}')
+            worker = SyncDiffusionWorker(ckpt, device)
             print(f'Worker: worker_launch: {worker.ckpt["name"]} launched')
-            loop.run_until_complete(worker_loop(dream_queue, awaken_queue, message_queue, worker, out_dir, dream))
+            loop.run_until_complete(worker_loop(inbox, awaken_queue, message_queue, ready_queue, index, worker, out_dir, dream))
         except Exception as e:
             retry_count += 1
             message = f'Worker: worker_launch: retry: {retry_count} / has error: {e}'
@@ -119,53 +118,44 @@ def worker_launch(dream_queue, awaken_queue, message_queue, ckpt, out_dir):
             time.sleep(retry_count * 2 ** 3)
 
 
-async def upscaler_loop(upscale_queue, out_dir):
+async def upscaler_loop(upscale_queue, upscaled_queue, out_dir):
     upscaler = SyncDiffusionUpscaler()
+    jobs = QueueBridge(upscale_queue, 'upscale')
     while True:
         try:
-            if not upscale_queue.empty():
-                job = upscale_queue.get()
-                if job[1] == 'queue':
-                    print(job)
-                    await upscaler.set_job(*job[2])
-                    await upscaler.run()
-                    image = await upscaler.get_response()
-
-                    filename = job[2][2]
-                    fileio = BytesIO()
-                    image.save(fileio, 'PNG')
-                    file_size = fileio.tell()
-                    fileio.seek(0)
-                    if file_size < 6000000:
-                        filename = filename + '.upscale.png'   
-                        image.save(f'{out_dir}\{filename}', 'PNG')
-                    else:
-                        filename = filename + '.upscale.jpg'
-                        image.save(f'{out_dir}\{filename}', 'JPEG')
-
-                    next_job = [job[0], 'done', job[2]]
-                    upscale_queue.put(next_job)
-                    print(next_job)
-                else:
-                    upscale_queue.put(job)
-                    print(f'upscale_queue found, but not status is queue: {job}')
-                    await asyncio.sleep(0.8)
-
+            job = await jobs.get()
+            if job[1] == 'queue':
+                print(job)
+                await upscaler.set_job(*job[2])
+                await upscaler.run()
+                image = await upscaler.get_response()
+
+                # the bot reads the file as soon as it hears back, so this one is written inline
+                filename = job[2][2] + '.upscale'
+                save_sized(image, f'{out_dir}\{filename}', 6000000)
+
+                # results go back on their own queue, so neither side has to
+                # re-queue items that are not meant for it
+                next_job = [job[0], 'done', job[2]]
+                upscaled_queue.put(next_job)
+                print(next_job)
             else:
-                await asyncio.sleep(0.5)
+                print(f'upscale_queue found, but not status is queue: {job}')
+
         except Exception as e:
             message = f'upscaler_loop: has error: {e}'
             print(message)
+            jobs.close()
             raise
 
-def upscaler_launch(upscale_queue, out_dir):
+def upscaler_launch(upscale_queue, upscaled_queue, out_dir):
     print('1')
     retry_count = 0
     while True:
         try:
             loop = asyncio.get_event_loop()
             print('start upscaler')
-            loop.run_until_complete(upscaler_loop(upscale_queue, out_dir))
+            loop.run_until_complete(upscaler_loop(upscale_queue, upscaled_queue, out_dir))
         except Exception as e:
             retry_count += 1
             message = f'upscaler: retry: {retry_count} / has error: {e}'
@@ -187,33 +177,38 @@ if __name__ == "__main__":
     awaken_queue = Queue()
     message_queue = Queue()
     upscale_queue = Queue()
+    upscaled_queue = Queue()
 
-    bot_thread = Thread(target=bot_launch, args=(dream_queue, awaken_queue, message_queue, upscale_queue, out_dir, restart_queue))
-    bot_thread.start()
-
-    upscaler_process = Process(target=upscaler_launch, args=(upscale_queue, out_dir))
-    upscaler_process.start()
+    default_name = opt.modeltype or 'sd1.5'
+    default_ckpt = find_ckpt(cpkts, default_name, default_name)
 
+    # one worker per visible device unless --workers says otherwise
+    device_count = torch.cuda.device_count()
+    worker_count = opt.workers or max(device_count, 1)
+    devices = [f'cuda:{i % device_count}' if device_count > 0 else 'cpu' for i in range(worker_count)]
+    ready_queue = Queue()
+    inboxes = [Queue() for i in range(worker_count)]
+    pool = SyncDiffusionPool(dream_queue, ready_queue, inboxes, cpkts, default_name, opt.max_batch, opt.batch_window, devices)
 
-    search_ckpt = list(filter(lambda item : item['name'] == 'sd1.5', cpkts))
-    default_ckpt = search_ckpt[0]
+    pool_thread = Thread(target=pool_launch, args=(pool,))
+    pool_thread.start()
 
-    p = Process(target=worker_launch, args=(dream_queue, awaken_queue, message_queue, default_ckpt, out_dir))
-    p.start()
-    processes.append(p)
+    bot_thread = Thread(target=bot_launch, args=(dream_queue, awaken_queue, message_queue, upscale_queue, upscaled_queue, out_dir, restart_queue, pool))
+    bot_thread.start()
 
+    upscaler_process = Process(target=upscaler_launch, args=(upscale_queue, upscaled_queue, out_dir))
+    upscaler_process.start()
 
-    '''
-    for i in range(len(cpkts)):
-        p = Process(target=worker_launch, args=(dream_queue, awaken_queue, message_queue, cpkts[i], out_dir))
+    for i, device in enumerate(devices):
+        p = Process(target=worker_launch, args=(inboxes[i], awaken_queue, message_queue, ready_queue, i, default_ckpt, device, out_dir))
         p.start()
         processes.append(p)
-    '''
 
 
     while True:
-        if not restart_queue.empty:
-            print('restart_queue is found!')
+        # block instead of spinning the main process
+        restart = restart_queue.get()
+        print(f'restart_queue is found! / {restart}')
 
 
 
@@ -49,6 +49,7 @@ class StableDiffusionPipeline(DiffusionPipeline):
         generator: Optional[torch.Generator] = None,
         latents: Optional[torch.FloatTensor] = None,
         text_embeddings: Optional[torch.FloatTensor] = None,
+        uncond_embeddings: Optional[torch.FloatTensor] = None,
         output_type: Optional[str] = "pil",
         **kwargs,
     ):
@@ -99,17 +100,21 @@ class StableDiffusionPipeline(DiffusionPipeline):
         do_classifier_free_guidance = guidance_scale > 1.0
         # get unconditional embeddings for classifier free guidance
         if do_classifier_free_guidance:
-            # max_length = text_input.input_ids.shape[-1]
-            max_length = 77  # self.tokenizer.model_max_length
-            uncond_input = self.tokenizer(
-                [""] * batch_size,
-                padding="max_length",
-                max_length=max_length,
-                return_tensors="pt",
-            )
-            uncond_embeddings = self.text_encoder(
-                uncond_input.input_ids.to(self.device)
-            )[0]
+            if uncond_embeddings is None:
+                # max_length = text_input.input_ids.shape[-1]
+                max_length = 77  # self.tokenizer.model_max_length
+                uncond_input = self.tokenizer(
+                    [""] * batch_size,
+                    padding="max_length",
+                    max_length=max_length,
+                    return_tensors="pt",
+                )
+                uncond_embeddings = self.text_encoder(
+                    uncond_input.input_ids.to(self.device)
+                )[0]
+            else:
+                # embedded once by the caller, e.g. for every frame of a walk
+                uncond_embeddings = uncond_embeddings.expand(batch_size, -1, -1)
 
             # For classifier free guidance, we need to do two forward passes.
             # Here we concatenate the unconditional and text embeddings into a single batch
@@ -34,14 +34,19 @@ SCHEDULERS = dict(default=default_scheduler, ddim=ddim_scheduler, klms=klms_sche
 
 
 def slerp(t, v0, v1, DOT_THRESHOLD=0.9995):
-    """helper function to spherically interpolate two arrays v1 v2"""
+    """helper function to spherically interpolate two arrays v1 v2, t can also be a list of
+    fractions to get every point as one batch"""
 
+    inputs_are_torch = False
     if not isinstance(v0, np.ndarray):
         inputs_are_torch = True
         input_device = v0.device
         v0 = v0.cpu().numpy()
         v1 = v1.cpu().numpy()
 
+    # one row per fraction, broadcast against the batch dimension of v0 and v1
+    t = np.asarray(t, dtype=v0.dtype).reshape(-1, *[1] * (v0.ndim - 1))
+
     dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
     if np.abs(dot) > DOT_THRESHOLD:
         v2 = (1 - t) * v0 + t * v1
@@ -88,6 +93,7 @@ def walk(
     disable_tqdm=False,
     upsample=False,
     fps=30,
+    batch_size=1,
 ):
     """Generate video frames/a video given a list of prompts and seeds.
 
@@ -110,6 +116,7 @@ def walk(
         upsample (bool, optional): If True, uses Real-ESRGAN to upsample images 4x. Requires it to be installed
             which you can do by running: `pip install git+https://github.com/xinntao/Real-ESRGAN.git`. Defaults to False.
         fps (int, optional): The frames per second (fps) that you want the video to use. Does nothing if make_video is False. Defaults to 30.
+        batch_size (int, optional): How many frames go through the model at once. Defaults to 1.
 
     Returns:
         str: Path to video file saved if make_video=True, else None.
@@ -141,7 +148,8 @@ def walk(
                 do_loop=do_loop,
                 make_video=make_video,
                 use_lerp_for_text=use_lerp_for_text,
-                scheduler=scheduler
+                scheduler=scheduler,
+                batch_size=batch_size
             ),
             indent=2,
             sort_keys=False,
@@ -150,63 +158,60 @@ def walk(
 
     assert len(prompts) == len(seeds)
 
-    first_prompt, *prompts = prompts
-    embeds_a = pipeline.embed_text(first_prompt)
-
-    first_seed, *seeds = seeds
-    latents_a = torch.randn(
-        (1, pipeline.unet.in_channels, height // 8, width // 8),
-        device=pipeline.device,
-        generator=torch.Generator(device=pipeline.device).manual_seed(first_seed),
-    )
-
-    if do_loop:
-        prompts.append(first_prompt)
-        seeds.append(first_seed)
-
-    frame_index = 0
-    for prompt, seed in zip(prompts, seeds):
-        # Text
-        embeds_b = pipeline.embed_text(prompt)
+    # every prompt is embedded once, in one batch, and so is the empty prompt for guidance
+    embeds = pipeline.embed_text(prompts)
+    uncond_embeddings = pipeline.embed_text([""])
 
-        # Latent Noise
-        latents_b = torch.randn(
+    latents = torch.cat([
+        torch.randn(
             (1, pipeline.unet.in_channels, height // 8, width // 8),
             device=pipeline.device,
             generator=torch.Generator(device=pipeline.device).manual_seed(seed),
         )
+        for seed in seeds
+    ])
 
-        for i, t in enumerate(np.linspace(0, 1, num_steps)):
-            do_print_progress = (i == 0) or ((frame_index + 1) % 20 == 0)
-            if do_print_progress:
-                print(f"COUNT: {frame_index+1}/{len(seeds)*num_steps}")
+    walk_indices = list(range(len(prompts)))
+    if do_loop:
+        walk_indices.append(0)
 
-            if use_lerp_for_text:
-                embeds = torch.lerp(embeds_a, embeds_b, float(t))
-            else:
-                embeds = slerp(float(t), embeds_a, embeds_b)
-            latents = slerp(float(t), latents_a, latents_b)
+    schedule = np.linspace(0, 1, num_steps)
+    frame_count = (len(walk_indices) - 1) * num_steps
+    frame_index = 0
+    for a, b in zip(walk_indices, walk_indices[1:]):
+        # every frame between the two prompts, one row each
+        embeds_a, embeds_b = embeds[a:a + 1], embeds[b:b + 1]
+        if use_lerp_for_text:
+            t = torch.tensor(schedule, dtype=embeds.dtype, device=embeds.device).view(-1, 1, 1)
+            walk_embeds = embeds_a + (embeds_b - embeds_a) * t
+        else:
+            walk_embeds = slerp(schedule, embeds_a, embeds_b)
+        walk_latents = slerp(schedule, latents[a:a + 1], latents[b:b + 1])
+
+        for i in range(0, num_steps, batch_size):
+            do_print_progress = (i == 0) or ((frame_index + 1) % 20 < batch_size)
+            if do_print_progress:
+                print(f"COUNT: {frame_index+1}/{frame_count}")
 
             with torch.autocast("cuda"):
-                im = pipeline(
-                    latents=latents,
-                    text_embeddings=embeds,
+                images = pipeline(
+                    latents=walk_latents[i:i + batch_size],
+                    text_embeddings=walk_embeds[i:i + batch_size],
+                    uncond_embeddings=uncond_embeddings,
                     height=height,
                     width=width,
                     guidance_scale=guidance_scale,
                     eta=eta,
                     num_inference_steps=num_inference_steps,
                     output_type='pil' if not upsample else 'numpy'
-                )["sample"][0]
+                )["sample"]
 
                 if upsample:
-                    im = upsampling_pipeline(im)
-
-            im.save(output_path / ("frame%06d.jpg" % frame_index))
-            frame_index += 1
+                    images = [upsampling_pipeline(im) for im in images]
 
-        embeds_a = embeds_b
-        latents_a = latents_b
+            for im in images:
+                im.save(output_path / ("frame%06d.jpg" % frame_index))
+                frame_index += 1
 
     if make_video:
         return make_video_ffmpeg(output_path, f"{name}.mp4", fps=fps)
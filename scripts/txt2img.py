@@ -11,8 +11,7 @@ from streamlit.elements import image as STImage
 import os
 from typing import Union
 from io import BytesIO
-from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.models.diffusion.plms import PLMSSampler
+from modules.samplers import get_sampler
 
 # Temp imports 
 
@@ -69,24 +68,7 @@ def txt2img(prompt: str, ddim_steps: int, sampler_name: str, realesrgan_model_na
     #use_GFPGAN = 7 in toggles
     #use_RealESRGAN = 8 in toggles
 
-    if sampler_name == 'PLMS':
-        sampler = PLMSSampler(st.session_state["model"])
-    elif sampler_name == 'DDIM':
-        sampler = DDIMSampler(st.session_state["model"])
-    elif sampler_name == 'k_dpm_2_a':
-        sampler = KDiffusionSampler(st.session_state["model"],'dpm_2_ancestral')
-    elif sampler_name == 'k_dpm_2':
-        sampler = KDiffusionSampler(st.session_state["model"],'dpm_2')
-    elif sampler_name == 'k_euler_a':
-        sampler = KDiffusionSampler(st.session_state["model"],'euler_ancestral')
-    elif sampler_name == 'k_euler':
-        sampler = KDiffusionSampler(st.session_state["model"],'euler')
-    elif sampler_name == 'k_heun':
-        sampler = KDiffusionSampler(st.session_state["model"],'heun')
-    elif sampler_name == 'k_lms':
-        sampler = KDiffusionSampler(st.session_state["model"],'lms')
-    else:
-        raise Exception("Unknown sampler: " + sampler_name)
+    sampler = get_sampler(st.session_state["model"], sampler_name)
 
     def init():
         pass
@@ -19,6 +19,9 @@ from torch import autocast
 from io import BytesIO
 import imageio
 from slugify import slugify
+from modules.noise import slerp
+from modules.previews import latent_to_rgb
+from modules.telemetry import get_telemetry, format_usage
 
 # Temp imports
 
@@ -61,19 +64,16 @@ else:
 def diffuse(
 	pipe,
 		cond_embeddings, # text conditioning, should be (1, 77, 768)
-	cond_latents,    # image conditioning, should be (1, 4, 64, 64)
+	uncond_embeddings, # embedding of the empty prompt, (1, 77, 768), computed once per run
+	cond_latents,    # image conditioning, a batch of frames (n, 4, 64, 64)
 	num_inference_steps,
 	cfg_scale,
 	eta,
 	):
 
-	torch_device = cond_latents.get_device()
-
-	# classifier guidance: add the unconditional embedding
-	max_length = cond_embeddings.shape[1] # 77
-	uncond_input = pipe.tokenizer([""], padding="max_length", max_length=max_length, return_tensors="pt")
-	uncond_embeddings = pipe.text_encoder(uncond_input.input_ids.to(torch_device))[0]
-	text_embeddings = torch.cat([uncond_embeddings, cond_embeddings])
+	# classifier guidance: add the unconditional embedding, every frame of the batch shares both
+	batch_size = cond_latents.shape[0]
+	text_embeddings = torch.cat([uncond_embeddings.expand(batch_size, -1, -1), cond_embeddings.expand(batch_size, -1, -1)])
 
 	# if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
 	if isinstance(pipe.scheduler, LMSDiscreteScheduler):
@@ -145,13 +145,17 @@ def diffuse(
 				if st.session_state.dynamic_preview_frequency:
 					st.session_state["current_chunk_speed"], st.session_state["previous_chunk_speed_list"], st.session_state['defaults'].txt2vid.update_preview_frequency, st.session_state["avg_update_preview_frequency"] = optimize_update_preview_frequency(st.session_state["current_chunk_speed"], st.session_state["previous_chunk_speed_list"], st.session_state['defaults'].txt2vid.update_preview_frequency, st.session_state["update_preview_frequency_list"])   
 
-				#scale and decode the image latents with vae
-				cond_latents_2 = 1 / 0.18215 * cond_latents
-				image = pipe.vae.decode(cond_latents_2)
+				if st.session_state['defaults'].general.preview_mode == "latent":
+					# a linear map of the latents to rgb, no vae pass
+					image = transforms.ToPILImage()(latent_to_rgb(cond_latents[:1])[0])
+				else:
+					#scale and decode the image latents with vae
+					cond_latents_2 = 1 / 0.18215 * cond_latents[:1]
+					image = pipe.vae.decode(cond_latents_2)
 
-				# generate output numpy image as uint8
-				image = torch.clamp((image["sample"] + 1.0) / 2.0, min=0.0, max=1.0)
-				image = transforms.ToPILImage()(image.squeeze_(0))
+					# generate output numpy image as uint8
+					image = torch.clamp((image["sample"] + 1.0) / 2.0, min=0.0, max=1.0)
+					image = transforms.ToPILImage()(image[0])
 
 				st.session_state["preview_image"].image(image)
 
@@ -185,7 +189,11 @@ def diffuse(
 		)
 		st.session_state["progress_bar"].progress(percent if percent < 100 else 100)
 
-	return image
+	#scale and decode the frames of the batch with vae
+	images = pipe.vae.decode(1 / 0.18215 * cond_latents)
+	images = torch.clamp((images["sample"] + 1.0) / 2.0, min=0.0, max=1.0)
+
+	return [transforms.ToPILImage()(image) for image in images]
 
 #
 def txt2vid(
@@ -197,6 +205,7 @@ def txt2vid(
 	#rootdir:str = st.session_state['defaults'].general.outdir,
 	num_steps:int = 200, # number of steps between each pair of sampled points
 		max_frames:int = 10000, # number of frames to write and then exit the script
+				batch_size:int = 1, # frames that go through the unet together
 				num_inference_steps:int = 50, # more (e.g. 100, 200 etc) can create slightly better images
 				cfg_scale:float = 5.0, # can depend on the prompt. usually somewhere between 3-10 is good
 				do_loop = False,
@@ -222,6 +231,7 @@ def txt2vid(
 	#rootdir:str = st.session_state['defaults'].general.outdir,
 	num_steps:int = 200, # number of steps between each pair of sampled points
 	max_frames:int = 10000, # number of frames to write and then exit the script
+	batch_size:int = 1, # frames that go through the unet together
 	num_inference_steps:int = 50, # more (e.g. 100, 200 etc) can create slightly better images
 	cfg_scale:float = 5.0, # can depend on the prompt. usually somewhere between 3-10 is good
 	do_loop = False,
@@ -238,8 +248,7 @@ def txt2vid(
 	beta_end = 0.00012,
 	beta_schedule = "scaled_linear"
 	"""
-	mem_mon = MemUsageMonitor('MemMon')
-	mem_mon.start()
+	usage = get_telemetry(gpu).begin_job()
 
 
 	seeds = seed_to_int(seeds)
@@ -273,6 +282,7 @@ def txt2vid(
 									gpu = gpu,
 								num_steps = num_steps,
 											max_frames = max_frames,
+											batch_size = batch_size,
 											num_inference_steps = num_inference_steps,
 														cfg_scale = cfg_scale,
 															do_loop = do_loop,
@@ -380,6 +390,10 @@ def txt2vid(
 	text_input = st.session_state["pipe"].tokenizer(prompts, padding="max_length", max_length=st.session_state["pipe"].tokenizer.model_max_length, truncation=True, return_tensors="pt")
 	cond_embeddings = st.session_state["pipe"].text_encoder(text_input.input_ids.to(torch_device))[0] # shape [1, 77, 768]
 
+	# the unconditional embedding for classifier free guidance, the same for every frame
+	uncond_input = st.session_state["pipe"].tokenizer([""], padding="max_length", max_length=cond_embeddings.shape[1], return_tensors="pt")
+	uncond_embeddings = st.session_state["pipe"].text_encoder(uncond_input.input_ids.to(torch_device))[0]
+
 	#
 	if st.session_state.defaults.general.use_sd_concepts_library:
 
@@ -422,6 +436,9 @@ def txt2vid(
 		#seeds.append(first_seed)
 
 
+	# the interpolation fractions of every frame between two sampled points
+	schedule = torch.linspace(0, 1, max_frames, device=torch_device)
+
 	# iterate the loop
 	frames = []
 	frame_index = 0
@@ -438,36 +455,40 @@ def txt2vid(
 			# sample the destination
 			init2 = torch.randn((1, st.session_state["pipe"].unet.in_channels, height // 8, width // 8), device=torch_device)
 
-			for i, t in enumerate(np.linspace(0, 1, max_frames)):
+			for i in range(0, max_frames, batch_size):
 				start = timeit.default_timer()
 				print(f"COUNT: {frame_index+1}/{max_frames}")
 
+				# the next frames of the walk from init1 to init2, interpolated as one batch
+				t = schedule[i:i + batch_size].view(-1, 1, 1, 1)
+
 				#if use_lerp_for_text:
-					#init = torch.lerp(init1, init2, float(t))
+					#init = torch.lerp(init1, init2, t)
 				#else:
-					#init = slerp(gpu, float(t), init1, init2)
+					#init = slerp(t, init1, init2)
 
-				init = slerp(gpu, float(t), init1, init2)
+				init = slerp(t, init1, init2)
 
 				with autocast("cuda"):
-					image = diffuse(st.session_state["pipe"], cond_embeddings, init, num_inference_steps, cfg_scale, eta)
+					images = diffuse(st.session_state["pipe"], cond_embeddings, uncond_embeddings, init, num_inference_steps, cfg_scale, eta)
 
-				#im = Image.fromarray(image)
-				outpath = os.path.join(full_path, 'frame%06d.png' % frame_index)
-				image.save(outpath, quality=quality)
+				for image in images:
+					#im = Image.fromarray(image)
+					outpath = os.path.join(full_path, 'frame%06d.png' % frame_index)
+					image.save(outpath, quality=quality)
 
-				# send the image to the UI to update it
-				#st.session_state["preview_image"].image(im)
+					# send the image to the UI to update it
+					#st.session_state["preview_image"].image(im)
 
-				#append the frames to the frames list so we can use them later.
-				frames.append(np.asarray(image))
+					#append the frames to the frames list so we can use them later.
+					frames.append(np.asarray(image))
 
-				#increase frame_index counter.
-				frame_index += 1
+					#increase frame_index counter.
+					frame_index += 1
 
 				st.session_state["current_frame"] = frame_index
 
-				duration = timeit.default_timer() - start
+				duration = (timeit.default_timer() - start) / len(images)
 
 				if duration >= 1:
 					speed = "s/it"
@@ -500,7 +521,7 @@ def txt2vid(
 		# show video preview on the UI
 		st.session_state["preview_video"].video(open(video_path, 'rb').read())
 
-	mem_max_used, mem_total = mem_mon.read_and_stop()
+	usage = get_telemetry(gpu).end_job(usage)
 	time_diff = time.time()- start
 
 	info = f"""
@@ -508,7 +529,7 @@ def txt2vid(
 		Sampling Steps: {num_steps}, Sampler: {scheduler}, CFG scale: {cfg_scale}, Seed: {seeds}, Max Frames: {max_frames}""".strip()
 	stats = f'''
 		Took { round(time_diff, 2) }s total ({ round(time_diff/(max_frames),2) }s per image)
-		Peak memory usage: { -(mem_max_used // -1_048_576) } MiB / { -(mem_total // -1_048_576) } MiB / { round(mem_max_used/mem_total*100, 3) }%'''
+		{format_usage(usage)}'''
 
 	return video_path, seeds, info, stats
 
@@ -585,10 +606,10 @@ def layout():
 												#help="Upload an image which will be used for the image to image generation.")			
 			seed = st.text_input("Seed:", value=st.session_state['defaults'].txt2vid.seed, help=" The seed to use, if left blank a random seed will be generated.")
 			#batch_count = st.slider("Batch count.", min_value=1, max_value=100, value=st.session_state['defaults'].txt2vid.batch_count, step=1, help="How many iterations or batches of images to generate in total.")
-			#batch_size = st.slider("Batch size", min_value=1, max_value=250, value=st.session_state['defaults'].txt2vid.batch_size, step=1,
-					#help="How many images are at once in a batch.\
-					#It increases the VRAM usage a lot but if you have enough VRAM it can reduce the time it takes to finish generation as more images are generated at once.\
-					#Default: 1")
+			batch_size = st.slider("Batch size", min_value=1, max_value=250, value=st.session_state['defaults'].txt2vid.batch_size, step=1,
+					help="How many frames go through the model at once.\
+					It increases the VRAM usage a lot but if you have enough VRAM it can reduce the time it takes to finish generation as more frames are generated at once.\
+					Default: 1")
 
 			st.session_state["max_frames"] = int(st.text_input("Max Frames:", value=st.session_state['defaults'].txt2vid.max_frames, help="Specify the max number of frames you want to generate."))
 
@@ -723,6 +744,7 @@ def layout():
 			# run video generation
 			video, seed, info, stats = txt2vid(prompts=prompt, gpu=st.session_state["defaults"].general.gpu,
 											   num_steps=st.session_state.sampling_steps, max_frames=int(st.session_state.max_frames),
+											   batch_size=batch_size,
 							   num_inference_steps=st.session_state.num_inference_steps,
 							   cfg_scale=cfg_scale,do_loop=st.session_state["do_loop"],
 							   seeds=seed, quality=100, eta=0.0, width=width,
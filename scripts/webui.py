@@ -7,9 +7,25 @@ from frontend.frontend import draw_gradio_ui
 from frontend.job_manager import JobManager, JobInfo
 from frontend.image_metadata import ImageMetadata
 from frontend.ui_functions import resize_image
+from modules.image_writer import ImageWriter
+from modules.sequence import next_sequence_number
+from modules.residency import ModelResidency
+from modules.upscalers import RealESRGAN_path, get_RealESRGAN, forget_RealESRGAN
+from modules.postprocess import PostProcessor
+from modules.gobig import gobig
+from modules.grid import get_font, image_grid as make_grid
+from modules.prompts import split_weighted_subprompts
+from modules.conditioning import get_conditioning
+from modules.noise import create_random_tensors, sampling_noise, seeded_rng, slerp
+from modules.previews import PREVIEW_MODES, latent_preview
+from modules.telemetry import get_telemetry, format_usage
+from modules.tracing import Trace, current_trace, span, traced, set_trace_log
+from modules.samplers import get_sampler, compile_steps, guidance_interval, CFGDenoiser, CFGMaskedDenoiser, KDiffusionSampler
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--attention", type=str, help="attention backend, picked once at load: auto (sdpa if available, else chunked), sdpa, chunked, einsum or compvis", default="auto")
 parser.add_argument("--ckpt", type=str, default="models/ldm/stable-diffusion-v1/model.ckpt", help="path to checkpoint of model",)
 parser.add_argument("--cli", type=str, help="don't launch web server, take Python function kwargs from this file.", default=None)
+parser.add_argument("--clip-cache-mb", type=int, help="memory cap in MB for cached prompt embeddings, 0 disables the cache", default=64)
 parser.add_argument("--config", type=str, default="configs/stable-diffusion/v1-inference.yaml", help="path to config which constructs model",)
 parser.add_argument("--defaults", type=str, help="path to configuration file providing UI defaults, uses same format as cli parameter", default='configs/webui/webui.yaml')
 parser.add_argument("--esrgan-cpu", action='store_true', help="run ESRGAN on cpu", default=False)
@@ -20,10 +36,14 @@ parser.add_argument("--gfpgan-cpu", action='store_true', help="run GFPGAN on cpu
 parser.add_argument("--gfpgan-dir", type=str, help="GFPGAN directory", default=('./src/gfpgan' if os.path.exists('./src/gfpgan') else './GFPGAN')) # i disagree with where you're putting it but since all guidefags are doing it this way, there you go
 parser.add_argument("--gfpgan-gpu", type=int, help="run GFPGAN on specific gpu (overrides --gpu) ", default=0)
 parser.add_argument("--gpu", type=int, help="choose which GPU to use if you have multiple", default=0)
+parser.add_argument("--gobig-batch-size", type=int, help="number of GoBig tiles sampled together", default=4)
 parser.add_argument("--grid-format", type=str, help="png for lossless png files; jpg:quality for lossy jpeg; webp:quality for lossy webp, or webp:-compression for lossless webp", default="jpg:95")
 parser.add_argument("--inbrowser", action='store_true', help="automatically launch the interface in a new tab on the default browser", default=False)
 parser.add_argument("--ldsr-dir", type=str, help="LDSR directory", default=('./src/latent-diffusion' if os.path.exists('./src/latent-diffusion') else './LDSR'))
+parser.add_argument("--model-host-mb", type=int, help="pinned host memory in MB for models evicted from the gpu, past that they are unloaded", default=8192)
+parser.add_argument("--model-vram-mb", type=int, help="gpu memory in MB that loaded models may keep while they are not in use, 0 for 60%% of the gpu", default=0)
 parser.add_argument("--n_rows", type=int, default=-1, help="rows in the grid; use -1 for autodetect and 0 for n_rows to be same as batch_size (default: -1)",)
+parser.add_argument("--no-ckpt-cache", action='store_true', help="do not write a faster to load copy of .ckpt checkpoints next to them", default=False)
 parser.add_argument("--no-half", action='store_true', help="do not switch the model to 16-bit floats", default=False)
 parser.add_argument("--no-progressbar-hiding", action='store_true', help="do not hide progressbar in gradio UI (we hide it because it slows down ML if you have hardware accleration in browser)", default=False)
 parser.add_argument("--no-verify-input", action='store_true', help="do not verify input to check if it's too long", default=False)
@@ -46,6 +66,13 @@ parser.add_argument("--skip-save", action='store_true', help="do not save indivi
 parser.add_argument('--no-job-manager', action='store_true', help="Don't use the experimental job manager on top of gradio", default=False)
 parser.add_argument("--max-jobs", type=int, help="Maximum number of concurrent 'generate' commands", default=1)
 parser.add_argument("--tiling", action='store_true', help="Generate tiling images", default=False)
+parser.add_argument("--upscale-tile", type=int, help="RealESRGAN tile size in input pixels, tiles of all images in a batch are upscaled together; 0 upscales whole images", default=512)
+parser.add_argument("--upscale-tile-overlap", type=int, help="overlap in input pixels between RealESRGAN tiles, blended linearly", default=32)
+parser.add_argument("--vae-tile-size", type=int, help="decode images larger than this many pixels in overlapping tiles to bound VAE memory, 0 decodes in one pass", default=0)
+parser.add_argument("--compile-sampler", action='store_true', help="compile the DDIM/PLMS step with torch.compile, needs torch 2", default=False)
+parser.add_argument("--cpu-noise", action='store_true', help="draw the initial and step noise on the cpu, so a seed gives the same image on any device (changes the images of existing gpu seeds)", default=False)
+parser.add_argument("--trace-log", type=str, help="append the stage timings of every request as one json line to this file", default=None)
+parser.add_argument("--preview-mode", type=str, choices=PREVIEW_MODES, help="step previews and recorded steps: latent maps the latents to rgb without the VAE, full decodes them with the VAE", default="latent")
 opt = parser.parse_args()
 
 #Should not be needed anymore
@@ -58,11 +85,9 @@ opt = parser.parse_args()
 #    os.environ["CUDA_VISIBLE_DEVICES"] = str(opt.gpu)
 
 import gradio as gr
-import k_diffusion as K
 import math
 import mimetypes
 import numpy as np
-import pynvml
 import random
 import threading, asyncio
 import time
@@ -95,9 +120,10 @@ from io import BytesIO
 import base64
 import re
 from torch import autocast
-from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.models.diffusion.plms import PLMSSampler
 from ldm.util import instantiate_from_config
+from ldm.checkpoint import load_model, load_state_dict
+from ldm.modules.attention import set_attention_backend
+from ldm.models.batched_decode import BatchedDecoder
 
 # add global options to models
 def patch_conv(**patch):
@@ -124,8 +150,9 @@ from transformers import AutoFeatureExtractor
 
 # load safety model
 safety_model_id = "CompVis/stable-diffusion-safety-checker"
-safety_feature_extractor = None
-safety_checker = None
+
+def load_safety_checker():
+    return AutoFeatureExtractor.from_pretrained(safety_model_id), StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
 
 # this is a fix for Windows users. Without it, javascript files will be served with text/html content-type and the bowser will not show any UI
 mimetypes.init()
@@ -151,6 +178,10 @@ else:
     job_manager = JobManager(opt.max_jobs)
     opt.max_jobs += 1 # Leave a free job open for button clicks
 
+# one sampler for device memory, shared by every job
+get_telemetry(opt.gpu)
+set_trace_log(opt.trace_log)
+
 # should probably be moved to a settings menu in the UI at some point
 grid_format = [s.lower() for s in opt.grid_format.split(':')]
 grid_lossless = False
@@ -176,32 +207,14 @@ def chunk(it, size):
     return iter(lambda: tuple(islice(it, size)), ())
 
 
-def load_model_from_config(config, ckpt, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print("missing keys:")
-        print(m)
-    if len(u) > 0 and verbose:
-        print("unexpected keys:")
-        print(u)
-
-    model.cuda()
-    model.eval()
-    return model
+def load_model_from_config(config, ckpt, verbose=False, device="cuda", half=False):
+    # builds the model without weight init and streams the cached checkpoint straight into device and dtype
+    return load_model(config, ckpt, device=device, half=half, verbose=verbose, cache=not opt.no_ckpt_cache)
 
 def load_sd_from_config(ckpt, verbose=False):
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    return sd
+    # a plain dict, the optimized loader renames keys in place
+    return dict(load_state_dict(ckpt, cache=not opt.no_ckpt_cache))
 
 def crash(e, s):
     global model
@@ -222,121 +235,6 @@ def crash(e, s):
     t = threading.Timer(0.25, os._exit, args=[0])
     t.start()
 
-class MemUsageMonitor(threading.Thread):
-    stop_flag = False
-    max_usage = 0
-    total = -1
-
-    def __init__(self, name):
-        threading.Thread.__init__(self)
-        self.name = name
-
-    def run(self):
-        try:
-            pynvml.nvmlInit()
-        except:
-            print(f"[{self.name}] Unable to initialize NVIDIA management. No memory stats. \n")
-            return
-        print(f"[{self.name}] Recording max memory usage...\n")
-        # check if we're using a scoped-down GPU environment (pynvml does not listen to CUDA_VISIBLE_DEVICES)
-        # so that we can measure memory on the correct GPU
-        try:
-            isinstance(int(os.environ["CUDA_VISIBLE_DEVICES"]), int)
-            handle = pynvml.nvmlDeviceGetHandleByIndex(int(os.environ["CUDA_VISIBLE_DEVICES"]))
-        except (KeyError, ValueError) as pynvmlHandleError:
-            if os.getenv("SD_WEBUI_DEBUG", 'False').lower() in ('true', '1', 'y'):
-                print("[MemMon][WARNING]", pynvmlHandleError)
-                print("[MemMon][INFO]", "defaulting to monitoring memory on the default gpu (set via --gpu flag)")
-            handle = pynvml.nvmlDeviceGetHandleByIndex(opt.gpu)
-        self.total = pynvml.nvmlDeviceGetMemoryInfo(handle).total
-        while not self.stop_flag:
-            m = pynvml.nvmlDeviceGetMemoryInfo(handle)
-            self.max_usage = max(self.max_usage, m.used)
-            # print(self.max_usage)
-            time.sleep(0.1)
-        print(f"[{self.name}] Stopped recording.\n")
-        pynvml.nvmlShutdown()
-
-    def read(self):
-        return self.max_usage, self.total
-
-    def stop(self):
-        self.stop_flag = True
-
-    def read_and_stop(self):
-        self.stop_flag = True
-        return self.max_usage, self.total
-
-class CFGMaskedDenoiser(nn.Module):
-    def __init__(self, model):
-        super().__init__()
-        self.inner_model = model
-
-    def forward(self, x, sigma, uncond, cond, cond_scale, mask, x0, xi):
-        x_in = x
-        x_in = torch.cat([x_in] * 2)
-        sigma_in = torch.cat([sigma] * 2)
-        cond_in = torch.cat([uncond, cond])
-        uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
-        denoised = uncond + (cond - uncond) * cond_scale
-
-        if mask is not None:
-            assert x0 is not None
-            img_orig = x0
-            mask_inv = 1. - mask
-            denoised = (img_orig * mask_inv) + (mask * denoised)
-
-        return denoised
-
-class CFGDenoiser(nn.Module):
-    def __init__(self, model):
-        super().__init__()
-        self.inner_model = model
-
-    def forward(self, x, sigma, uncond, cond, cond_scale):
-        x_in = torch.cat([x] * 2)
-        sigma_in = torch.cat([sigma] * 2)
-        cond_in = torch.cat([uncond, cond])
-        uncond, cond = self.inner_model(x_in, sigma_in, cond=cond_in).chunk(2)
-        return uncond + (cond - uncond) * cond_scale
-
-
-class KDiffusionSampler:
-    def __init__(self, m, sampler):
-        self.model = m
-        self.model_wrap = K.external.CompVisDenoiser(m)
-        self.schedule = sampler
-    def get_sampler_name(self):
-        return self.schedule
-    def sample(self, S, conditioning, batch_size, shape, verbose, unconditional_guidance_scale, unconditional_conditioning, eta, x_T, img_callback: Callable = None ):
-        sigmas = self.model_wrap.get_sigmas(S)
-        x = x_T * sigmas[0]
-        model_wrap_cfg = CFGDenoiser(self.model_wrap)
-
-        samples_ddim = K.sampling.__dict__[f'sample_{self.schedule}'](model_wrap_cfg, x, sigmas, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': unconditional_guidance_scale}, disable=False, callback=partial(KDiffusionSampler.img_callback_wrapper, img_callback))
-
-        return samples_ddim, None
-
-    @classmethod
-    def img_callback_wrapper(cls, callback: Callable, *args):
-        ''' Converts a KDiffusion callback to the standard img_callback '''
-        if callback:
-            arg_dict = args[0]
-            callback(image_sample=arg_dict['denoised'], iter_num=arg_dict['i'])
-
-def create_random_tensors(shape, seeds):
-    xs = []
-    for seed in seeds:
-        torch.manual_seed(seed)
-
-        # randn results depend on device; gpu and cpu get different results for same seed;
-        # the way I see it, it's better to do this on CPU, so that everyone gets same result;
-        # but the original script had it like this so i do not dare change it for now because
-        # it will break everyone's seeds.
-        xs.append(torch.randn(shape, device=device))
-    x = torch.stack(xs)
-    return x
-
 def torch_gc():
     torch.cuda.empty_cache()
     torch.cuda.ipc_collect()
@@ -374,31 +272,21 @@ def load_GFPGAN(checking=False):
         instance = GFPGANer(model_path=model_path, upscale=1, arch='clean', channel_multiplier=2, bg_upsampler=None, device=torch.device(f'cuda:{opt.gpu}'))
     return instance
 
-def load_RealESRGAN(model_name: str, checking = False):
-    from basicsr.archs.rrdbnet_arch import RRDBNet
-    RealESRGAN_models = {
-        'RealESRGAN_x4plus': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
-        'RealESRGAN_x4plus_anime_6B': RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=6, num_grow_ch=32, scale=4)
-    }
+def RealESRGAN_device():
+    if opt.esrgan_cpu or opt.extra_models_cpu:
+        return torch.device('cpu'), False
+    elif opt.extra_models_gpu:
+        return torch.device(f'cuda:{opt.esrgan_gpu}'), not opt.no_half
+    return None, not opt.no_half
 
-    model_path = os.path.join(RealESRGAN_dir, 'experiments/pretrained_models', model_name + '.pth')
+def load_RealESRGAN(model_name: str, checking = False):
+    model_path = RealESRGAN_path(RealESRGAN_dir, model_name)
     if not os.path.isfile(model_path):
         raise Exception(model_name+".pth not found at path "+model_path)
     if checking == True:
         return True
-    sys.path.append(os.path.abspath(RealESRGAN_dir))
-    from realesrgan import RealESRGANer
-
-    if opt.esrgan_cpu or opt.extra_models_cpu:
-        instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_models[model_name], pre_pad=0, half=False) # cpu does not support half
-        instance.device = torch.device('cpu')
-        instance.model.to('cpu')
-    elif opt.extra_models_gpu:
-        instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_models[model_name], pre_pad=0, half=not opt.no_half, gpu_id=opt.esrgan_gpu)
-    else:
-        instance = RealESRGANer(scale=2, model_path=model_path, model=RealESRGAN_models[model_name], pre_pad=0, half=not opt.no_half)
-    instance.model.name = model_name
-    return instance
+    # one instance per model, device and precision, shared by imgproc, process_images and run_RealESRGAN
+    return get_RealESRGAN(RealESRGAN_dir, model_name, *RealESRGAN_device())
 
 GFPGAN = None
 if os.path.exists(GFPGAN_dir):
@@ -488,64 +376,53 @@ def load_SD_model():
             model = model.half()
             modelCS = modelCS.half()
             modelFS = modelFS.half()
+        modelCS.cond_stage_model.cache_mb = opt.clip_cache_mb
         return model,modelCS,modelFS,device, config
     else:
         config = OmegaConf.load(opt.config)
-        model = load_model_from_config(config, opt.ckpt)
-
         device = torch.device(f"cuda:{opt.gpu}") if torch.cuda.is_available() else torch.device("cpu")
-        model = (model if opt.no_half else model.half()).to(device)
+        model = load_model_from_config(config, opt.ckpt, device=device, half=not opt.no_half)
+        # set on every load, residency reloads the model from disk after dropping it
+        model.cond_stage_model.cache_mb = opt.clip_cache_mb
+        if opt.vae_tile_size:
+            model.first_stage_tile = opt.vae_tile_size // 8
     return model, device,config
 
+# every model the ui can load, kept warm on the gpu or in pinned host memory between uses
+residency = ModelResidency(device_budget=(opt.model_vram_mb << 20) or None, host_budget=opt.model_host_mb << 20)
+# the optimized model moves its parts between devices itself
+residency.register('model', load_SD_model, movable=not opt.optimized)
+residency.register('GFPGAN', load_GFPGAN)
+# LDSR loads its model on every call, there is nothing to keep on the gpu
+residency.register('LDSR', load_LDSR, movable=False)
+residency.register('safety_checker', load_safety_checker, movable=False)
+
+set_attention_backend(opt.attention)
+if opt.compile_sampler:
+    compile_steps()
 if opt.optimized:
-    model,modelCS,modelFS,device, config = load_SD_model()
+    model,modelCS,modelFS,device, config = residency.get('model')
 else:
-    model, device,config = load_SD_model()
+    model, device,config = residency.get('model')
+if opt.vae_tile_size and opt.optimized:
+    # the first stage of optimizedSD decodes in one pass, it has no tiled decode
+    print("--vae-tile-size has no effect with --optimized, the VAE decodes whole images")
+
+
+first_stage_decoder = BatchedDecoder()
+postprocessor = PostProcessor(tile=opt.upscale_tile, tile_overlap=opt.upscale_tile_overlap)
+image_writer = ImageWriter()
 
 
 def load_embeddings(fp):
     if fp is not None and hasattr(model, "embedding_manager"):
         model.embedding_manager.load(fp.name)
+        if hasattr(model.cond_stage_model, "clear_cache"):
+            model.cond_stage_model.clear_cache()
 
 
-def get_font(fontsize):
-    fonts = ["arial.ttf", "DejaVuSans.ttf"]
-    for font_name in fonts:
-        try:
-            return ImageFont.truetype(font_name, fontsize)
-        except OSError:
-           pass
-
-    # ImageFont.load_default() is practically unusable as it only supports
-    # latin1, so raise an exception instead if no usable font was found
-    raise Exception(f"No usable font found (tried {', '.join(fonts)})")
-
 def image_grid(imgs, batch_size, force_n_rows=None, captions=None):
-    if force_n_rows is not None:
-        rows = force_n_rows
-    elif opt.n_rows > 0:
-        rows = opt.n_rows
-    elif opt.n_rows == 0:
-        rows = batch_size
-    else:
-        rows = math.sqrt(len(imgs))
-        rows = round(rows)
-
-    cols = math.ceil(len(imgs) / rows)
-
-    w, h = imgs[0].size
-    grid = Image.new('RGB', size=(cols * w, rows * h), color='black')
-
-    fnt = get_font(30)
-
-    for i, img in enumerate(imgs):
-        grid.paste(img, box=(i % cols * w, i // cols * h))
-        if captions and i<len(captions):
-            d = ImageDraw.Draw( grid )
-            size = d.textbbox( (0,0), captions[i], font=fnt, stroke_width=2, align="center" )
-            d.multiline_text((i % cols * w + w/2, i // cols * h + h - size[3]), captions[i], font=fnt, fill=(255,255,255), stroke_width=2, stroke_fill=(0,0,0), anchor="mm", align="center")
-
-    return grid
+    return make_grid(imgs, batch_size, force_n_rows, captions, n_rows=opt.n_rows)
 
 def seed_to_int(s):
     if type(s) is int:
@@ -643,7 +520,14 @@ def check_prompt_length(prompt, comments):
     comments.append(f"Warning: too many input tokens; some ({len(overflowing_words)}) have been truncated:\n{overflowing_text}\n")
 
 
-def save_sample(image, sample_path_i, filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
+def save_sample(image, sample_path_i, filename, jpg_sample, *args, **kwargs):
+    ''' queues the image on the image writer, so encoding and file writes do not hold up the next batch '''
+    filename_i = os.path.join(sample_path_i, filename)
+    with span('save'):
+        image_writer.submit(traced('encode_write', write_sample), image, sample_path_i, filename, jpg_sample, *args, **kwargs,
+                            paths=[f"{filename_i}.{'jpg' if jpg_sample else 'png'}"])
+
+def write_sample(image, sample_path_i, filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
 skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=False):
     ''' saves the image according to selected parameters. Expects to find generation parameters on image, set by ImageMetadata.set_on_image() '''
     metadata = ImageMetadata.get_from_image(image)
@@ -732,17 +616,10 @@ def get_next_sequence_number(path, prefix=''):
     prefix, and strip the prefix from filenames before extracting their
     sequence number.
 
-    The sequence starts at 0.
+    The sequence starts at 0. Numbers come from a counter kept next to the
+    images, the directory is only scanned the first time.
     """
-    result = -1
-    for p in Path(path).iterdir():
-        if p.name.endswith(('.png', '.jpg')) and p.name.startswith(prefix):
-            tmp = p.name[len(prefix):]
-            try:
-                result = max(int(tmp.split('-')[0]), result)
-            except ValueError:
-                pass
-    return result + 1
+    return next_sequence_number(path, prefix, pending=image_writer.pending_files(path))
 
 
 def oxlamon_matrix(prompt, seed, n_iter, batch_size):
@@ -842,26 +719,27 @@ def perform_masked_image_restoration(image, init_img, init_mask, mask_blur_stren
 
 
 def perform_color_correction(img_rgb, correction_target_lab, do_color_correction):
-    try:
-        from skimage import exposure
-    except:
-        print("Install scikit-image to perform color correction")
-        return img_rgb
-
-    if not do_color_correction: return img_rgb
-    if correction_target_lab is None: return img_rgb
-
-    return (
-        Image.fromarray(cv2.cvtColor(exposure.match_histograms(
-                cv2.cvtColor(
-                    np.asarray(img_rgb),
-                    cv2.COLOR_RGB2LAB
-                ),
-                correction_target_lab,
-                channel_axis=2
-            ), cv2.COLOR_LAB2RGB).astype("uint8")
+    with span('color_correction'):
+        try:
+            from skimage import exposure
+        except:
+            print("Install scikit-image to perform color correction")
+            return img_rgb
+
+        if not do_color_correction: return img_rgb
+        if correction_target_lab is None: return img_rgb
+
+        return (
+            Image.fromarray(cv2.cvtColor(exposure.match_histograms(
+                    cv2.cvtColor(
+                        np.asarray(img_rgb),
+                        cv2.COLOR_RGB2LAB
+                    ),
+                    correction_target_lab,
+                    channel_axis=2
+                ), cv2.COLOR_LAB2RGB).astype("uint8")
+            )
         )
-    )
 
 def process_images(
         outpath, func_init, func_sample, prompt, seed, sampler_name, skip_grid, skip_save, batch_size,
@@ -896,12 +774,10 @@ def process_images(
 
     # check and replace nsfw content
     def check_safety(x_image):
-        global safety_feature_extractor, safety_checker
-        if safety_feature_extractor is None:
-            safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id)
-            safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
+        safety_feature_extractor, safety_checker = residency.get('safety_checker')
         safety_checker_input = safety_feature_extractor(numpy_to_pil(x_image), return_tensors="pt")
         x_checked_image, has_nsfw_concept = safety_checker(images=x_image, clip_input=safety_checker_input.pixel_values)
+        residency.release('safety_checker')
         for i in range(len(has_nsfw_concept)):
             if has_nsfw_concept[i]:
                 x_checked_image[i] = load_replacement(x_checked_image[i])
@@ -912,411 +788,402 @@ def process_images(
     # start time after garbage collection (or before?)
     start_time = time.time()
 
-    mem_mon = MemUsageMonitor('MemMon')
-    mem_mon.start()
-
-    if hasattr(model, "embedding_manager"):
-        load_embeddings(fp)
-
-    os.makedirs(outpath, exist_ok=True)
-
-    sample_path = os.path.join(outpath, "samples")
-    os.makedirs(sample_path, exist_ok=True)
-
-    if not ("|" in prompt) and prompt.startswith("@"):
-        prompt = prompt[1:]
-
-    negprompt = ''
-    if '###' in prompt:
-        prompt, negprompt = prompt.split('###', 1)
-        prompt = prompt.strip()
-        negprompt = negprompt.strip()
-
-    comments = []
-
-    prompt_matrix_parts = []
-    simple_templating = False
-    add_original_image = True
-    if prompt_matrix:
-        if prompt.startswith("@"):
-            simple_templating = True
-            add_original_image = not (use_RealESRGAN or use_GFPGAN)
-            all_seeds, n_iter, prompt_matrix_parts, all_prompts, frows = oxlamon_matrix(prompt, seed, n_iter, batch_size)
-        else:
-            all_prompts = []
-            prompt_matrix_parts = prompt.split("|")
-            combination_count = 2 ** (len(prompt_matrix_parts) - 1)
-            for combination_num in range(combination_count):
-                current = prompt_matrix_parts[0]
+    usage = get_telemetry(opt.gpu).begin_job()
+    trace = Trace('img2img' if init_img is not None else 'txt2img', sampler=sampler_name, steps=steps, width=width, height=height, batch_size=batch_size, n_iter=n_iter)
+    trace_token = current_trace.set(trace)
+    try:
+        if hasattr(model, "embedding_manager"):
+            load_embeddings(fp)
 
-                for n, text in enumerate(prompt_matrix_parts[1:]):
-                    if combination_num & (2 ** n) > 0:
-                        current += ("" if text.strip().startswith(",") else ", ") + text
+        os.makedirs(outpath, exist_ok=True)
 
-                all_prompts.append(current)
+        sample_path = os.path.join(outpath, "samples")
+        os.makedirs(sample_path, exist_ok=True)
 
-            n_iter = math.ceil(len(all_prompts) / batch_size)
-            all_seeds = len(all_prompts) * [seed]
+        if not ("|" in prompt) and prompt.startswith("@"):
+            prompt = prompt[1:]
 
-        print(f"Prompt matrix will create {len(all_prompts)} images using a total of {n_iter} batches.")
-    else:
+        negprompt = ''
+        if '###' in prompt:
+            prompt, negprompt = prompt.split('###', 1)
+            prompt = prompt.strip()
+            negprompt = negprompt.strip()
 
-        if not opt.no_verify_input:
-            try:
-                check_prompt_length(prompt, comments)
-            except:
-                import traceback
-                print("Error verifying input:", file=sys.stderr)
-                print(traceback.format_exc(), file=sys.stderr)
-
-        all_prompts = batch_size * n_iter * [prompt]
-        all_seeds = [seed + x for x in range(len(all_prompts))]
-    original_seeds = all_seeds.copy()
-
-    precision_scope = autocast if opt.precision == "autocast" else nullcontext
-    if job_info:
-        output_images = job_info.images
-    else:
-        output_images = []
-    grid_captions = []
-    stats = []
-    with torch.no_grad(), precision_scope("cuda"), (model.ema_scope() if not opt.optimized else nullcontext()):
-        init_data = func_init()
-        tic = time.time()
-
-
-        # if variant_amount > 0.0 create noise from base seed
-        base_x = None
-        if variant_amount > 0.0:
-            target_seed_randomizer = seed_to_int('') # random seed
-            torch.manual_seed(seed) # this has to be the single starting seed (not per-iteration)
-            base_x = create_random_tensors([opt_C, height // opt_f, width // opt_f], seeds=[seed])
-            # we don't want all_seeds to be sequential from starting seed with variants,
-            # since that makes the same variants each time,
-            # so we add target_seed_randomizer as a random offset
-            for si in range(len(all_seeds)):
-                all_seeds[si] += target_seed_randomizer
-
-        for n in range(n_iter):
-            if job_info and job_info.should_stop.is_set():
-                print("Early exit requested")
-                break
-
-            print(f"Iteration: {n+1}/{n_iter}")
-            prompts = all_prompts[n * batch_size:(n + 1) * batch_size]
-            captions = prompt_matrix_parts[n * batch_size:(n + 1) * batch_size]
-            seeds = all_seeds[n * batch_size:(n + 1) * batch_size]
-            current_seeds = original_seeds[n * batch_size:(n + 1) * batch_size]
-
-            if job_info:
-                job_info.job_status = f"Processing Iteration {n+1}/{n_iter}. Batch size {batch_size}"
-                job_info.rec_steps_imgs.clear()
-                for idx,(p,s) in enumerate(zip(prompts,seeds)):
-                    job_info.job_status += f"\nItem {idx}: Seed {s}\nPrompt: {p}"
-                    print(f"Current prompt: {p}")
+        comments = []
 
-            if opt.optimized:
-                modelCS.to(device)
-            uc = (model if not opt.optimized else modelCS).get_learned_conditioning(len(prompts) * [negprompt])
-            if isinstance(prompts, tuple):
-                prompts = list(prompts)
+        prompt_matrix_parts = []
+        simple_templating = False
+        add_original_image = True
+        if prompt_matrix:
+            if prompt.startswith("@"):
+                simple_templating = True
+                add_original_image = not (use_RealESRGAN or use_GFPGAN)
+                all_seeds, n_iter, prompt_matrix_parts, all_prompts, frows = oxlamon_matrix(prompt, seed, n_iter, batch_size)
+            else:
+                all_prompts = []
+                prompt_matrix_parts = prompt.split("|")
+                combination_count = 2 ** (len(prompt_matrix_parts) - 1)
+                for combination_num in range(combination_count):
+                    current = prompt_matrix_parts[0]
 
-            # split the prompt if it has : for weighting
-            # TODO for speed it might help to have this occur when all_prompts filled??
-            weighted_subprompts = split_weighted_subprompts(prompts[0], normalize_prompt_weights)
+                    for n, text in enumerate(prompt_matrix_parts[1:]):
+                        if combination_num & (2 ** n) > 0:
+                            current += ("" if text.strip().startswith(",") else ", ") + text
 
-            # sub-prompt weighting used if more than 1
-            if len(weighted_subprompts) > 1:
-                c = torch.zeros_like(uc) # i dont know if this is correct.. but it works
-                for i in range(0, len(weighted_subprompts)):
-                    # note if alpha negative, it functions same as torch.sub
-                    c = torch.add(c, (model if not opt.optimized else modelCS).get_learned_conditioning(weighted_subprompts[i][0]), alpha=weighted_subprompts[i][1])
-            else: # just behave like usual
-                c = (model if not opt.optimized else modelCS).get_learned_conditioning(prompts)
+                    all_prompts.append(current)
 
-            shape = [opt_C, height // opt_f, width // opt_f]
+                n_iter = math.ceil(len(all_prompts) / batch_size)
+                all_seeds = len(all_prompts) * [seed]
 
-            if opt.optimized:
-                mem = torch.cuda.memory_allocated()/1e6
-                modelCS.to("cpu")
-                while(torch.cuda.memory_allocated()/1e6 >= mem):
-                    time.sleep(1)
-
-            cur_variant_amount = variant_amount
-            if variant_amount == 0.0:
-                # we manually generate all input noises because each one should have a specific seed
-                x = create_random_tensors(shape, seeds=seeds)
-            else: # we are making variants
-                # using variant_seed as sneaky toggle,
-                # when not None or '' use the variant_seed
-                # otherwise use seeds
-                if variant_seed != None and variant_seed != '':
-                    specified_variant_seed = seed_to_int(variant_seed)
-                    torch.manual_seed(specified_variant_seed)
-                    target_x = create_random_tensors(shape, seeds=[specified_variant_seed])
-                    # with a variant seed we would end up with the same variant as the basic seed
-                    # does not change. But we can increase the steps to get an interesting result
-                    # that shows more and more deviation of the original image and let us adjust
-                    # how far we will go (using 10 iterations with variation amount set to 0.02 will
-                    # generate an icreasingly variated image which is very interesting for movies)
-                    cur_variant_amount += n*variant_amount
-                else:
-                    target_x = create_random_tensors(shape, seeds=seeds)
-                # finally, slerp base_x noise to target_x noise for creating a variant
-                x = slerp(device, max(0.0, min(1.0, cur_variant_amount)), base_x, target_x)
+            print(f"Prompt matrix will create {len(all_prompts)} images using a total of {n_iter} batches.")
+        else:
 
-            # If optimized then use first stage for preview and store it on cpu until needed
-            if opt.optimized:
-                step_preview_model = modelFS
-                step_preview_model.cpu()
-            else:
-                step_preview_model = model
+            if not opt.no_verify_input:
+                try:
+                    check_prompt_length(prompt, comments)
+                except:
+                    import traceback
+                    print("Error verifying input:", file=sys.stderr)
+                    print(traceback.format_exc(), file=sys.stderr)
+
+            all_prompts = batch_size * n_iter * [prompt]
+            all_seeds = [seed + x for x in range(len(all_prompts))]
+        original_seeds = all_seeds.copy()
+
+        precision_scope = autocast if opt.precision == "autocast" else nullcontext
+        if job_info:
+            output_images = job_info.images
+        else:
+            output_images = []
+        grid_captions = []
+        stats = []
+        with torch.no_grad(), precision_scope("cuda"), (model.ema_scope() if not opt.optimized else nullcontext()):
+            init_data = func_init()
+            tic = time.time()
+
+
+            # if variant_amount > 0.0 create noise from base seed
+            base_x = None
+            if variant_amount > 0.0:
+                target_seed_randomizer = seed_to_int('') # random seed
+                # this has to be the single starting seed (not per-iteration)
+                base_x = create_random_tensors([opt_C, height // opt_f, width // opt_f], seeds=[seed], device=device, cpu=opt.cpu_noise)
+                # we don't want all_seeds to be sequential from starting seed with variants,
+                # since that makes the same variants each time,
+                # so we add target_seed_randomizer as a random offset
+                for si in range(len(all_seeds)):
+                    all_seeds[si] += target_seed_randomizer
+
+            for n in range(n_iter):
+                if job_info and job_info.should_stop.is_set():
+                    print("Early exit requested")
+                    break
+
+                print(f"Iteration: {n+1}/{n_iter}")
+                prompts = all_prompts[n * batch_size:(n + 1) * batch_size]
+                captions = prompt_matrix_parts[n * batch_size:(n + 1) * batch_size]
+                seeds = all_seeds[n * batch_size:(n + 1) * batch_size]
+                current_seeds = original_seeds[n * batch_size:(n + 1) * batch_size]
 
-            def sample_iteration_callback(image_sample: torch.Tensor, iter_num: int):
-                ''' Called from the sampler every iteration '''
                 if job_info:
-                    job_info.active_iteration_cnt = iter_num
-                    record_periodic_image = job_info.rec_steps_enabled and (0 == iter_num % job_info.rec_steps_intrvl)
-                    if record_periodic_image or job_info.refresh_active_image_requested.is_set():
-                        preview_start_time = time.time()
-                        if opt.optimized:
-                            step_preview_model.to(device)
-
-                        decoded_batch: List[torch.Tensor] = []
-                        # Break up batch to save VRAM
-                        for sample in image_sample:
-                            sample = sample[None, :]  # expands the tensor as if it still had a batch dimension
-                            decoded_sample = step_preview_model.decode_first_stage(sample)[0]
-                            decoded_sample = torch.clamp((decoded_sample + 1.0) / 2.0, min=0.0, max=1.0)
-                            decoded_sample = decoded_sample.cpu()
-                            decoded_batch.append(decoded_sample)
-
-                        batch_size = len(decoded_batch)
-
-                        if opt.optimized:
-                            step_preview_model.cpu()
-
-                        images: List[Image.Image] = []
-                        # Convert tensor to image (copied from code below)
-                        for ddim in decoded_batch:
-                            x_sample = 255. * rearrange(ddim.numpy(), 'c h w -> h w c')
-                            x_sample = x_sample.astype(np.uint8)
-                            image = Image.fromarray(x_sample)
-                            images.append(image)
-
-                        caption = f"Iter {iter_num}"
-                        grid = image_grid(images, len(images), force_n_rows=1, captions=[caption]*len(images))
-
-                        # Save the images if recording steps, and append existing saved steps
-                        if job_info.rec_steps_enabled:
-                            gallery_img_size = tuple(int(0.25*dim) for dim in images[0].size)
-                            job_info.rec_steps_imgs.append(grid.resize(gallery_img_size))
-
-                        # Notify the requester that the image is updated
-                        if job_info.refresh_active_image_requested.is_set():
-                            if job_info.rec_steps_enabled:
-                                grid_rows = None if batch_size == 1 else len(job_info.rec_steps_imgs)
-                                grid = image_grid(imgs=job_info.rec_steps_imgs[::-1], batch_size=1, force_n_rows=grid_rows)
-                            job_info.active_image = grid
-                            job_info.refresh_active_image_done.set()
-                            job_info.refresh_active_image_requested.clear()
-
-                        preview_elapsed_timed = time.time() - preview_start_time
-                        if preview_elapsed_timed / job_info.rec_steps_intrvl > 1:
-                            print(
-                                f"Warning: Preview generation is slowing image generation. It took {preview_elapsed_timed:.2f}s to generate progress images for batch of {batch_size} images!")
-
-                    # Interrupt current iteration?
-                    if job_info.stop_cur_iter.is_set():
-                        job_info.stop_cur_iter.clear()
-                        raise StopIteration()
+                    job_info.job_status = f"Processing Iteration {n+1}/{n_iter}. Batch size {batch_size}"
+                    job_info.rec_steps_imgs.clear()
+                    for idx,(p,s) in enumerate(zip(prompts,seeds)):
+                        job_info.job_status += f"\nItem {idx}: Seed {s}\nPrompt: {p}"
+                        print(f"Current prompt: {p}")
 
-            try:
-                samples_ddim = func_sample(init_data=init_data, x=x, conditioning=c, unconditional_conditioning=uc, sampler_name=sampler_name, img_callback=sample_iteration_callback)
-            except StopIteration:
-                print("Skipping iteration")
-                job_info.job_status = "Skipping iteration"
-                continue
-
-            if opt.optimized:
-                modelFS.to(device)
+                if opt.optimized:
+                    modelCS.to(device)
+                with span('text_encoder', sync=True):
+                    uc = (model if not opt.optimized else modelCS).get_learned_conditioning(len(prompts) * [negprompt])
+                    if isinstance(prompts, tuple):
+                        prompts = list(prompts)
 
-            for i in range(len(samples_ddim)):
-                x_samples_ddim = (model if not opt.optimized else modelFS).decode_first_stage(samples_ddim[i].unsqueeze(0))
-                x_sample = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
+                    # each row is conditioned on its own prompt, so a batch can mix prompts
+                    c = get_conditioning((model if not opt.optimized else modelCS), prompts, partial(split_weighted_subprompts, normalize=normalize_prompt_weights))
 
-                if filter_nsfw:
-                    x_samples_ddim_numpy = x_sample.cpu().permute(0, 2, 3, 1).numpy()
-                    x_checked_image, has_nsfw_concept = check_safety(x_samples_ddim_numpy)
-                    x_sample = torch.from_numpy(x_checked_image).permute(0, 3, 1, 2)
+                shape = [opt_C, height // opt_f, width // opt_f]
 
-                sanitized_prompt = prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})
-                if variant_seed != None and variant_seed != '':
+                if opt.optimized:
+                    mem = torch.cuda.memory_allocated()/1e6
+                    modelCS.to("cpu")
+                    while(torch.cuda.memory_allocated()/1e6 >= mem):
+                        time.sleep(1)
+
+                cur_variant_amount = variant_amount
+                # the step noise of ancestral samplers continues from the last seed drawn
+                rng_seed = seeds[-1]
+                with span('noise', sync=True):
                     if variant_amount == 0.0:
-                        seed_used = f"{current_seeds[i]}-{variant_seed}"
-                    else:
-                        seed_used = f"{seed}-{variant_seed}"
-                else:
-                   seed_used = f"{current_seeds[i]}"
-                if sort_samples:
-                    sanitized_prompt = sanitized_prompt[:128] #200 is too long
-                    sample_path_i = os.path.join(sample_path, sanitized_prompt)
-                    os.makedirs(sample_path_i, exist_ok=True)
-                    base_count = get_next_sequence_number(sample_path_i)
-                    filename = opt.filename_format or "[STEPS]_[SAMPLER]_[SEED]_[VARIANT_AMOUNT]"
+                        # we manually generate all input noises because each one should have a specific seed
+                        x = create_random_tensors(shape, seeds=seeds, device=device, cpu=opt.cpu_noise)
+                    else: # we are making variants
+                        # using variant_seed as sneaky toggle,
+                        # when not None or '' use the variant_seed
+                        # otherwise use seeds
+                        if variant_seed != None and variant_seed != '':
+                            specified_variant_seed = seed_to_int(variant_seed)
+                            rng_seed = specified_variant_seed
+                            target_x = create_random_tensors(shape, seeds=[specified_variant_seed], device=device, cpu=opt.cpu_noise)
+                            # with a variant seed we would end up with the same variant as the basic seed
+                            # does not change. But we can increase the steps to get an interesting result
+                            # that shows more and more deviation of the original image and let us adjust
+                            # how far we will go (using 10 iterations with variation amount set to 0.02 will
+                            # generate an icreasingly variated image which is very interesting for movies)
+                            cur_variant_amount += n*variant_amount
+                        else:
+                            target_x = create_random_tensors(shape, seeds=seeds, device=device, cpu=opt.cpu_noise)
+                        # finally, slerp base_x noise to target_x noise for creating a variant
+                        x = slerp(max(0.0, min(1.0, cur_variant_amount)), base_x, target_x)
+
+                # If optimized then use first stage for preview and store it on cpu until needed
+                if opt.optimized:
+                    step_preview_model = modelFS
+                    step_preview_model.cpu()
                 else:
-                    sample_path_i = sample_path
-                    base_count = get_next_sequence_number(sample_path_i)
-                    filename = opt.filename_format or "[STEPS]_[SAMPLER]_[SEED]_[VARIANT_AMOUNT]_[PROMPT]"
-
-                #Add new filenames tags here
-                filename = f"{base_count:05}-" + filename
-                filename = filename.replace("[STEPS]", str(steps))
-                filename = filename.replace("[CFG]", str(cfg_scale))
-                filename = filename.replace("[PROMPT]", sanitized_prompt[:128])
-                filename = filename.replace("[PROMPT_SPACES]", prompts[i].translate({ord(x): '' for x in invalid_filename_chars})[:128])
-                filename = filename.replace("[WIDTH]", str(width))
-                filename = filename.replace("[HEIGHT]", str(height))
-                filename = filename.replace("[SAMPLER]", sampler_name)
-                filename = filename.replace("[SEED]", seed_used)
-                filename = filename.replace("[VARIANT_AMOUNT]", f"{cur_variant_amount:.2f}")
-
-                x_sample = 255. * rearrange(x_sample[0].cpu().numpy(), 'c h w -> h w c')
-                x_sample = x_sample.astype(np.uint8)
-                metadata = ImageMetadata(prompt=prompts[i], seed=seeds[i], height=height, width=width, steps=steps,
-                                    cfg_scale=cfg_scale, normalize_prompt_weights=normalize_prompt_weights, denoising_strength=denoising_strength,
-                                    GFPGAN=use_GFPGAN )
-                image = Image.fromarray(x_sample)
-                image = perform_color_correction(image, correction_target, do_color_correction)
-                ImageMetadata.set_on_image(image, metadata)
+                    step_preview_model = model
+
+                def sample_iteration_callback(image_sample: torch.Tensor, iter_num: int):
+                    ''' Called from the sampler every iteration '''
+                    if job_info:
+                        job_info.active_iteration_cnt = iter_num
+                        record_periodic_image = job_info.rec_steps_enabled and (0 == iter_num % job_info.rec_steps_intrvl)
+                        if record_periodic_image or job_info.refresh_active_image_requested.is_set():
+                            preview_start_time = time.time()
+                            if opt.preview_mode == 'latent':
+                                # a linear map of the latents, no VAE pass
+                                images: List[Image.Image] = [Image.fromarray(x_sample) for x_sample in latent_preview(image_sample)]
+                            else:
+                                if opt.optimized:
+                                    step_preview_model.to(device)
+
+                                # decodes as many samples at once as VRAM allows
+                                images: List[Image.Image] = [Image.fromarray(x_sample) for x_sample in first_stage_decoder(step_preview_model.decode_first_stage, image_sample)]
+
+                                if opt.optimized:
+                                    step_preview_model.cpu()
+
+                            batch_size = len(images)
+
+                            caption = f"Iter {iter_num}"
+                            grid = image_grid(images, len(images), force_n_rows=1, captions=[caption]*len(images))
+
+                            # Save the images if recording steps, and append existing saved steps
+                            if job_info.rec_steps_enabled:
+                                gallery_img_size = tuple(int(0.25*dim) for dim in images[0].size)
+                                job_info.rec_steps_imgs.append(grid.resize(gallery_img_size))
+
+                            # Notify the requester that the image is updated
+                            if job_info.refresh_active_image_requested.is_set():
+                                if job_info.rec_steps_enabled:
+                                    grid_rows = None if batch_size == 1 else len(job_info.rec_steps_imgs)
+                                    grid = image_grid(imgs=job_info.rec_steps_imgs[::-1], batch_size=1, force_n_rows=grid_rows)
+                                job_info.active_image = grid
+                                job_info.refresh_active_image_done.set()
+                                job_info.refresh_active_image_requested.clear()
+
+                            preview_elapsed_timed = time.time() - preview_start_time
+                            if preview_elapsed_timed / job_info.rec_steps_intrvl > 1:
+                                print(
+                                    f"Warning: Preview generation is slowing image generation. It took {preview_elapsed_timed:.2f}s to generate progress images for batch of {batch_size} images!")
+
+                        # Interrupt current iteration?
+                        if job_info.stop_cur_iter.is_set():
+                            job_info.stop_cur_iter.clear()
+                            raise StopIteration()
+
+                try:
+                    with seeded_rng(rng_seed, shape, device, cpu=opt.cpu_noise), span('sampling', sync=True):
+                        samples_ddim = func_sample(init_data=init_data, x=x, conditioning=c, unconditional_conditioning=uc, sampler_name=sampler_name, img_callback=sample_iteration_callback)
+                except StopIteration:
+                    print("Skipping iteration")
+                    job_info.job_status = "Skipping iteration"
+                    continue
 
-                original_sample = x_sample
-                original_filename = filename
-                if use_GFPGAN and GFPGAN is not None and not use_RealESRGAN:
-                    skip_save = True # #287 >_>
+                if opt.optimized:
+                    modelFS.to(device)
+
+                # decodes in micro-batches; sample i is copied to the host while the next ones decode
+                with span('vae_decode', sync=True):
+                    decoded = first_stage_decoder((model if not opt.optimized else modelFS).decode_first_stage, samples_ddim, to_uint8=not filter_nsfw)
+                    x_samples = []
+                    for x_sample in decoded:
+                        if filter_nsfw:
+                            with span('safety_checker'):
+                                x_checked_image, has_nsfw_concept = check_safety(x_sample[None])
+                            x_sample = (255. * x_checked_image[0]).astype(np.uint8)
+                        x_samples.append(x_sample)
+
+                # faces and upscales for the whole batch at once
+                if use_GFPGAN and GFPGAN is not None or use_RealESRGAN and RealESRGAN is not None:
                     torch_gc()
-                    cropped_faces, restored_faces, restored_img = GFPGAN.enhance(original_sample[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
-                    gfpgan_sample = restored_img[:,:,::-1]
-                    gfpgan_image = Image.fromarray(gfpgan_sample)
-                    gfpgan_image = perform_color_correction(gfpgan_image, correction_target, do_color_correction)
-                    gfpgan_image = perform_masked_image_restoration(
-                        gfpgan_image, init_img, init_mask,
+                with span('gfpgan', sync=True):
+                    gfpgan_samples = postprocessor.restore_faces(GFPGAN, x_samples) if use_GFPGAN and GFPGAN is not None else None
+                with span('realesrgan', sync=True):
+                    esrgan_samples = postprocessor.upscale(RealESRGAN, gfpgan_samples or x_samples) if use_RealESRGAN and RealESRGAN is not None else None
+
+                for i, x_sample in enumerate(x_samples):
+                    sanitized_prompt = prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})
+                    if variant_seed != None and variant_seed != '':
+                        if variant_amount == 0.0:
+                            seed_used = f"{current_seeds[i]}-{variant_seed}"
+                        else:
+                            seed_used = f"{seed}-{variant_seed}"
+                    else:
+                       seed_used = f"{current_seeds[i]}"
+                    if sort_samples:
+                        sanitized_prompt = sanitized_prompt[:128] #200 is too long
+                        sample_path_i = os.path.join(sample_path, sanitized_prompt)
+                        os.makedirs(sample_path_i, exist_ok=True)
+                        base_count = get_next_sequence_number(sample_path_i)
+                        filename = opt.filename_format or "[STEPS]_[SAMPLER]_[SEED]_[VARIANT_AMOUNT]"
+                    else:
+                        sample_path_i = sample_path
+                        base_count = get_next_sequence_number(sample_path_i)
+                        filename = opt.filename_format or "[STEPS]_[SAMPLER]_[SEED]_[VARIANT_AMOUNT]_[PROMPT]"
+
+                    #Add new filenames tags here
+                    filename = f"{base_count:05}-" + filename
+                    filename = filename.replace("[STEPS]", str(steps))
+                    filename = filename.replace("[CFG]", str(cfg_scale))
+                    filename = filename.replace("[PROMPT]", sanitized_prompt[:128])
+                    filename = filename.replace("[PROMPT_SPACES]", prompts[i].translate({ord(x): '' for x in invalid_filename_chars})[:128])
+                    filename = filename.replace("[WIDTH]", str(width))
+                    filename = filename.replace("[HEIGHT]", str(height))
+                    filename = filename.replace("[SAMPLER]", sampler_name)
+                    filename = filename.replace("[SEED]", seed_used)
+                    filename = filename.replace("[VARIANT_AMOUNT]", f"{cur_variant_amount:.2f}")
+
+                    metadata = ImageMetadata(prompt=prompts[i], seed=seeds[i], height=height, width=width, steps=steps,
+                                        cfg_scale=cfg_scale, normalize_prompt_weights=normalize_prompt_weights, denoising_strength=denoising_strength,
+                                        GFPGAN=use_GFPGAN )
+                    image = Image.fromarray(x_sample)
+                    image = perform_color_correction(image, correction_target, do_color_correction)
+                    ImageMetadata.set_on_image(image, metadata)
+
+                    original_sample = x_sample
+                    original_filename = filename
+                    if use_GFPGAN and GFPGAN is not None and not use_RealESRGAN:
+                        skip_save = True # #287 >_>
+                        gfpgan_sample = gfpgan_samples[i]
+                        gfpgan_image = Image.fromarray(gfpgan_sample)
+                        gfpgan_image = perform_color_correction(gfpgan_image, correction_target, do_color_correction)
+                        gfpgan_image = perform_masked_image_restoration(
+                            gfpgan_image, init_img, init_mask,
+                            mask_blur_strength, mask_restore,
+                            use_RealESRGAN = False, RealESRGAN = None
+                        )
+                        gfpgan_metadata = copy.copy(metadata)
+                        gfpgan_metadata.GFPGAN = True
+                        ImageMetadata.set_on_image( gfpgan_image, gfpgan_metadata )
+                        gfpgan_filename = original_filename + '-gfpgan'
+                        save_sample(gfpgan_image, sample_path_i, gfpgan_filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
+    skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=False)
+                        output_images.append(gfpgan_image) #287
+                        #if simple_templating:
+                        #    grid_captions.append( captions[i] + "\ngfpgan" )
+
+                    if use_RealESRGAN and RealESRGAN is not None and not use_GFPGAN:
+                        skip_save = True # #287 >_>
+                        esrgan_filename = original_filename + '-esrgan4x'
+                        esrgan_sample = esrgan_samples[i]
+                        esrgan_image = Image.fromarray(esrgan_sample)
+                        esrgan_image = perform_color_correction(esrgan_image, correction_target, do_color_correction)
+                        esrgan_image = perform_masked_image_restoration(
+                            esrgan_image, init_img, init_mask,
+                            mask_blur_strength, mask_restore,
+                            use_RealESRGAN, RealESRGAN
+                        )
+                        ImageMetadata.set_on_image( esrgan_image, metadata )
+                        save_sample(esrgan_image, sample_path_i, esrgan_filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
+    skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=False)
+                        output_images.append(esrgan_image) #287
+                        #if simple_templating:
+                        #    grid_captions.append( captions[i] + "\nesrgan" )
+
+                    if use_RealESRGAN and RealESRGAN is not None and use_GFPGAN and GFPGAN is not None:
+                        skip_save = True # #287 >_>
+                        gfpgan_esrgan_filename = original_filename + '-gfpgan-esrgan4x'
+                        gfpgan_esrgan_sample = esrgan_samples[i]
+                        gfpgan_esrgan_image = Image.fromarray(gfpgan_esrgan_sample)
+                        gfpgan_esrgan_image = perform_color_correction(gfpgan_esrgan_image, correction_target, do_color_correction)
+                        gfpgan_esrgan_image = perform_masked_image_restoration(
+                            gfpgan_esrgan_image, init_img, init_mask,
+                            mask_blur_strength, mask_restore,
+                            use_RealESRGAN, RealESRGAN
+                        )
+                        ImageMetadata.set_on_image(gfpgan_esrgan_image, metadata)
+                        save_sample(gfpgan_esrgan_image, sample_path_i, gfpgan_esrgan_filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback,
+    skip_save, skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=False)
+                        output_images.append(gfpgan_esrgan_image) #287
+                        #if simple_templating:
+                        #    grid_captions.append( captions[i] + "\ngfpgan_esrgan" )
+
+                    # this flag is used for imgProcessorTasks like GoBig, will return the image without saving it
+                    if imgProcessorTask == True:
+                        output_images.append(image)
+
+                    image = perform_masked_image_restoration(
+                        image, init_img, init_mask,
                         mask_blur_strength, mask_restore,
+                        # RealESRGAN image already processed in if-case above.
                         use_RealESRGAN = False, RealESRGAN = None
                     )
-                    gfpgan_metadata = copy.copy(metadata)
-                    gfpgan_metadata.GFPGAN = True
-                    ImageMetadata.set_on_image( gfpgan_image, gfpgan_metadata )
-                    gfpgan_filename = original_filename + '-gfpgan'
-                    save_sample(gfpgan_image, sample_path_i, gfpgan_filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
-skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=False)
-                    output_images.append(gfpgan_image) #287
-                    #if simple_templating:
-                    #    grid_captions.append( captions[i] + "\ngfpgan" )
-
-                if use_RealESRGAN and RealESRGAN is not None and not use_GFPGAN:
-                    skip_save = True # #287 >_>
-                    torch_gc()
-                    output, img_mode = RealESRGAN.enhance(original_sample[:,:,::-1])
-                    esrgan_filename = original_filename + '-esrgan4x'
-                    esrgan_sample = output[:,:,::-1]
-                    esrgan_image = Image.fromarray(esrgan_sample)
-                    esrgan_image = perform_color_correction(esrgan_image, correction_target, do_color_correction)
-                    esrgan_image = perform_masked_image_restoration(
-                        esrgan_image, init_img, init_mask,
-                        mask_blur_strength, mask_restore,
-                        use_RealESRGAN, RealESRGAN
-                    )
-                    ImageMetadata.set_on_image( esrgan_image, metadata )
-                    save_sample(esrgan_image, sample_path_i, esrgan_filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
-skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=False)
-                    output_images.append(esrgan_image) #287
-                    #if simple_templating:
-                    #    grid_captions.append( captions[i] + "\nesrgan" )
-
-                if use_RealESRGAN and RealESRGAN is not None and use_GFPGAN and GFPGAN is not None:
-                    skip_save = True # #287 >_>
-                    torch_gc()
-                    cropped_faces, restored_faces, restored_img = GFPGAN.enhance(x_sample[:,:,::-1], has_aligned=False, only_center_face=False, paste_back=True)
-                    gfpgan_sample = restored_img[:,:,::-1]
-                    output, img_mode = RealESRGAN.enhance(gfpgan_sample[:,:,::-1])
-                    gfpgan_esrgan_filename = original_filename + '-gfpgan-esrgan4x'
-                    gfpgan_esrgan_sample = output[:,:,::-1]
-                    gfpgan_esrgan_image = Image.fromarray(gfpgan_esrgan_sample)
-                    gfpgan_esrgan_image = perform_color_correction(gfpgan_esrgan_image, correction_target, do_color_correction)
-                    gfpgan_esrgan_image = perform_masked_image_restoration(
-                        gfpgan_esrgan_image, init_img, init_mask,
-                        mask_blur_strength, mask_restore,
-                        use_RealESRGAN, RealESRGAN
-                    )
-                    ImageMetadata.set_on_image(gfpgan_esrgan_image, metadata)
-                    save_sample(gfpgan_esrgan_image, sample_path_i, gfpgan_esrgan_filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback,
-skip_save, skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, skip_metadata=False)
-                    output_images.append(gfpgan_esrgan_image) #287
-                    #if simple_templating:
-                    #    grid_captions.append( captions[i] + "\ngfpgan_esrgan" )
-
-                # this flag is used for imgProcessorTasks like GoBig, will return the image without saving it
-                if imgProcessorTask == True:
-                    output_images.append(image)
-
-                image = perform_masked_image_restoration(
-                    image, init_img, init_mask,
-                    mask_blur_strength, mask_restore,
-                    # RealESRGAN image already processed in if-case above.
-                    use_RealESRGAN = False, RealESRGAN = None
-                )
-
-                if not skip_save:
-                    save_sample(image, sample_path_i, filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
-skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, False)
-                if add_original_image or not simple_templating:
-                    output_images.append(image)
-                    if simple_templating:
-                        grid_captions.append( captions[i] )
-
-            # Save the progress images?
-            if job_info:
-                if job_info.rec_steps_enabled and (job_info.rec_steps_to_file or job_info.rec_steps_to_gallery):
-                    steps_grid = image_grid(job_info.rec_steps_imgs, 1)
-                    if job_info.rec_steps_to_gallery:
-                        gallery_img_size = tuple(2*dim for dim in image.size)
-                        output_images.append( steps_grid.resize( gallery_img_size ) )
-                    if job_info.rec_steps_to_file:
-                        steps_grid_filename = f"{original_filename}_step_grid"
-                        save_sample(steps_grid, sample_path_i, steps_grid_filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
-                                    normalize_prompt_weights, use_GFPGAN, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
-                                    skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, False)
 
-            if opt.optimized:
-                mem = torch.cuda.memory_allocated()/1e6
-                modelFS.to("cpu")
-                while(torch.cuda.memory_allocated()/1e6 >= mem):
-                    time.sleep(1)
-
-        if (prompt_matrix or not skip_grid) and not do_not_save_grid:
-            grid = None
-            if prompt_matrix:
-                if simple_templating:
-                    grid = image_grid(output_images, batch_size, force_n_rows=frows, captions=grid_captions)
-                else:
-                    grid = image_grid(output_images, batch_size, force_n_rows=1 << ((len(prompt_matrix_parts)-1)//2))
-                    try:
-                        grid = draw_prompt_matrix(grid, width, height, prompt_matrix_parts)
-                    except:
-                        import traceback
-                        print("Error creating prompt_matrix text:", file=sys.stderr)
-                        print(traceback.format_exc(), file=sys.stderr)
-            elif len(output_images) > 0 and (batch_size > 1  or n_iter > 1):
-                grid = image_grid(output_images, batch_size)
-            if grid is not None:
-                grid_count = get_next_sequence_number(outpath, 'grid-')
-                grid_file = f"grid-{grid_count:05}-{seed}_{prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.{grid_ext}"
-                grid.save(os.path.join(outpath, grid_file), grid_format, quality=grid_quality, lossless=grid_lossless, optimize=True)
-
-        toc = time.time()
-
-    mem_max_used, mem_total = mem_mon.read_and_stop()
+                    if not skip_save:
+                        save_sample(image, sample_path_i, filename, jpg_sample, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
+    skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, False)
+                    if add_original_image or not simple_templating:
+                        output_images.append(image)
+                        if simple_templating:
+                            grid_captions.append( captions[i] )
+
+                # Save the progress images?
+                if job_info:
+                    if job_info.rec_steps_enabled and (job_info.rec_steps_to_file or job_info.rec_steps_to_gallery):
+                        steps_grid = image_grid(job_info.rec_steps_imgs, 1)
+                        if job_info.rec_steps_to_gallery:
+                            gallery_img_size = tuple(2*dim for dim in image.size)
+                            output_images.append( steps_grid.resize( gallery_img_size ) )
+                        if job_info.rec_steps_to_file:
+                            steps_grid_filename = f"{original_filename}_step_grid"
+                            save_sample(steps_grid, sample_path_i, steps_grid_filename, jpg_sample, prompts, seeds, width, height, steps, cfg_scale,
+                                        normalize_prompt_weights, use_GFPGAN, write_info_files, write_sample_info_to_log_file, prompt_matrix, init_img, uses_loopback, uses_random_seed_loopback, skip_save,
+                                        skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoising_strength, resize_mode, False)
+
+                if opt.optimized:
+                    mem = torch.cuda.memory_allocated()/1e6
+                    modelFS.to("cpu")
+                    while(torch.cuda.memory_allocated()/1e6 >= mem):
+                        time.sleep(1)
+
+            if (prompt_matrix or not skip_grid) and not do_not_save_grid:
+                grid = None
+                if prompt_matrix:
+                    if simple_templating:
+                        grid = image_grid(output_images, batch_size, force_n_rows=frows, captions=grid_captions)
+                    else:
+                        grid = image_grid(output_images, batch_size, force_n_rows=1 << ((len(prompt_matrix_parts)-1)//2))
+                        try:
+                            grid = draw_prompt_matrix(grid, width, height, prompt_matrix_parts)
+                        except:
+                            import traceback
+                            print("Error creating prompt_matrix text:", file=sys.stderr)
+                            print(traceback.format_exc(), file=sys.stderr)
+                elif len(output_images) > 0 and (batch_size > 1  or n_iter > 1):
+                    grid = image_grid(output_images, batch_size)
+                if grid is not None:
+                    grid_count = get_next_sequence_number(outpath, 'grid-')
+                    grid_file = f"grid-{grid_count:05}-{seed}_{prompts[i].replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.{grid_ext}"
+                    with span('save'):
+                        image_writer.submit(trace.wrap('encode_write', grid.save), os.path.join(outpath, grid_file), grid_format, quality=grid_quality, lossless=grid_lossless, optimize=True,
+                                            paths=[os.path.join(outpath, grid_file)])
+
+            toc = time.time()
+    finally:
+        usage = get_telemetry(opt.gpu).end_job(usage)
+        current_trace.reset(trace_token)
+        trace.finish()
     time_diff = time.time()-start_time
     args_and_names = {
         "seed": seed,
@@ -1336,13 +1203,12 @@ skip_grid, sort_samples, sampler_name, ddim_eta, n_iter, batch_size, i, denoisin
 # {prompt} --seed {seed} --W {width} --H {height}  -s {steps} -C {cfg_scale} --sampler {sampler_name}  {', Denoising strength: '+str(denoising_strength) if init_img is not None else ''}{', GFPGAN' if use_GFPGAN and GFPGAN is not None else ''}{', '+realesrgan_model_name if use_RealESRGAN and RealESRGAN is not None else ''}{', Prompt Matrix Mode.' if prompt_matrix else ''}""".strip()
     stats = f'''
 Took { round(time_diff, 2) }s total ({ round(time_diff/(len(all_prompts)),2) }s per image)
-Peak memory usage: { -(mem_max_used // -1_048_576) } MiB / { -(mem_total // -1_048_576) } MiB / { round(mem_max_used/mem_total*100, 3) }%'''
+{format_usage(usage)}
+{trace.summary()}'''
 
     for comment in comments:
         info['text'] += "\n\n" + comment
 
-    #mem_mon.stop()
-    #del mem_mon
     torch_gc()
 
     return output_images, seed, info, stats
@@ -1350,10 +1216,12 @@ Peak memory usage: { -(mem_max_used // -1_048_576) } MiB / { -(mem_total // -1_0
 
 def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List[int], realesrgan_model_name: str,
             ddim_eta: float, n_iter: int, batch_size: int, cfg_scale: float, seed: Union[int, str, None],
-            height: int, width: int, fp, variant_amount: float = None, variant_seed: int = None, job_info: JobInfo = None):
+            height: int, width: int, fp, variant_amount: float = None, variant_seed: int = None,
+            cfg_sigma_min: float = 0.0, cfg_sigma_max: float = 0.0, job_info: JobInfo = None):
     outpath = opt.outdir_txt2img or opt.outdir or "outputs/txt2img-samples"
     err = False
     seed = seed_to_int(seed)
+    cfg_interval = guidance_interval(cfg_sigma_min, cfg_sigma_max)
     prompt_matrix = 0 in toggles
     normalize_prompt_weights = 1 in toggles
     skip_save = 2 not in toggles
@@ -1378,30 +1246,13 @@ def txt2img(prompt: str, ddim_steps: int, sampler_name: str, toggles: List[int],
         ModelLoader(['RealESRGAN'],True,False,realesrgan_model_name)
     if use_RealESRGAN and use_GFPGAN:
         ModelLoader(['GFPGAN','RealESRGAN'],True,False,realesrgan_model_name)
-    if sampler_name == 'PLMS':
-        sampler = PLMSSampler(model)
-    elif sampler_name == 'DDIM':
-        sampler = DDIMSampler(model)
-    elif sampler_name == 'k_dpm_2_a':
-        sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-    elif sampler_name == 'k_dpm_2':
-        sampler = KDiffusionSampler(model,'dpm_2')
-    elif sampler_name == 'k_euler_a':
-        sampler = KDiffusionSampler(model,'euler_ancestral')
-    elif sampler_name == 'k_euler':
-        sampler = KDiffusionSampler(model,'euler')
-    elif sampler_name == 'k_heun':
-        sampler = KDiffusionSampler(model,'heun')
-    elif sampler_name == 'k_lms':
-        sampler = KDiffusionSampler(model,'lms')
-    else:
-        raise Exception("Unknown sampler: " + sampler_name)
+    sampler = get_sampler(model, sampler_name)
 
     def init():
         pass
 
     def sample(init_data, x, conditioning, unconditional_conditioning, sampler_name, img_callback: Callable = None):
-        samples_ddim, _ = sampler.sample(S=ddim_steps, conditioning=conditioning, batch_size=int(x.shape[0]), shape=x[0].shape, verbose=False, unconditional_guidance_scale=cfg_scale, unconditional_conditioning=unconditional_conditioning, eta=ddim_eta, x_T=x, img_callback=img_callback)
+        samples_ddim, _ = sampler.sample(S=ddim_steps, conditioning=conditioning, batch_size=int(x.shape[0]), shape=x[0].shape, verbose=False, unconditional_guidance_scale=cfg_scale, unconditional_conditioning=unconditional_conditioning, eta=ddim_eta, x_T=x, img_callback=img_callback, cfg_interval=cfg_interval)
         return samples_ddim
 
     try:
@@ -1463,7 +1314,7 @@ class Flagging(gr.FlaggingCallback):
         os.makedirs("log/images", exist_ok=True)
 
         # those must match the "txt2img" function !! + images, seed, comment, stats !! NOTE: changes to UI output must be reflected here too
-        prompt, ddim_steps, sampler_name, toggles, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, variant_amount, variant_seed, images, seed, comment, stats = flag_data
+        prompt, ddim_steps, sampler_name, toggles, ddim_eta, n_iter, batch_size, cfg_scale, seed, height, width, fp, variant_amount, variant_seed, cfg_sigma_min, cfg_sigma_max, images, seed, comment, stats = flag_data
 
         filenames = []
 
@@ -1504,13 +1355,15 @@ def blurArr(a,r=8):
 
 def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_strength: int, mask_restore: bool, ddim_steps: int, sampler_name: str,
             toggles: List[int], realesrgan_model_name: str, n_iter: int,  cfg_scale: float, denoising_strength: float,
-            seed: int, height: int, width: int, resize_mode: int, init_info: any = None, init_info_mask: any = None, fp = None, job_info: JobInfo = None):
+            seed: int, height: int, width: int, resize_mode: int, init_info: any = None, init_info_mask: any = None, fp = None,
+            cfg_sigma_min: float = 0.0, cfg_sigma_max: float = 0.0, job_info: JobInfo = None):
     # print([prompt, image_editor_mode, init_info, init_info_mask, mask_mode,
     #                               mask_blur_strength, ddim_steps, sampler_name, toggles,
     #                               realesrgan_model_name, n_iter, cfg_scale,
     #                               denoising_strength, seed, height, width, resize_mode,
     #                               fp])
     outpath = opt.outdir_img2img or opt.outdir or "outputs/img2img-samples"
+    cfg_interval = guidance_interval(cfg_sigma_min, cfg_sigma_max)
     err = False
     seed = seed_to_int(seed)
 
@@ -1539,22 +1392,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
         ModelLoader(['RealESRGAN'],True,False,realesrgan_model_name)
     if use_RealESRGAN and use_GFPGAN:
         ModelLoader(['GFPGAN','RealESRGAN'],True,False,realesrgan_model_name)
-    if sampler_name == 'DDIM':
-        sampler = DDIMSampler(model)
-    elif sampler_name == 'k_dpm_2_a':
-        sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-    elif sampler_name == 'k_dpm_2':
-        sampler = KDiffusionSampler(model,'dpm_2')
-    elif sampler_name == 'k_euler_a':
-        sampler = KDiffusionSampler(model,'euler_ancestral')
-    elif sampler_name == 'k_euler':
-        sampler = KDiffusionSampler(model,'euler')
-    elif sampler_name == 'k_heun':
-        sampler = KDiffusionSampler(model,'heun')
-    elif sampler_name == 'k_lms':
-        sampler = KDiffusionSampler(model,'lms')
-    else:
-        raise Exception("Unknown sampler: " + sampler_name)
+    sampler = get_sampler(model, sampler_name)
 
     if image_editor_mode == 'Mask':
         init_img = init_info_mask["image"]
@@ -1682,12 +1520,12 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
 
             # Obliterate masked image
             if z_mask is not None and obliterate:
-                random = torch.randn(z_mask.shape, device=xi.device)
+                random = sampling_noise(z_mask.shape, xi.device)
                 xi = (z_mask * noise) + ((1-z_mask) * xi)
 
             sigma_sched = sigmas[ddim_steps - t_enc_steps - 1:]
-            model_wrap_cfg = CFGMaskedDenoiser(sampler.model_wrap)
-            samples_ddim = K.sampling.__dict__[f'sample_{sampler.get_sampler_name()}'](model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': cfg_scale, 'mask': z_mask, 'x0': x0, 'xi': xi}, disable=False, callback=partial(KDiffusionSampler.img_callback_wrapper, img_callback))
+            model_wrap_cfg = CFGMaskedDenoiser(sampler.model_wrap, cfg_interval)
+            samples_ddim = sampler.run(model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': cfg_scale, 'mask': z_mask, 'x0': x0, 'xi': xi}, disable=False, callback=partial(KDiffusionSampler.img_callback_wrapper, img_callback))
         else:
 
             x0, z_mask = init_data
@@ -1697,7 +1535,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
 
             # Obliterate masked image
             if z_mask is not None and obliterate:
-                random = torch.randn(z_mask.shape, device=z_enc.device)
+                random = sampling_noise(z_mask.shape, z_enc.device)
                 z_enc = (z_mask * random) + ((1-z_mask) * z_enc)
 
                                 # decode it
@@ -1778,7 +1616,7 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
             grid_count = get_next_sequence_number(outpath, 'grid-')
             grid = image_grid(history, batch_size, force_n_rows=1)
             grid_file = f"grid-{grid_count:05}-{seed}_{prompt.replace(' ', '_').translate({ord(x): '' for x in invalid_filename_chars})[:128]}.{grid_ext}"
-            grid.save(os.path.join(outpath, grid_file), grid_format, quality=grid_quality, lossless=grid_lossless, optimize=True)
+            image_writer.save(grid, os.path.join(outpath, grid_file), grid_format, quality=grid_quality, lossless=grid_lossless, optimize=True)
 
 
         output_images = history
@@ -1832,97 +1670,55 @@ def img2img(prompt: str, image_editor_mode: str, mask_mode: str, mask_blur_stren
     return output_images, seed, info, stats
 
 
-prompt_parser = re.compile("""
-    (?P<prompt>     # capture group for 'prompt'
-    (?:\\\:|[^:])+  # match one or more non ':' characters or escaped colons '\:'
-    )               # end 'prompt'
-    (?:             # non-capture group
-    :+              # match one or more ':' characters
-    (?P<weight>     # capture group for 'weight'
-    -?\d*\.{0,1}\d+ # match positive or negative integer or decimal number
-    )?              # end weight capture group, make optional
-    \s*             # strip spaces after weight
-    |               # OR
-    $               # else, if no ':' then match end of line
-    )               # end non-capture group
-""", re.VERBOSE)
-
-# grabs all text up to the first occurrence of ':' as sub-prompt
-# takes the value following ':' as weight
-# if ':' has no value defined, defaults to 1.0
-# repeats until no text remaining
-def split_weighted_subprompts(input_string, normalize=True):
-    parsed_prompts = [(match.group("prompt").replace("\\:", ":"), float(match.group("weight") or 1)) for match in re.finditer(prompt_parser, input_string)]
-    if not normalize:
-        return parsed_prompts
-    weight_sum = sum(map(lambda x: x[1], parsed_prompts))
-    if weight_sum == 0:
-        print("Warning: Subprompt weights add up to zero. Discarding and using even weights instead.")
-        equal_weight = 1 / (len(parsed_prompts) or 1)
-        return [(x[0], equal_weight) for x in parsed_prompts]
-    return [(x[0], x[1] / weight_sum) for x in parsed_prompts]
-
-def slerp(device, t, v0:torch.Tensor, v1:torch.Tensor, DOT_THRESHOLD=0.9995):
-    v0 = v0.detach().cpu().numpy()
-    v1 = v1.detach().cpu().numpy()
-
-    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
-    if np.abs(dot) > DOT_THRESHOLD:
-        v2 = (1 - t) * v0 + t * v1
-    else:
-        theta_0 = np.arccos(dot)
-        sin_theta_0 = np.sin(theta_0)
-        theta_t = theta_0 * t
-        sin_theta_t = np.sin(theta_t)
-        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
-        s1 = sin_theta_t / sin_theta_0
-        v2 = s0 * v0 + s1 * v1
-
-    v2 = torch.from_numpy(v2).to(device)
-
-    return v2
-
-
-
 def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_toggles,imgproc_realesrgan_model_name,imgproc_sampling,
  imgproc_steps, imgproc_height, imgproc_width, imgproc_cfg, imgproc_denoising, imgproc_seed,imgproc_gfpgan_strength,imgproc_ldsr_steps,imgproc_ldsr_pre_downSample,imgproc_ldsr_post_downSample):
 
     outpath = opt.outdir_imglab or opt.outdir or "outputs/imglab-samples"
     output = []
     images = []
-    def processGFPGAN(image,strength):
-        image = image.convert("RGB")
-        metadata = ImageMetadata.get_from_image(image)
-        cropped_faces, restored_faces, restored_img = GFPGAN.enhance(np.array(image, dtype=np.uint8), has_aligned=False, only_center_face=False, paste_back=True)
-        result = Image.fromarray(restored_img)
-        if metadata:
-            metadata.GFPGAN = True
-            ImageMetadata.set_on_image(image, metadata)
+    def processGFPGAN(images,strength):
+        # faces of all images are restored in batched passes
+        images = [image.convert("RGB") for image in images]
+        with span('gfpgan', sync=True):
+            restored = postprocessor.restore_faces(GFPGAN, [np.array(image, dtype=np.uint8) for image in images])
+        results = []
+        for image, restored_img in zip(images, restored):
+            metadata = ImageMetadata.get_from_image(image)
+            result = Image.fromarray(restored_img)
+            if metadata:
+                metadata.GFPGAN = True
+                ImageMetadata.set_on_image(image, metadata)
 
-        if strength < 1.0:
-            result = Image.blend(image, result, strength)
+            if strength < 1.0:
+                result = Image.blend(image, result, strength)
+            results.append(result)
 
-        return result
-    def processRealESRGAN(image):
+        return results
+    def processRealESRGAN(images):
         if 'x2' in imgproc_realesrgan_model_name:
             # downscale to 1/2 size
             modelMode = imgproc_realesrgan_model_name.replace('x2','x4')
         else:
             modelMode = imgproc_realesrgan_model_name
-        image = image.convert("RGB")
-        metadata = ImageMetadata.get_from_image(image)
-        RealESRGAN = load_RealESRGAN(modelMode)
-        result, res = RealESRGAN.enhance(np.array(image, dtype=np.uint8))
-        result = Image.fromarray(result)
-        ImageMetadata.set_on_image(result, metadata)
-        if 'x2' in imgproc_realesrgan_model_name:
-            # downscale to 1/2 size
-            result = result.resize((result.width//2, result.height//2), LANCZOS)
-
-        return result
+        images = [image.convert("RGB") for image in images]
+        RealESRGAN = residency.get(resident_RealESRGAN(modelMode))
+        # images of the same size are upscaled together, tile by tile
+        with span('realesrgan', sync=True):
+            upscaled = postprocessor.upscale(RealESRGAN, [np.array(image, dtype=np.uint8) for image in images])
+        results = []
+        for image, output in zip(images, upscaled):
+            metadata = ImageMetadata.get_from_image(image)
+            result = Image.fromarray(output)
+            ImageMetadata.set_on_image(result, metadata)
+            if 'x2' in imgproc_realesrgan_model_name:
+                # downscale to 1/2 size
+                result = result.resize((result.width//2, result.height//2), LANCZOS)
+            results.append(result)
+
+        return results
     def processGoBig(image):
         metadata = ImageMetadata.get_from_image(image)
-        result = processRealESRGAN(image,)
+        result = processRealESRGAN([image])[0]
         if 'x4' in imgproc_realesrgan_model_name:
             #downscale to 1/2 size
             result = result.resize((result.width//2, result.height//2), LANCZOS)
@@ -1930,212 +1726,76 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
 
 
         #make sense of parameters
-        n_iter = 1
-        batch_size = 1
         seed = seed_to_int(imgproc_seed)
         ddim_steps = int(imgproc_steps)
-        resize_mode = 0 #need to add resize mode to form, or infer correct resolution from file name
         width = int(imgproc_width)
         height = int(imgproc_height)
         cfg_scale = float(imgproc_cfg)
         denoising_strength = float(imgproc_denoising)
-        skip_save = True
-        skip_grid = True
         prompt = imgproc_prompt
+        negprompt = ''
+        if '###' in prompt:
+            prompt, negprompt = prompt.split('###', 1)
+            prompt = prompt.strip()
+            negprompt = negprompt.strip()
         t_enc = int(denoising_strength * ddim_steps)
         sampler_name = imgproc_sampling
+        batch_size = opt.gobig_batch_size
 
 
-        if sampler_name == 'DDIM':
-            sampler = DDIMSampler(model)
-        elif sampler_name == 'k_dpm_2_a':
-            sampler = KDiffusionSampler(model,'dpm_2_ancestral')
-        elif sampler_name == 'k_dpm_2':
-            sampler = KDiffusionSampler(model,'dpm_2')
-        elif sampler_name == 'k_euler_a':
-            sampler = KDiffusionSampler(model,'euler_ancestral')
-        elif sampler_name == 'k_euler':
-            sampler = KDiffusionSampler(model,'euler')
-        elif sampler_name == 'k_heun':
-            sampler = KDiffusionSampler(model,'heun')
-        elif sampler_name == 'k_lms':
-            sampler = KDiffusionSampler(model,'lms')
-        else:
-            raise Exception("Unknown sampler: " + sampler_name)
-            pass
-        init_img = result
-        init_mask = None
-        keep_mask = False
-        mask_restore = False
+        sampler = get_sampler(model, sampler_name)
         assert 0. <= denoising_strength <= 1., 'can only work with strength in [0.0, 1.0]'
+        first_stage = model if not opt.optimized else modelFS
+        cond_stage = model if not opt.optimized else modelCS
+
+        def encode(tiles):
+            init_image = torch.from_numpy(tiles).to(device).permute(0, 3, 1, 2).float() / 127.5 - 1.
+            return first_stage.get_first_stage_encoding(first_stage.encode_first_stage(init_image))  # move to latent space
+
+        def sample(x0):
+            # every tile starts from the same seed, like one process_images call per tile did
+            n = len(x0)
+            x = create_random_tensors(list(x0.shape[1:]), seeds=n * [seed], device=device, cpu=opt.cpu_noise)
+            c, uc = conditioning[:n], unconditional_conditioning[:n]
+            with seeded_rng(seed, list(x0.shape[1:]), device, cpu=opt.cpu_noise):
+                if sampler_name != 'DDIM':
+                    sigmas = sampler.model_wrap.get_sigmas(ddim_steps)
+                    noise = x * sigmas[ddim_steps - t_enc - 1]
+
+                    xi = x0 + noise
+                    sigma_sched = sigmas[ddim_steps - t_enc - 1:]
+                    model_wrap_cfg = CFGDenoiser(sampler.model_wrap)
+                    samples_ddim = sampler.run(model_wrap_cfg, xi, sigma_sched, extra_args={'cond': c, 'uncond': uc, 'cond_scale': cfg_scale}, disable=False)
+                else:
+                    sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=0.0, verbose=False)
+                    z_enc = sampler.stochastic_encode(x0, torch.tensor([t_enc]*n).to(device))
+                                        # decode it
+                    samples_ddim = sampler.decode(z_enc, c, t_enc,
+                                                    unconditional_guidance_scale=cfg_scale,
+                                                    unconditional_conditioning=uc,)
+            return samples_ddim
 
-        def init():
-            image = init_img.convert("RGB")
-            image = resize_image(resize_mode, image, width, height)
-            image = np.array(image).astype(np.float32) / 255.0
-            image = image[None].transpose(0, 3, 1, 2)
-            image = torch.from_numpy(image)
+        def decode(samples):
+            return first_stage_decoder(first_stage.decode_first_stage, samples, to_uint8=False)
 
+        # tiles are encoded, sampled and decoded batch_size at a time with one shared conditioning,
+        # the overlaps are blended with linear ramps
+        precision_scope = autocast if opt.precision == "autocast" else nullcontext
+        with torch.no_grad(), precision_scope("cuda"), (model.ema_scope() if not opt.optimized else nullcontext()):
             if opt.optimized:
+                modelCS.to(device)
+            with span('text_encoder', sync=True):
+                conditioning = get_conditioning(cond_stage, batch_size * [prompt], partial(split_weighted_subprompts, normalize=False))
+                unconditional_conditioning = cond_stage.get_learned_conditioning(batch_size * [negprompt])
+            if opt.optimized:
+                modelCS.to("cpu")
                 modelFS.to(device)
-
-            init_image = 2. * image - 1.
-            init_image = init_image.to(device)
-            init_image = repeat(init_image, '1 ... -> b ...', b=batch_size)
-            init_latent = (model if not opt.optimized else modelFS).get_first_stage_encoding((model if not opt.optimized else modelFS).encode_first_stage(init_image))  # move to latent space
-
+            with span('gobig', sync=True):
+                combined = gobig(np.array(result.convert("RGB")), width, height, 64, batch_size, encode, sample, decode)
             if opt.optimized:
-                mem = torch.cuda.memory_allocated()/1e6
                 modelFS.to("cpu")
-                while(torch.cuda.memory_allocated()/1e6 >= mem):
-                    time.sleep(1)
-
-            return init_latent,
-
-        def sample(init_data, x, conditioning, unconditional_conditioning, sampler_name, img_callback: Callable = None):
-            if sampler_name != 'DDIM':
-                x0, = init_data
-
-                sigmas = sampler.model_wrap.get_sigmas(ddim_steps)
-                noise = x * sigmas[ddim_steps - t_enc - 1]
-
-                xi = x0 + noise
-                sigma_sched = sigmas[ddim_steps - t_enc - 1:]
-                model_wrap_cfg = CFGDenoiser(sampler.model_wrap)
-                samples_ddim = K.sampling.__dict__[f'sample_{sampler.get_sampler_name()}'](model_wrap_cfg, xi, sigma_sched, extra_args={'cond': conditioning, 'uncond': unconditional_conditioning, 'cond_scale': cfg_scale}, disable=False, callback=partial(KDiffusionSampler.img_callback_wrapper, img_callback))
-            else:
-                x0, = init_data
-                sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=0.0, verbose=False)
-                z_enc = sampler.stochastic_encode(x0, torch.tensor([t_enc]*batch_size).to(device))
-                                    # decode it
-                samples_ddim = sampler.decode(z_enc, conditioning, t_enc,
-                                                unconditional_guidance_scale=cfg_scale,
-                                                unconditional_conditioning=unconditional_conditioning,)
-            return samples_ddim
-        def split_grid(image, tile_w=512, tile_h=512, overlap=64):
-            Grid = namedtuple("Grid", ["tiles", "tile_w", "tile_h", "image_w", "image_h", "overlap"])
-            w = image.width
-            h = image.height
-
-            now = tile_w - overlap  # non-overlap width
-            noh = tile_h - overlap
-
-            cols = math.ceil((w - overlap) / now)
-            rows = math.ceil((h - overlap) / noh)
-
-            grid = Grid([], tile_w, tile_h, w, h, overlap)
-            for row in range(rows):
-                row_images = []
 
-                y = row * noh
-
-                if y + tile_h >= h:
-                    y = h - tile_h
-
-                for col in range(cols):
-                    x = col * now
-
-                    if x+tile_w >= w:
-                        x = w - tile_w
-
-                    tile = image.crop((x, y, x + tile_w, y + tile_h))
-
-                    row_images.append([x, tile_w, tile])
-
-                grid.tiles.append([y, tile_h, row_images])
-
-            return grid
-
-
-        def combine_grid(grid):
-            def make_mask_image(r):
-                r = r * 255 / grid.overlap
-                r = r.astype(np.uint8)
-                return Image.fromarray(r, 'L')
-
-            mask_w = make_mask_image(np.arange(grid.overlap, dtype=np.float).reshape((1, grid.overlap)).repeat(grid.tile_h, axis=0))
-            mask_h = make_mask_image(np.arange(grid.overlap, dtype=np.float).reshape((grid.overlap, 1)).repeat(grid.image_w, axis=1))
-
-            combined_image = Image.new("RGB", (grid.image_w, grid.image_h))
-            for y, h, row in grid.tiles:
-                combined_row = Image.new("RGB", (grid.image_w, h))
-                for x, w, tile in row:
-                    if x == 0:
-                        combined_row.paste(tile, (0, 0))
-                        continue
-
-                    combined_row.paste(tile.crop((0, 0, grid.overlap, h)), (x, 0), mask=mask_w)
-                    combined_row.paste(tile.crop((grid.overlap, 0, w, h)), (x + grid.overlap, 0))
-
-                if y == 0:
-                    combined_image.paste(combined_row, (0, 0))
-                    continue
-
-                combined_image.paste(combined_row.crop((0, 0, combined_row.width, grid.overlap)), (0, y), mask=mask_h)
-                combined_image.paste(combined_row.crop((0, grid.overlap, combined_row.width, h)), (0, y + grid.overlap))
-
-            return combined_image
-
-        grid = split_grid(result, tile_w=width, tile_h=height, overlap=64)
-        work = []
-        work_results = []
-
-        for y, h, row in grid.tiles:
-            for tiledata in row:
-                work.append(tiledata[2])
-        batch_count = math.ceil(len(work) / batch_size)
-        print(f"GoBig upscaling will process a total of {len(work)} images tiled as {len(grid.tiles[0][2])}x{len(grid.tiles)} in a total of {batch_count} batches.")
-        for i in range(batch_count):
-            init_img = work[i*batch_size:(i+1)*batch_size][0]
-            output_images, seed, info, stats = process_images(
-                    outpath=outpath,
-                    func_init=init,
-                    func_sample=sample,
-                    prompt=prompt,
-                    seed=seed,
-                    sampler_name=sampler_name,
-                    skip_save=skip_save,
-                    skip_grid=skip_grid,
-                    batch_size=batch_size,
-                    n_iter=n_iter,
-                    steps=ddim_steps,
-                    cfg_scale=cfg_scale,
-                    width=width,
-                    height=height,
-                    prompt_matrix=None,
-                    filter_nsfw=False,
-                    use_GFPGAN=None,
-                    use_RealESRGAN=None,
-                    realesrgan_model_name=None,
-                    fp=None,
-                    normalize_prompt_weights=False,
-                    init_img=init_img,
-                    init_mask=None,
-                    keep_mask=False,
-                    mask_blur_strength=None,
-                    denoising_strength=denoising_strength,
-                    mask_restore=mask_restore,
-                    resize_mode=resize_mode,
-                    uses_loopback=False,
-                    sort_samples=True,
-                    write_info_files=True,
-                    write_sample_info_to_log_file=False,
-                    jpg_sample=False,
-                    imgProcessorTask=True
-                )
-            #if initial_seed is None:
-            #    initial_seed = seed
-            #seed = seed + 1
-
-            work_results.append(output_images[0])
-        image_index = 0
-        for y, h, row in grid.tiles:
-            for tiledata in row:
-                tiledata[2] = work_results[image_index]
-                image_index += 1
-
-        combined_image = combine_grid(grid)
-        grid_count = len(os.listdir(outpath)) - 1
+        combined_image = Image.fromarray(combined)
         del sampler
 
         torch.cuda.empty_cache()
@@ -2143,7 +1803,8 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
         return combined_image
     def processLDSR(image):
         metadata = ImageMetadata.get_from_image(image)
-        result = LDSR.superResolution(image,int(imgproc_ldsr_steps),str(imgproc_ldsr_pre_downSample),str(imgproc_ldsr_post_downSample))
+        with span('ldsr', sync=True):
+            result = LDSR.superResolution(image,int(imgproc_ldsr_steps),str(imgproc_ldsr_pre_downSample),str(imgproc_ldsr_post_downSample))
         ImageMetadata.set_on_image(result, metadata)
         return result
 
@@ -2164,131 +1825,151 @@ def imgproc(image,image_batch,imgproc_prompt,imgproc_toggles, imgproc_upscale_to
         else:
             images.append(image)
 
-    if len(images) > 0:
-        print("Processing images...")
-        #pre load models not in loop
-        if 0 in imgproc_toggles:
-            ModelLoader(['RealESGAN','LDSR'],False,True) # Unload unused models
-            ModelLoader(['GFPGAN'],True,False) # Load used models
-        if 1 in imgproc_toggles:
-                if imgproc_upscale_toggles == 0:
-                     ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
-                     ModelLoader(['RealESGAN'],True,False,imgproc_realesrgan_model_name) # Load used models
-                elif imgproc_upscale_toggles == 1:
-                        ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
-                        ModelLoader(['RealESGAN','model'],True,False) # Load used models
-                elif imgproc_upscale_toggles == 2:
-
-                    ModelLoader(['model','GFPGAN','RealESGAN'],False,True) # Unload unused models
-                    ModelLoader(['LDSR'],True,False) # Load used models
-                elif imgproc_upscale_toggles == 3:
-                    ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
-                    ModelLoader(['RealESGAN','model'],True,False,imgproc_realesrgan_model_name) # Load used models
-        for image in images:
-            metadata = ImageMetadata.get_from_image(image)
+    trace = Trace('imgproc', images=len(images), toggles=list(imgproc_toggles), upscaler=imgproc_upscale_toggles)
+    trace_token = current_trace.set(trace)
+    try:
+        if len(images) > 0:
+            print("Processing images...")
+            #pre load models not in loop
             if 0 in imgproc_toggles:
-                #recheck if GFPGAN is loaded since it's the only model that can be loaded in the loop as well
+                ModelLoader(['RealESRGAN','LDSR'],False,True) # Unload unused models
                 ModelLoader(['GFPGAN'],True,False) # Load used models
-                image = processGFPGAN(image,imgproc_gfpgan_strength)
-                if metadata:
-                    metadata.GFPGAN = True
-                ImageMetadata.set_on_image(image, metadata)
-                outpathDir = os.path.join(outpath,'GFPGAN')
-                os.makedirs(outpathDir, exist_ok=True)
-                batchNumber = get_next_sequence_number(outpathDir)
-                outFilename = str(batchNumber)+'-'+'result'
-
-                if 1 not in imgproc_toggles:
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
             if 1 in imgproc_toggles:
-                if imgproc_upscale_toggles == 0:
-                    image = processRealESRGAN(image)
-                    ImageMetadata.set_on_image(image, metadata)
-                    outpathDir = os.path.join(outpath,'RealESRGAN')
-                    os.makedirs(outpathDir, exist_ok=True)
-                    batchNumber = get_next_sequence_number(outpathDir)
-                    outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
-
-                elif imgproc_upscale_toggles == 1:
-                    image = processGoBig(image)
-                    ImageMetadata.set_on_image(image, metadata)
-                    outpathDir = os.path.join(outpath,'GoBig')
-                    os.makedirs(outpathDir, exist_ok=True)
-                    batchNumber = get_next_sequence_number(outpathDir)
-                    outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
-
-                elif imgproc_upscale_toggles == 2:
-                    image = processLDSR(image)
-                    ImageMetadata.set_on_image(image, metadata)
-                    outpathDir = os.path.join(outpath,'LDSR')
-                    os.makedirs(outpathDir, exist_ok=True)
-                    batchNumber = get_next_sequence_number(outpathDir)
-                    outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-                    save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
-
-                elif imgproc_upscale_toggles == 3:
-                    image = processGoBig(image)
-                    ModelLoader(['model','GFPGAN','RealESGAN'],False,True) # Unload unused models
-                    ModelLoader(['LDSR'],True,False) # Load used models
-                    image = processLDSR(image)
+                    if imgproc_upscale_toggles == 0:
+                         ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
+                         ModelLoader(['RealESRGAN'],True,False,imgproc_realesrgan_model_name) # Load used models
+                    elif imgproc_upscale_toggles == 1:
+                            ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
+                            ModelLoader(['RealESRGAN','model'],True,False) # Load used models
+                    elif imgproc_upscale_toggles == 2:
+
+                        ModelLoader(['model','GFPGAN','RealESRGAN'],False,True) # Unload unused models
+                        ModelLoader(['LDSR'],True,False) # Load used models
+                    elif imgproc_upscale_toggles == 3:
+                        ModelLoader(['GFPGAN','LDSR'],False,True) # Unload unused models
+                        ModelLoader(['RealESRGAN','model'],True,False,imgproc_realesrgan_model_name) # Load used models
+            # face restoration and RealESRGAN run over the whole batch before the per image loop
+            if 0 in imgproc_toggles:
+                ModelLoader(['GFPGAN'],True,False) # Load used models
+                restored_images = processGFPGAN(images,imgproc_gfpgan_strength)
+            if 1 in imgproc_toggles and imgproc_upscale_toggles == 0:
+                upscaled_images = processRealESRGAN(restored_images if 0 in imgproc_toggles else images)
+            for n, image in enumerate(images):
+                metadata = ImageMetadata.get_from_image(image)
+                if 0 in imgproc_toggles:
+                    image = restored_images[n]
+                    if metadata:
+                        metadata.GFPGAN = True
                     ImageMetadata.set_on_image(image, metadata)
-                    outpathDir = os.path.join(outpath,'GoLatent')
+                    outpathDir = os.path.join(outpath,'GFPGAN')
                     os.makedirs(outpathDir, exist_ok=True)
                     batchNumber = get_next_sequence_number(outpathDir)
                     outFilename = str(batchNumber)+'-'+'result'
-                    output.append(image)
-
-                    save_sample(image, outpathDir, outFilename, None, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
 
-    #LDSR is always unloaded to avoid memory issues
-    #ModelLoader(['LDSR'],False,True)
-    #print("Reloading default models...")
-    #ModelLoader(['model','RealESGAN','GFPGAN'],True,False) # load back models
-    print("Done.")
+                    if 1 not in imgproc_toggles:
+                        output.append(image)
+                        save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
+                if 1 in imgproc_toggles:
+                    if imgproc_upscale_toggles == 0:
+                        image = upscaled_images[n]
+                        ImageMetadata.set_on_image(image, metadata)
+                        outpathDir = os.path.join(outpath,'RealESRGAN')
+                        os.makedirs(outpathDir, exist_ok=True)
+                        batchNumber = get_next_sequence_number(outpathDir)
+                        outFilename = str(batchNumber)+'-'+'result'
+                        output.append(image)
+                        save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
+
+                    elif imgproc_upscale_toggles == 1:
+                        image = processGoBig(image)
+                        ImageMetadata.set_on_image(image, metadata)
+                        outpathDir = os.path.join(outpath,'GoBig')
+                        os.makedirs(outpathDir, exist_ok=True)
+                        batchNumber = get_next_sequence_number(outpathDir)
+                        outFilename = str(batchNumber)+'-'+'result'
+                        output.append(image)
+                        save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
+
+                    elif imgproc_upscale_toggles == 2:
+                        image = processLDSR(image)
+                        ImageMetadata.set_on_image(image, metadata)
+                        outpathDir = os.path.join(outpath,'LDSR')
+                        os.makedirs(outpathDir, exist_ok=True)
+                        batchNumber = get_next_sequence_number(outpathDir)
+                        outFilename = str(batchNumber)+'-'+'result'
+                        output.append(image)
+                        save_sample(image, outpathDir, outFilename, False, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
+
+                    elif imgproc_upscale_toggles == 3:
+                        image = processGoBig(image)
+                        ModelLoader(['model','GFPGAN','RealESRGAN'],False,True) # Unload unused models
+                        ModelLoader(['LDSR'],True,False) # Load used models
+                        image = processLDSR(image)
+                        ImageMetadata.set_on_image(image, metadata)
+                        outpathDir = os.path.join(outpath,'GoLatent')
+                        os.makedirs(outpathDir, exist_ok=True)
+                        batchNumber = get_next_sequence_number(outpathDir)
+                        outFilename = str(batchNumber)+'-'+'result'
+                        output.append(image)
+
+                        save_sample(image, outpathDir, outFilename, None, None, None, None, None, None, False, None, None, None, None, None, None, None, None, None, False)
+
+        #LDSR is always unloaded to avoid memory issues
+        #ModelLoader(['LDSR'],False,True)
+        #print("Reloading default models...")
+        #ModelLoader(['model','RealESRGAN','GFPGAN'],True,False) # load back models
+    finally:
+        current_trace.reset(trace_token)
+        trace.finish()
+    print(f"Done. {trace.summary()}")
     return output
 
+def resident_RealESRGAN(model_name):
+    if model_name not in residency:
+        residency.register(model_name, partial(load_RealESRGAN, model_name), unload=lambda instance: forget_RealESRGAN(model_name, *RealESRGAN_device()))
+    return model_name
+
 def ModelLoader(models,load=False,unload=False,imgproc_realesrgan_model_name='RealESRGAN_x4plus'):
-    #get global variables
+    # unloading only lets the residency manager evict a model when it needs the room,
+    # loading takes it from the gpu, pinned host memory or disk, whichever is closest
+    global RealESRGAN_model_name
+    with span('model_load', sync=True):
+        realesrgan = [name for name in residency.entries if name.startswith('RealESRGAN')]
+        if unload:
+            for m in models:
+                for name in (realesrgan if m == 'RealESRGAN' else [m]):
+                    residency.release(name)
+        if load:
+            for m in models:
+                if m == 'RealESRGAN':
+                    RealESRGAN_model_name = resident_RealESRGAN(imgproc_realesrgan_model_name)
+                    m = RealESRGAN_model_name
+                if m == 'LDSR':
+                    # LDSR loads its own model on every call and needs the memory
+                    residency.evict_unused()
+                if m in residency:
+                    residency.get(m)
+        publish_models()
+        torch_gc()
+
+RealESRGAN_model_name = opt.realesrgan_model
+
+def publish_models():
+    # the globals only point at models that are on their device
     global_vars = globals()
-    #check if m is in globals
-    if unload:
-        for m in models:
-            if m in global_vars:
-                #if it is, delete it
-                del global_vars[m]
-                if opt.optimized:
-                    if m == 'model':
-                        del global_vars[m+'FS']
-                        del global_vars[m+'CS']
-                if m =='model':
-                    m='Stable Diffusion'
-                print('Unloaded ' + m)
-    if load:
-        for m in models:
-            if m not in global_vars or m in global_vars and type(global_vars[m]) == bool:
-                #if it isn't, load it
-                if m == 'GFPGAN':
-                    global_vars[m] = load_GFPGAN()
-                elif m == 'model':
-                    sdLoader = load_SD_model()
-                    global_vars[m] = sdLoader[0]
-                    if opt.optimized:
-                        global_vars[m+'CS'] = sdLoader[1]
-                        global_vars[m+'FS'] = sdLoader[2]
-                elif m == 'RealESRGAN':
-                    global_vars[m] = load_RealESRGAN(imgproc_realesrgan_model_name)
-                elif m == 'LDSR':
-                    global_vars[m] = load_LDSR()
-                if m =='model':
-                    m='Stable Diffusion'
-                print('Loaded ' + m)
-    torch_gc()
+    resident = {name: entry.obj for name, entry in residency.entries.items() if entry.tier == 'device'}
+    if 'model' in resident:
+        global_vars['model'] = resident['model'][0]
+        if opt.optimized:
+            global_vars['modelCS'], global_vars['modelFS'] = resident['model'][1:3]
+    else:
+        for name in (['model', 'modelCS', 'modelFS'] if opt.optimized else ['model']):
+            global_vars.pop(name, None)
+    for name, key in [('GFPGAN', 'GFPGAN'), ('LDSR', 'LDSR'), ('RealESRGAN', RealESRGAN_model_name)]:
+        if key in resident:
+            global_vars[name] = resident[key]
+        else:
+            global_vars.pop(name, None)
 
 
 def run_GFPGAN(image, strength):
@@ -2297,7 +1978,7 @@ def run_GFPGAN(image, strength):
     metadata = ImageMetadata.get_from_image(image)
     image = image.convert("RGB")
 
-    cropped_faces, restored_faces, restored_img = GFPGAN.enhance(np.array(image, dtype=np.uint8), has_aligned=False, only_center_face=False, paste_back=True)
+    restored_img = postprocessor.restore_faces(GFPGAN, [np.array(image, dtype=np.uint8)])[0]
     res = Image.fromarray(restored_img)
     metadata.GFPGAN = True
     ImageMetadata.set_on_image(res, metadata)
@@ -2309,14 +1990,12 @@ def run_GFPGAN(image, strength):
 
 def run_RealESRGAN(image, model_name: str):
     ModelLoader(['GFPGAN','LDSR'],False,True)
-    ModelLoader(['RealESRGAN'],True,False)
-    if RealESRGAN.model.name != model_name:
-            try_loading_RealESRGAN(model_name)
+    ModelLoader(['RealESRGAN'],True,False,model_name)
 
     metadata = ImageMetadata.get_from_image(image)
     image = image.convert("RGB")
 
-    output, img_mode = RealESRGAN.enhance(np.array(image, dtype=np.uint8))
+    output = postprocessor.upscale(RealESRGAN, [np.array(image, dtype=np.uint8)])[0]
     res = Image.fromarray(output)
     ImageMetadata.set_on_image(res, metadata)
 
@@ -2367,6 +2046,8 @@ txt2img_defaults = {
     'fp': None,
     'variant_amount': 0.0,
     'variant_seed': '',
+    'cfg_sigma_min': 0.0,
+    'cfg_sigma_max': 0.0,
     'submit_on_enter': 'Yes',
 }
 
@@ -2442,6 +2123,8 @@ img2img_defaults = {
     'height': 512,
     'width': 512,
     'fp': None,
+    'cfg_sigma_min': 0.0,
+    'cfg_sigma_max': 0.0,
 }
 
 if 'img2img' in user_defaults:
@@ -2495,7 +2178,8 @@ demo = draw_gradio_ui(opt,
                       LDSR=LDSR,
                       run_GFPGAN=run_GFPGAN,
                       run_RealESRGAN=run_RealESRGAN,
-                      job_manager=job_manager
+                      job_manager=job_manager,
+                      telemetry=lambda: get_telemetry(opt.gpu).summary()
                         )
 
 class ServerLauncher(threading.Thread):
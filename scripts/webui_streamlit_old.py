@@ -34,12 +34,16 @@ from typing import Union
 from pathlib import Path
 #from tqdm import tqdm
 from contextlib import nullcontext
+from functools import partial
 from einops import rearrange
 from omegaconf import OmegaConf
 from io import StringIO
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.models.diffusion.plms import PLMSSampler
 from ldm.util import instantiate_from_config
+from ldm.checkpoint import load_model, load_state_dict
+from modules.residency import ModelResidency
+from modules.previews import latent_to_rgb
 
 from retry import retry
 
@@ -137,109 +141,67 @@ def load_models(continue_prev_run = False, use_GFPGAN=False, use_RealESRGAN=Fals
             ).decode("ascii")
 
 	# check what models we want to use and if the they are already loaded.
+	# st.session_state is used for keeping the models in memory across multiple pages or runs,
+	# models that are switched off stay warm in the residency manager until it needs the room.
+	if "residency" not in st.session_state:
+		st.session_state["residency"] = ModelResidency()
+		st.session_state["residency"].register("GFPGAN", load_GFPGAN)
+	residency = st.session_state["residency"]
 
 	if use_GFPGAN:
-		if "GFPGAN" in st.session_state:
-			print("GFPGAN already loaded")
-		else:
-			# Load GFPGAN
-			if os.path.exists(defaults.general.GFPGAN_dir):
-				try:
-					st.session_state["GFPGAN"] = load_GFPGAN()
-					print("Loaded GFPGAN")
-				except Exception:
-					import traceback
-					print("Error loading GFPGAN:", file=sys.stderr)
-					print(traceback.format_exc(), file=sys.stderr)          
+		# Load GFPGAN
+		if os.path.exists(defaults.general.GFPGAN_dir):
+			try:
+				st.session_state["GFPGAN"] = residency.get("GFPGAN")
+				print("Loaded GFPGAN")
+			except Exception:
+				import traceback
+				print("Error loading GFPGAN:", file=sys.stderr)
+				print(traceback.format_exc(), file=sys.stderr)          
 	else:
 		if "GFPGAN" in st.session_state:
 			del st.session_state["GFPGAN"]        
+		residency.release("GFPGAN")
 
-	if use_RealESRGAN:
-		if "RealESRGAN" in st.session_state and st.session_state["RealESRGAN"].model.name == RealESRGAN_model:
-			print("RealESRGAN already loaded")
-		else:
-			#Load RealESRGAN 
-			try:
-				# We first remove the variable in case it has something there,
-				# some errors can load the model incorrectly and leave things in memory.
-				del st.session_state["RealESRGAN"]
-			except KeyError:
-				pass
-
-			if os.path.exists(defaults.general.RealESRGAN_dir):
-				# st.session_state is used for keeping the models in memory across multiple pages or runs.
-				st.session_state["RealESRGAN"] = load_RealESRGAN(RealESRGAN_model)
-				print("Loaded RealESRGAN with model "+ st.session_state["RealESRGAN"].model.name)
-
-	else:
-		if "RealESRGAN" in st.session_state:
-			del st.session_state["RealESRGAN"]        
-
-	
+	if "RealESRGAN" in st.session_state:
+		# We first remove the variable in case it has something there,
+		# some errors can load the model incorrectly and leave things in memory.
+		residency.release(st.session_state["RealESRGAN"].model.name)
+		del st.session_state["RealESRGAN"]
 
-	if "model" in st.session_state:
-		if "model" in st.session_state and st.session_state["custom_model"] == custom_model:
-			print("Model already loaded")
-		else:
-			try:
-				del st.session_state["model"]
-			except KeyError:
-				pass
-			
-			config = OmegaConf.load(defaults.general.default_model_config)
-			
-			if custom_model == defaults.general.default_model:
-				model = load_model_from_config(config, defaults.general.default_model_path)			
-			else:
-				model = load_model_from_config(config, os.path.join("models","custom", f"{custom_model}.ckpt")) 
-				
-			st.session_state["custom_model"] = custom_model
-			st.session_state["device"] = torch.device(f"cuda:{defaults.general.gpu}") if torch.cuda.is_available() else torch.device("cpu")
-			st.session_state["model"] = (model if defaults.general.no_half else model.half()).to(st.session_state["device"] ) 			
+	if use_RealESRGAN:
+		#Load RealESRGAN 
+		if os.path.exists(defaults.general.RealESRGAN_dir):
+			if RealESRGAN_model not in residency:
+				residency.register(RealESRGAN_model, partial(load_RealESRGAN, RealESRGAN_model))
+			st.session_state["RealESRGAN"] = residency.get(RealESRGAN_model)
+			print("Loaded RealESRGAN with model "+ st.session_state["RealESRGAN"].model.name)
+
+	# every custom model is its own entry, switching back to one that is still warm skips the load
+	if custom_model == defaults.general.default_model:
+		ckpt = defaults.general.default_model_path
 	else:
-		config = OmegaConf.load(defaults.general.default_model_config)
-
-		if custom_model == defaults.general.default_model:
-			model = load_model_from_config(config, defaults.general.default_model_path)			
-		else:
-			model = load_model_from_config(config, os.path.join("models","custom", f"{custom_model}.ckpt")) 
-		
-		st.session_state["custom_model"] = custom_model		
-		st.session_state["device"] = torch.device(f"cuda:{defaults.general.gpu}") if torch.cuda.is_available() else torch.device("cpu")
-		st.session_state["model"] = (model if defaults.general.no_half else model.half()).to(st.session_state["device"] )    
+		ckpt = os.path.join("models","custom", f"{custom_model}.ckpt")
+	if custom_model not in residency:
+		residency.register(custom_model, partial(load_model_from_config, OmegaConf.load(defaults.general.default_model_config), ckpt))
+	if "custom_model" in st.session_state and st.session_state["custom_model"] != custom_model:
+		residency.release(st.session_state["custom_model"])
 
-		print("Model loaded.")
+	st.session_state["model"] = residency.get(custom_model)
+	st.session_state["custom_model"] = custom_model
+	st.session_state["device"] = torch.device(f"cuda:{defaults.general.gpu}") if torch.cuda.is_available() else torch.device("cpu")
 
+	print("Model loaded.")
 
 def load_model_from_config(config, ckpt, verbose=False):
-
-	print(f"Loading model from {ckpt}")
-
-	pl_sd = torch.load(ckpt, map_location="cpu")
-	if "global_step" in pl_sd:
-		print(f"Global Step: {pl_sd['global_step']}")
-	sd = pl_sd["state_dict"]
-	model = instantiate_from_config(config.model)
-	m, u = model.load_state_dict(sd, strict=False)
-	if len(m) > 0 and verbose:
-		print("missing keys:")
-		print(m)
-	if len(u) > 0 and verbose:
-		print("unexpected keys:")
-		print(u)
-
-	model.cuda()
-	model.eval()
-	return model
+	# builds the model without weight init and streams the cached checkpoint straight into device and dtype
+	device = torch.device(f"cuda:{defaults.general.gpu}") if torch.cuda.is_available() else torch.device("cpu")
+	return load_model(config, ckpt, device=device, half=not defaults.general.no_half, verbose=verbose, cache=not defaults.general.no_ckpt_cache)
 
 def load_sd_from_config(ckpt, verbose=False):
 	print(f"Loading model from {ckpt}")
-	pl_sd = torch.load(ckpt, map_location="cpu")
-	if "global_step" in pl_sd:
-		print(f"Global Step: {pl_sd['global_step']}")
-	sd = pl_sd["state_dict"]
-	return sd
+	# a plain dict, the optimized loader renames keys in place
+	return dict(load_state_dict(ckpt, cache=not defaults.general.no_ckpt_cache))
 #
 @retry(tries=5)
 def generation_callback(img, i=0):
@@ -257,14 +219,17 @@ def generation_callback(img, i=0):
 		# The following lines will convert the tensor we got on img to an actual image we can render on the UI.
 		# It can probably be done in a better way for someone who knows what they're doing. I don't.		
 		#print (img,isinstance(img, torch.Tensor))
-		if isinstance(img, torch.Tensor):
-			x_samples_ddim = (st.session_state["model"] if not defaults.general.optimized else modelFS).decode_first_stage(img)          
-		else:
+		if not isinstance(img, torch.Tensor):
 			# When using the k Diffusion samplers they return a dict instead of a tensor that look like this:
 			# {'x': x, 'i': i, 'sigma': sigmas[i], 'sigma_hat': sigmas[i], 'denoised': denoised}			
-			x_samples_ddim = (st.session_state["model"] if not defaults.general.optimized else modelFS).decode_first_stage(img["denoised"])
+			img = img["denoised"]
 
-		x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)  
+		if defaults.general.preview_mode == "latent":
+			# a linear map of the latents to rgb, no VAE pass
+			x_samples_ddim = latent_to_rgb(img[:1])
+		else:
+			x_samples_ddim = (st.session_state["model"] if not defaults.general.optimized else modelFS).decode_first_stage(img[:1])
+			x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)  
 
 		pil_image = transforms.ToPILImage()(x_samples_ddim.squeeze_(0)) 			
 
@@ -578,18 +543,14 @@ def optimize_update_preview_frequency(current_chunk_speed, previous_chunk_speed,
 def diffuse(
         pipe,
         cond_embeddings, # text conditioning, should be (1, 77, 768)
+        uncond_embeddings, # embedding of the empty prompt, (1, 77, 768), computed once per run
         cond_latents,    # image conditioning, should be (1, 4, 64, 64)
         num_inference_steps,
         cfg_scale,
         eta,
         ):
 	
-	torch_device = cond_latents.get_device()
-
 	# classifier guidance: add the unconditional embedding
-	max_length = cond_embeddings.shape[1] # 77
-	uncond_input = pipe.tokenizer([""], padding="max_length", max_length=max_length, return_tensors="pt")
-	uncond_embeddings = pipe.text_encoder(uncond_input.input_ids.to(torch_device))[0]
 	text_embeddings = torch.cat([uncond_embeddings, cond_embeddings])
 
 	# if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
@@ -1980,6 +1941,10 @@ def txt2vid(
 	text_input = st.session_state["pipe"].tokenizer(prompts, padding="max_length", max_length=st.session_state["pipe"].tokenizer.model_max_length, truncation=True, return_tensors="pt")
 	cond_embeddings = st.session_state["pipe"].text_encoder(text_input.input_ids.to(torch_device))[0] # shape [1, 77, 768]
 
+	# the unconditional embedding for classifier free guidance, the same for every frame
+	uncond_input = st.session_state["pipe"].tokenizer([""], padding="max_length", max_length=cond_embeddings.shape[1], return_tensors="pt")
+	uncond_embeddings = st.session_state["pipe"].text_encoder(uncond_input.input_ids.to(torch_device))[0]
+
 	# sample a source
 	init1 = torch.randn((1, st.session_state["pipe"].unet.in_channels, height // 8, width // 8), device=torch_device)
 
@@ -2019,7 +1984,7 @@ def txt2vid(
 				init = slerp(gpu, float(t), init1, init2)
 				
 				with autocast("cuda"):
-					image = diffuse(st.session_state["pipe"], cond_embeddings, init, num_inference_steps, cfg_scale, eta)
+					image = diffuse(st.session_state["pipe"], cond_embeddings, uncond_embeddings, init, num_inference_steps, cfg_scale, eta)
 
 				im = Image.fromarray(image)
 				outpath = os.path.join(full_path, 'frame%06d.png' % frame_index)